@@ -6,16 +6,19 @@ from ._type_format_syndna_pool import (
     SyndnaPoolCsvFormat, SyndnaPoolDirectoryFormat,
     SyndnaPoolConcentrationTable)
 from ._type_format_linear_regressions import (
-    LinearRegressionsYamlFormat,
+    LinearRegressionsYamlFormat, LinearRegressionsInputsYamlFormat,
     LinearRegressionsDirectoryFormat, LinearRegressions)
 from ._type_format_pysyndna_log import (
     PysyndnaLogFormat,
     PysyndnaLogDirectoryFormat, PysyndnaLog)
 from ._type_format_length import (
-    TSVLengthFormat, TSVLengthDirectoryFormat, Length)
+    TSVLengthFormat, LengthArrayFormat, TSVLengthDirectoryFormat, Length)
 from ._type_format_coords import (
-    CoordsFormat, CoordsDirectoryFormat, Coords)
-from ._method import fit, count_cells, count_copies
+    CoordsFormat, CoordsArrayFormat, CoordsDirectoryFormat, Coords)
+from ._type_format_coverage import PercentCoverage
+from ._method import fit, merge_regressions, count_cells, \
+    calc_genome_coverages, count_cells_gdna_and_sample, count_cells_sweep, \
+    count_copies
 from ._visualizer import view_log, view_fit
 
 from . import _version
@@ -27,9 +30,13 @@ __all__ = [__plugin_name__, __package_name__, __description__,
            __long_description__, __license__, __author__, __email__,
            __url__, __citations_fname__, SyndnaPoolCsvFormat,
            SyndnaPoolDirectoryFormat, SyndnaPoolConcentrationTable,
-           LinearRegressionsYamlFormat, LinearRegressionsDirectoryFormat,
+           LinearRegressionsYamlFormat, LinearRegressionsInputsYamlFormat,
+           LinearRegressionsDirectoryFormat,
            LinearRegressions, PysyndnaLogFormat, PysyndnaLogDirectoryFormat,
-           PysyndnaLog, TSVLengthFormat, TSVLengthDirectoryFormat, Length,
-           CoordsFormat, CoordsDirectoryFormat, Coords, fit, count_cells,
-           count_copies, view_log, view_fit]
+           PysyndnaLog, TSVLengthFormat, LengthArrayFormat,
+           TSVLengthDirectoryFormat, Length,
+           CoordsFormat, CoordsArrayFormat, CoordsDirectoryFormat, Coords,
+           PercentCoverage, fit, merge_regressions, count_cells,
+           calc_genome_coverages, count_cells_gdna_and_sample,
+           count_cells_sweep, count_copies, view_log, view_fit]
 
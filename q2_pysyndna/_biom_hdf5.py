@@ -0,0 +1,268 @@
+import os
+import shutil
+import tempfile
+from typing import Iterator, List, Tuple
+
+import biom
+import h5py
+import numpy as np
+from scipy import sparse
+from q2_types.feature_table import BIOMV210DirFmt
+
+from q2_pysyndna._type_format_pysyndna_log import \
+    extract_fp_from_directory_format
+from q2_pysyndna._version import get_versions
+
+_OBSERVATION_AXIS = 'observation'
+_SAMPLE_AXIS = 'sample'
+_MATRIX_DATA = 'matrix/data'
+_MATRIX_INDICES = 'matrix/indices'
+_MATRIX_INDPTR = 'matrix/indptr'
+_IDS = 'ids'
+_GENERATED_BY = f"q2-pysyndna {get_versions()['version']}"
+# the most stored values the writer reads or writes at once
+_WRITE_CHUNK_NNZ = 4 * 1024 ** 2
+
+
+def biom_dir_fmt_to_table(data: BIOMV210DirFmt) -> biom.Table:
+    return biom.load_table(extract_fp_from_directory_format(data, data.file))
+
+
+def table_to_biom_dir_fmt(table: biom.Table) -> BIOMV210DirFmt:
+    result = BIOMV210DirFmt()
+    biom_fp = extract_fp_from_directory_format(result, result.file)
+    with h5py.File(biom_fp, 'w') as fh:
+        table.to_hdf5(fh, _GENERATED_BY)
+    return result
+
+
+def read_biom_ids(biom_fp: str) -> Tuple[List[str], List[str]]:
+    """Read a biom HDF5 file's observation and sample ids (but not counts).
+    """
+    with h5py.File(biom_fp, 'r') as fh:
+        return (_decode_ids(fh[_OBSERVATION_AXIS][_IDS][:]),
+                _decode_ids(fh[_SAMPLE_AXIS][_IDS][:]))
+
+
+def iter_biom_sample_blocks(biom_fp: str, sample_block_size: int) -> \
+        Iterator[Tuple[int, sparse.csc_matrix]]:
+    """Read a biom HDF5 file's counts a block of samples at a time.
+
+    Parameters
+    ----------
+    biom_fp : str
+        Path to a biom (v2.1, HDF5) file.
+    sample_block_size : int
+        The number of samples (columns) in each block; the last block may
+        have fewer.
+
+    Yields
+    ------
+    first_sample_num : int
+        The position in the file's samples of the block's first sample.
+    block_matrix : scipy.sparse.csc_matrix
+        The observations x samples counts of the block's samples, read from
+        the file's compressed sparse column matrix, so only the block's
+        stored values are ever in memory.
+    """
+    with h5py.File(biom_fp, 'r') as fh:
+        sample_grp = fh[_SAMPLE_AXIS]
+        num_observations = len(fh[_OBSERVATION_AXIS][_IDS])
+        indptr = sample_grp[_MATRIX_INDPTR][:].astype(np.int64)
+        num_samples = len(indptr) - 1
+        for start in range(0, num_samples, sample_block_size):
+            stop = min(start + sample_block_size, num_samples)
+            first, last = indptr[start], indptr[stop]
+            yield start, sparse.csc_matrix(
+                (sample_grp[_MATRIX_DATA][first:last],
+                 sample_grp[_MATRIX_INDICES][first:last],
+                 indptr[start:stop + 1] - first),
+                shape=(num_observations, stop - start))
+
+
+class SpilledBiomWriter:
+    """Write a sparse biom HDF5 file from values calculated block by block.
+
+    Values are appended a block of samples at a time, in sample order, and
+    spilled to temporary files, so memory holds only one block's values
+    (plus arrays the size of the observation and sample ids).  The biom
+    file then written has only the observations and samples with values,
+    each sorted by id, and is transposed (for its compressed sparse row
+    matrix) through memory-mapped files rather than in memory.
+    """
+
+    def __init__(self, observation_ids: List[str], sample_ids: List[str]):
+        self.observation_ids = observation_ids
+        self.sample_ids = sample_ids
+        self._tmp_dir = tempfile.mkdtemp()
+        self._values_fp = os.path.join(self._tmp_dir, 'values')
+        self._obs_nums_fp = os.path.join(self._tmp_dir, 'obs_nums')
+        self._observation_ranks = _get_ranks(observation_ids)
+        self._observation_nnzs = np.zeros(len(observation_ids), dtype=np.int64)
+        self._sample_nnzs = np.zeros(len(sample_ids), dtype=np.int64)
+        self._last_sample_num = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        shutil.rmtree(self._tmp_dir, ignore_errors=True)
+
+    def append(self, values: np.ndarray, observation_nums: np.ndarray,
+               sample_nums: np.ndarray):
+        """Add values, all of samples after those of any earlier append."""
+        if len(values) == 0:
+            return
+        if sample_nums.min() <= self._last_sample_num:
+            raise ValueError("Values must be appended in sample order")
+        self._last_sample_num = sample_nums.max()
+
+        # within each sample, in the order of the observations' sorted ids
+        sort_order = np.lexsort(
+            (self._observation_ranks[observation_nums], sample_nums))
+        with open(self._values_fp, 'ab') as fh:
+            values[sort_order].astype(np.float64).tofile(fh)
+        with open(self._obs_nums_fp, 'ab') as fh:
+            observation_nums[sort_order].astype(np.int64).tofile(fh)
+        self._observation_nnzs += np.bincount(
+            observation_nums, minlength=len(self._observation_nnzs))
+        self._sample_nnzs += np.bincount(
+            sample_nums, minlength=len(self._sample_nnzs))
+
+    def write(self) -> BIOMV210DirFmt:
+        """Write the appended values as the biom file of a new format."""
+        out_obs_nums = _get_sorted_nums_with_values(
+            self.observation_ids, self._observation_nnzs)
+        out_sample_nums = _get_sorted_nums_with_values(
+            self.sample_ids, self._sample_nnzs)
+        nnz = int(self._sample_nnzs.sum())
+        index_dtype = np.int32 if nnz < np.iinfo(np.int32).max else np.int64
+
+        result = BIOMV210DirFmt()
+        biom_fp = extract_fp_from_directory_format(result, result.file)
+        with h5py.File(biom_fp, 'w') as fh:
+            # biom writes the ids, metadata and attributes of an empty table
+            # of the right shape, and the matrices are then filled in
+            biom.Table(
+                sparse.csr_matrix((len(out_obs_nums), len(out_sample_nums))),
+                [self.observation_ids[x] for x in out_obs_nums],
+                [self.sample_ids[x] for x in out_sample_nums]).to_hdf5(
+                fh, _GENERATED_BY)
+            fh.attrs['nnz'] = nnz
+            self._write_matrices(fh, out_obs_nums, out_sample_nums, nnz,
+                                 index_dtype)
+        return result
+
+    def _write_matrices(self, fh: h5py.File, out_obs_nums: np.ndarray,
+                        out_sample_nums: np.ndarray, nnz: int,
+                        index_dtype: type):
+        out_rows = np.full(len(self.observation_ids), -1, dtype=np.int64)
+        out_rows[out_obs_nums] = np.arange(len(out_obs_nums))
+        # where each (input-order) sample's values start in the spill files
+        spill_starts = np.concatenate([[0], np.cumsum(self._sample_nnzs)])
+        sample_indptr = np.concatenate(
+            [[0], np.cumsum(self._sample_nnzs[out_sample_nums])])
+        obs_indptr = np.concatenate(
+            [[0], np.cumsum(self._observation_nnzs[out_obs_nums])])
+
+        sample_datasets = _create_matrix_datasets(
+            fh[_SAMPLE_AXIS], nnz, sample_indptr, index_dtype)
+        obs_datasets = _create_matrix_datasets(
+            fh[_OBSERVATION_AXIS], nnz, obs_indptr, index_dtype)
+        if nnz == 0:
+            return
+
+        spilled_values = np.memmap(self._values_fp, dtype=np.float64,
+                                   mode='r')
+        spilled_obs_nums = np.memmap(self._obs_nums_fp, dtype=np.int64,
+                                     mode='r')
+        # The row-wise matrix is filled in as the column-wise one is
+        # written: values are visited in column order, so each row's values
+        # land in column order
+        row_values = np.memmap(os.path.join(self._tmp_dir, 'row_values'),
+                               dtype=np.float64, mode='w+', shape=(nnz,))
+        row_cols = np.memmap(os.path.join(self._tmp_dir, 'row_cols'),
+                             dtype=index_dtype, mode='w+', shape=(nnz,))
+        row_fills = obs_indptr[:-1].copy()
+
+        for first_col, last_col in _chunk_by_nnz(sample_indptr):
+            col_sample_nums = out_sample_nums[first_col:last_col]
+            col_nnzs = self._sample_nnzs[col_sample_nums]
+            spill_positions = _concat_ranges(
+                spill_starts[col_sample_nums], col_nnzs)
+            values = np.asarray(spilled_values[spill_positions])
+            rows = out_rows[np.asarray(spilled_obs_nums[spill_positions])]
+            cols = np.repeat(np.arange(first_col, last_col), col_nnzs)
+
+            first, last = sample_indptr[first_col], sample_indptr[last_col]
+            sample_datasets[_MATRIX_DATA][first:last] = values
+            sample_datasets[_MATRIX_INDICES][first:last] = rows
+
+            # positions in the row-wise matrix, by the rows' fill pointers
+            row_order = np.argsort(rows, kind='stable')
+            sorted_rows = rows[row_order]
+            uniq_rows, row_starts, row_counts = np.unique(
+                sorted_rows, return_index=True, return_counts=True)
+            positions = row_fills[sorted_rows] + np.arange(len(rows)) - \
+                np.repeat(row_starts, row_counts)
+            row_values[positions] = values[row_order]
+            row_cols[positions] = cols[row_order]
+            row_fills[uniq_rows] += row_counts
+
+        for first in range(0, nnz, _WRITE_CHUNK_NNZ):
+            last = min(first + _WRITE_CHUNK_NNZ, nnz)
+            obs_datasets[_MATRIX_DATA][first:last] = row_values[first:last]
+            obs_datasets[_MATRIX_INDICES][first:last] = row_cols[first:last]
+
+
+def _decode_ids(ids: np.ndarray) -> List[str]:
+    return [x.decode('utf8') if isinstance(x, bytes) else x for x in ids]
+
+
+def _get_ranks(ids: List[str]) -> np.ndarray:
+    ranks = np.empty(len(ids), dtype=np.int64)
+    ranks[np.argsort(np.array(ids, dtype=object), kind='stable')] = \
+        np.arange(len(ids))
+    return ranks
+
+
+def _get_sorted_nums_with_values(ids: List[str],
+                                 nnzs: np.ndarray) -> np.ndarray:
+    nums = np.flatnonzero(nnzs > 0)
+    return nums[np.argsort(np.array(ids, dtype=object)[nums], kind='stable')]
+
+
+def _create_matrix_datasets(grp: h5py.Group, nnz: int, indptr: np.ndarray,
+                            index_dtype: type) -> dict:
+    # replaces the empty matrix that biom wrote, compressed as biom does
+    for name in [_MATRIX_DATA, _MATRIX_INDICES, _MATRIX_INDPTR]:
+        del grp[name]
+    grp.create_dataset(_MATRIX_INDPTR, data=indptr.astype(index_dtype),
+                       compression='gzip')
+    return {
+        _MATRIX_DATA: grp.create_dataset(
+            _MATRIX_DATA, shape=(nnz,), dtype=np.float64,
+            compression='gzip'),
+        _MATRIX_INDICES: grp.create_dataset(
+            _MATRIX_INDICES, shape=(nnz,), dtype=index_dtype,
+            compression='gzip')}
+
+
+def _chunk_by_nnz(indptr: np.ndarray) -> Iterator[Tuple[int, int]]:
+    # (first, last) column ranges holding about _WRITE_CHUNK_NNZ values
+    # each (or one column, if that holds more)
+    first = 0
+    num_cols = len(indptr) - 1
+    while first < num_cols:
+        last = int(np.searchsorted(
+            indptr, indptr[first] + _WRITE_CHUNK_NNZ, side='right')) - 1
+        last = min(max(last, first + 1), num_cols)
+        yield first, last
+        first = last
+
+
+def _concat_ranges(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    # np.concatenate([np.arange(s, s + n) for s, n in zip(starts, lengths)])
+    offsets = np.arange(lengths.sum()) - np.repeat(
+        np.cumsum(lengths) - lengths, lengths)
+    return np.repeat(starts, lengths) + offsets
@@ -0,0 +1,636 @@
+import contextlib
+from typing import Dict, List, Optional, Tuple
+
+import biom
+import numpy as np
+import pandas
+from scipy import sparse
+from q2_types.feature_table import BIOMV210DirFmt
+
+from pysyndna import OGU_CELLS_PER_G_OF_GDNA_KEY, \
+    OGU_CELLS_PER_G_OF_SAMPLE_KEY
+from pysyndna.src.fit_syndna_models import SAMPLE_ID_KEY, \
+    SAMPLE_TOTAL_READS_KEY
+from pysyndna.src.calc_cell_counts import GDNA_CONCENTRATION_NG_UL_KEY, \
+    ELUTE_VOL_UL_KEY, SAMPLE_IN_ALIQUOT_MASS_G_KEY, \
+    SEQUENCED_SAMPLE_GDNA_MASS_NG_KEY
+from pysyndna.src.util import calc_copies_genomic_element_per_g_series, \
+    DNA_BASEPAIR_G_PER_MOLE, NANOGRAMS_PER_GRAM
+from q2_pysyndna._biom_hdf5 import SpilledBiomWriter, \
+    iter_biom_sample_blocks, read_biom_ids
+
+PYSYNDNA_CELL_COUNT_ENGINE = 'pysyndna'
+SPARSE_CELL_COUNT_ENGINE = 'sparse'
+CELL_COUNT_ENGINES = [PYSYNDNA_CELL_COUNT_ENGINE, SPARSE_CELL_COUNT_ENGINE]
+
+_SLOPE = 'slope'
+_INTERCEPT = 'intercept'
+_RVALUE = 'rvalue'
+
+
+def calc_ogu_cell_counts_sparse(
+        sample_info_df: pandas.DataFrame,
+        linregs_dict: Dict[str, Optional[Dict[str, float]]],
+        genome_counts: biom.Table,
+        genome_lengths: pandas.Series,
+        read_length: int,
+        min_percent_coverage: float,
+        min_rsquared: float,
+        output_metric: str,
+        genome_coverages: Optional[biom.Table] = None) -> \
+        Tuple[biom.Table, List[str]]:
+    """Calculate cells of each genome per gram, only on the stored counts.
+
+    Does the calculation pysyndna's calc_ogu_cell_counts_biom does, but
+    straight on the (compressed sparse column) matrix of genome_counts,
+    never densifying it: each stored count is filtered by its coverage and
+    turned into a mass with its sample's regression, and the masses are
+    scaled by the genomes' lengths and the samples' gDNA masses.  Genome
+    count tables are mostly zeros, and a zero count has no cells.
+
+    Parameters
+    ----------
+    sample_info_df : pandas.DataFrame
+        A DataFrame with at least SAMPLE_ID_KEY, SAMPLE_TOTAL_READS_KEY and
+        SEQUENCED_SAMPLE_GDNA_MASS_NG_KEY columns, as well as
+        GDNA_CONCENTRATION_NG_UL_KEY, ELUTE_VOL_UL_KEY and
+        SAMPLE_IN_ALIQUOT_MASS_G_KEY columns if output_metric is
+        OGU_CELLS_PER_G_OF_SAMPLE_KEY.
+    linregs_dict : Dict[str, Optional[Dict[str, float]]]
+        Keyed by sample id, None or a dictionary of the sample's regression
+        properties (including slope, intercept and rvalue).
+    genome_counts : biom.Table
+        Feature table of genome counts.
+    genome_lengths : pandas.Series
+        Lengths in basepairs, indexed by genome id.  Genomes without a
+        length are left out of the output.
+    read_length : int
+        Length of sequencing reads in basepairs.
+    min_percent_coverage : float
+        Minimum percent coverage of a genome by a sample's reads required
+        for that genome to be included in that sample's output.
+    min_rsquared : float
+        Minimum r-squared value of a sample's regression required for the
+        sample to be included in the output.
+    output_metric : str
+        The metric to output. One of OGU_CELLS_PER_G_OF_GDNA_KEY or
+        OGU_CELLS_PER_G_OF_SAMPLE_KEY.
+    genome_coverages : Optional[biom.Table]
+        Percent coverages, as calc_percent_coverages_sparse calculates them,
+        of (at least) the genomes and samples of genome_counts.  If given,
+        the coverages are looked up in it rather than calculated (and
+        read_length is not used).
+
+    Returns
+    -------
+    cell_counts : biom.Table
+        The cells of each genome per gram (of gDNA or of sample), with the
+        genomes and samples that have any, each sorted by id.
+    log_msgs_list : List[str]
+        Log messages generated during the calculation.  Empty if there were
+        none.
+    """
+    cell_counts_dict, log_msgs_list = calc_ogu_cell_counts_sparse_metrics(
+        sample_info_df, linregs_dict, genome_counts, genome_lengths,
+        read_length, min_percent_coverage, min_rsquared, [output_metric],
+        genome_coverages)
+    return cell_counts_dict[output_metric], log_msgs_list
+
+
+def calc_ogu_cell_counts_sparse_metrics(
+        sample_info_df: pandas.DataFrame,
+        linregs_dict: Dict[str, Optional[Dict[str, float]]],
+        genome_counts: biom.Table,
+        genome_lengths: pandas.Series,
+        read_length: int,
+        min_percent_coverage: float,
+        min_rsquared: float,
+        output_metrics: List[str],
+        genome_coverages: Optional[biom.Table] = None) -> \
+        Tuple[Dict[str, biom.Table], List[str]]:
+    """Calculate cells of each genome per gram, in several metrics at once.
+
+    As calc_ogu_cell_counts_sparse, except that the coverage filtering and
+    the genomes per sample, which all metrics share, are calculated once,
+    and only the last per-sample scaling is done for each metric.
+
+    Parameters
+    ----------
+    (all but output_metrics as for calc_ogu_cell_counts_sparse)
+    output_metrics : List[str]
+        The metrics to output; each one of OGU_CELLS_PER_G_OF_GDNA_KEY or
+        OGU_CELLS_PER_G_OF_SAMPLE_KEY.
+
+    Returns
+    -------
+    cell_counts_dict : Dict[str, biom.Table]
+        Keyed by output metric, the table of cells of each genome per gram
+        that calc_ogu_cell_counts_sparse outputs for that metric.
+    log_msgs_list : List[str]
+        Log messages generated during the calculation (which are the same
+        whatever the metrics).  Empty if there were none.
+    """
+    genome_ids = genome_counts.ids(axis='observation').tolist()
+    sample_ids = genome_counts.ids(axis='sample').tolist()
+    coverage_matrix = None
+    if genome_coverages is not None:
+        coverage_matrix = _align_coverage_matrix(
+            genome_coverages, genome_ids, sample_ids)
+    calculator = _CellCountCalculator(
+        sample_info_df, linregs_dict, genome_ids, sample_ids, genome_lengths,
+        read_length, min_percent_coverage, min_rsquared, output_metrics,
+        coverage_matrix)
+
+    cells_per_g_dict, genome_nums, sample_nums = calculator.calc(
+        sparse.csc_matrix(genome_counts.matrix_data))
+
+    cell_counts_dict = {
+        x: _make_sorted_biom(cells_per_g, genome_nums, sample_nums,
+                             genome_ids, sample_ids)
+        for x, cells_per_g in cells_per_g_dict.items()}
+    return cell_counts_dict, calculator.get_log_msgs()
+
+
+def calc_percent_coverages_sparse(
+        genome_counts: biom.Table,
+        genome_lengths: pandas.Series,
+        read_length: int) -> biom.Table:
+    """Calculate the percent of each genome each sample's reads cover.
+
+    Parameters
+    ----------
+    genome_counts : biom.Table
+        Feature table of genome counts.
+    genome_lengths : pandas.Series
+        Lengths in basepairs, indexed by genome id.  Genomes without a
+        length have no coverages.
+    read_length : int
+        Length of sequencing reads in basepairs.
+
+    Returns
+    -------
+    genome_coverages : biom.Table
+        The percent coverage of each genome by each sample's reads, with
+        the ids of genome_counts and values only where it has nonzero
+        counts, calculated on just those counts.
+    """
+    matrix = sparse.csc_matrix(genome_counts.matrix_data)
+    matrix.sum_duplicates()
+    genome_ids = genome_counts.ids(axis='observation').tolist()
+    lengths = genome_lengths.reindex(genome_ids).to_numpy(dtype=float)
+
+    percent_coverages = _calc_percent_coverages(
+        matrix.data.astype(float), lengths[matrix.indices], read_length)
+    matrix = sparse.csc_matrix(
+        (np.nan_to_num(percent_coverages, nan=0), matrix.indices,
+         matrix.indptr), shape=matrix.shape)
+    matrix.eliminate_zeros()
+
+    return biom.Table(matrix, genome_ids,
+                      genome_counts.ids(axis='sample').tolist())
+
+
+def calc_ogu_cell_counts_blocked(
+        sample_info_df: pandas.DataFrame,
+        linregs_dict: Dict[str, Optional[Dict[str, float]]],
+        genome_counts_fp: str,
+        genome_lengths: pandas.Series,
+        read_length: int,
+        min_percent_coverage: float,
+        min_rsquared: float,
+        output_metric: str,
+        sample_block_size: int) -> Tuple[BIOMV210DirFmt, List[str]]:
+    """Calculate cells per gram as the sparse engine does, in sample blocks.
+
+    The genome counts are read from their biom file a block of samples at a
+    time, and each block's cell counts are spilled to disk before the next
+    block is read, so the memory used depends on the block size rather than
+    on the size of the table.
+
+    Parameters
+    ----------
+    sample_info_df : pandas.DataFrame
+        As for calc_ogu_cell_counts_sparse.
+    linregs_dict : Dict[str, Optional[Dict[str, float]]]
+        As for calc_ogu_cell_counts_sparse.
+    genome_counts_fp : str
+        Path to the biom (v2.1, HDF5) file of genome counts.
+    genome_lengths : pandas.Series
+        As for calc_ogu_cell_counts_sparse.
+    read_length : int
+        Length of sequencing reads in basepairs.
+    min_percent_coverage : float
+        As for calc_ogu_cell_counts_sparse.
+    min_rsquared : float
+        As for calc_ogu_cell_counts_sparse.
+    output_metric : str
+        The metric to output. One of OGU_CELLS_PER_G_OF_GDNA_KEY or
+        OGU_CELLS_PER_G_OF_SAMPLE_KEY.
+    sample_block_size : int
+        The number of samples' counts to read and calculate at once.
+
+    Returns
+    -------
+    cell_counts : BIOMV210DirFmt
+        The same table of cells per gram as calc_ogu_cell_counts_sparse's,
+        already written to a biom file.
+    log_msgs_list : List[str]
+        The same log messages as calc_ogu_cell_counts_sparse's.
+    """
+    cell_counts_dict, log_msgs_list = calc_ogu_cell_counts_blocked_metrics(
+        sample_info_df, linregs_dict, genome_counts_fp, genome_lengths,
+        read_length, min_percent_coverage, min_rsquared, [output_metric],
+        sample_block_size)
+    return cell_counts_dict[output_metric], log_msgs_list
+
+
+def calc_ogu_cell_counts_blocked_metrics(
+        sample_info_df: pandas.DataFrame,
+        linregs_dict: Dict[str, Optional[Dict[str, float]]],
+        genome_counts_fp: str,
+        genome_lengths: pandas.Series,
+        read_length: int,
+        min_percent_coverage: float,
+        min_rsquared: float,
+        output_metrics: List[str],
+        sample_block_size: int) -> \
+        Tuple[Dict[str, BIOMV210DirFmt], List[str]]:
+    """Calculate cells per gram in several metrics at once, in sample blocks.
+
+    As calc_ogu_cell_counts_blocked, except that each block of genome counts
+    is read, and its shared part of the calculation done, once for all of
+    output_metrics (as in calc_ogu_cell_counts_sparse_metrics), and its
+    cell counts are spilled to one file per metric.
+
+    Parameters
+    ----------
+    (all but output_metrics as for calc_ogu_cell_counts_blocked)
+    output_metrics : List[str]
+        The metrics to output; each one of OGU_CELLS_PER_G_OF_GDNA_KEY or
+        OGU_CELLS_PER_G_OF_SAMPLE_KEY.
+
+    Returns
+    -------
+    cell_counts_dict : Dict[str, BIOMV210DirFmt]
+        Keyed by output metric, the table of cells per gram that
+        calc_ogu_cell_counts_blocked outputs for that metric.
+    log_msgs_list : List[str]
+        The same log messages as calc_ogu_cell_counts_blocked's.
+    """
+    genome_ids, sample_ids = read_biom_ids(genome_counts_fp)
+    calculator = _CellCountCalculator(
+        sample_info_df, linregs_dict, genome_ids, sample_ids, genome_lengths,
+        read_length, min_percent_coverage, min_rsquared, output_metrics)
+
+    with contextlib.ExitStack() as stack:
+        writers = {x: stack.enter_context(
+            SpilledBiomWriter(genome_ids, sample_ids))
+            for x in output_metrics}
+        for first_sample_num, block_matrix in iter_biom_sample_blocks(
+                genome_counts_fp, sample_block_size):
+            cells_per_g_dict, genome_nums, sample_nums = calculator.calc(
+                block_matrix, first_sample_num)
+            for curr_metric, cells_per_g in cells_per_g_dict.items():
+                writers[curr_metric].append(
+                    cells_per_g, genome_nums, sample_nums)
+        cell_counts_dict = {x: y.write() for x, y in writers.items()}
+
+    return cell_counts_dict, calculator.get_log_msgs()
+
+
+def calc_ogu_cell_counts_sweep(
+        sample_info_df: pandas.DataFrame,
+        linregs_dict: Dict[str, Optional[Dict[str, float]]],
+        genome_counts: biom.Table,
+        genome_lengths: pandas.Series,
+        read_length: int,
+        min_percent_coverages: List[float],
+        min_rsquareds: List[float],
+        output_metric: str) -> Tuple[Dict[str, biom.Table], List[str]]:
+    """Calculate cells per gram for each combination of filter thresholds.
+
+    The coverages and the cell counts that pass the loosest thresholds are
+    calculated once (as calc_ogu_cell_counts_sparse does), and each
+    combination of a minimum r-squared and a minimum percent coverage is
+    then applied to them as a mask, so a sweep costs little more than one
+    calculation.
+
+    Parameters
+    ----------
+    (all but min_percent_coverages and min_rsquareds as for
+    calc_ogu_cell_counts_sparse)
+    min_percent_coverages : List[float]
+        The minimum percent coverages to sweep.
+    min_rsquareds : List[float]
+        The minimum r-squared values to sweep.
+
+    Returns
+    -------
+    cell_counts_dict : Dict[str, biom.Table]
+        Keyed by make_sweep_key(min_rsquared, min_percent_coverage), for
+        each combination (in the order of min_rsquareds, then of
+        min_percent_coverages) the table that calc_ogu_cell_counts_sparse
+        outputs with those thresholds.
+    summary_msgs_list : List[str]
+        The numbers of samples and genomes retained with each combination.
+    """
+    genome_ids = genome_counts.ids(axis='observation').tolist()
+    sample_ids = genome_counts.ids(axis='sample').tolist()
+    calculator = _CellCountCalculator(
+        sample_info_df, linregs_dict, genome_ids, sample_ids, genome_lengths,
+        read_length, min(min_percent_coverages), min(min_rsquareds),
+        [output_metric])
+
+    counts, genome_nums, sample_nums, percent_coverages = \
+        calculator.filter_counts(sparse.csc_matrix(genome_counts.matrix_data))
+    cells_per_g = calculator.calc_cells_per_g(
+        counts, genome_nums, sample_nums)[output_metric]
+    rsquareds = np.array(
+        [np.nan if linregs_dict.get(x) is None
+         else linregs_dict[x][_RVALUE] ** 2 for x in sample_ids])[sample_nums]
+
+    cell_counts_dict = {}
+    summary_msgs_list = [
+        f"Of {len(sample_ids)} samples and {len(genome_ids)} genomes with "
+        f"genome counts, the following are retained by each combination "
+        f"of thresholds:"]
+    for curr_min_rsquared in min_rsquareds:
+        for curr_min_percent_coverage in min_percent_coverages:
+            curr_key = make_sweep_key(
+                curr_min_rsquared, curr_min_percent_coverage)
+            if curr_key in cell_counts_dict:
+                continue
+            is_kept = (rsquareds >= curr_min_rsquared) & \
+                (percent_coverages >= curr_min_percent_coverage)
+            curr_biom = _make_sorted_biom(
+                cells_per_g[is_kept], genome_nums[is_kept],
+                sample_nums[is_kept], genome_ids, sample_ids)
+            cell_counts_dict[curr_key] = curr_biom
+            summary_msgs_list.append(
+                f"{curr_key}: {curr_biom.shape[1]} samples and "
+                f"{curr_biom.shape[0]} genomes")
+
+    return cell_counts_dict, summary_msgs_list
+
+
+def make_sweep_key(min_rsquared: float, min_percent_coverage: float) -> str:
+    """Name the sweep output of a combination of filter thresholds."""
+    return f"min_rsquared_{float(min_rsquared)}_" \
+           f"min_percent_coverage_{float(min_percent_coverage)}"
+
+
+class _CellCountCalculator:
+    # Turns genome counts into cells per gram, one block of samples at a
+    # time, collecting log messages across the blocks
+
+    def __init__(self, sample_info_df: pandas.DataFrame,
+                 linregs_dict: Dict[str, Optional[Dict[str, float]]],
+                 genome_ids: List[str], sample_ids: List[str],
+                 genome_lengths: pandas.Series, read_length: int,
+                 min_percent_coverage: float, min_rsquared: float,
+                 output_metrics: List[str],
+                 coverage_matrix: Optional[sparse.csc_matrix] = None):
+        for curr_metric in output_metrics:
+            if curr_metric not in [OGU_CELLS_PER_G_OF_GDNA_KEY,
+                                   OGU_CELLS_PER_G_OF_SAMPLE_KEY]:
+                raise ValueError(
+                    f"Unrecognized output metric '{curr_metric}'")
+
+        self.genome_ids = genome_ids
+        self.sample_ids = sample_ids
+        self.read_length = read_length
+        self.min_percent_coverage = min_percent_coverage
+        self.output_metrics = output_metrics
+        # percent coverages to look up instead of calculating, keyed by
+        # their (sample num, genome num) positions in sorted order
+        self._coverage_keys = self._coverage_values = None
+        if coverage_matrix is not None:
+            self._coverage_keys = self._get_position_keys(
+                coverage_matrix.indices,
+                np.repeat(np.arange(coverage_matrix.shape[1]),
+                          np.diff(coverage_matrix.indptr)))
+            self._coverage_values = coverage_matrix.data
+        self.lengths = genome_lengths.reindex(genome_ids).to_numpy(
+            dtype=float)
+        # copies of each genome per g of its gDNA, as pysyndna converts them
+        self.genome_copies_per_g = calc_copies_genomic_element_per_g_series(
+            pandas.Series(self.lengths), DNA_BASEPAIR_G_PER_MOLE).to_numpy(
+                dtype=float)
+        self.sample_scales = _get_sample_scales(
+            sample_info_df, sample_ids, output_metrics)
+        self._regression_log_msgs = []
+        self.slopes, self.intercepts, self.is_usable_sample = \
+            _get_sample_regressions(linregs_dict, sample_ids, min_rsquared,
+                                    self._regression_log_msgs)
+        self._low_coverage_items = []
+
+    def calc(self, matrix: sparse.csc_matrix, first_sample_num: int = 0) \
+            -> Tuple[Dict[str, np.ndarray], np.ndarray, np.ndarray]:
+        # matrix holds the counts of all genomes in the samples from
+        # first_sample_num on; returns the cells per gram of each covered
+        # genome in each usable sample (keyed by output metric), and their
+        # genome and sample numbers
+        counts, genome_nums, sample_nums, _ = self.filter_counts(
+            matrix, first_sample_num)
+        return self.calc_cells_per_g(counts, genome_nums, sample_nums), \
+            genome_nums, sample_nums
+
+    def filter_counts(self, matrix: sparse.csc_matrix,
+                      first_sample_num: int = 0) -> \
+            Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        # returns the counts of each covered genome in each usable sample,
+        # their genome and sample numbers, and their percent coverages
+        matrix.sum_duplicates()
+        counts = matrix.data.astype(float)
+        genome_nums = matrix.indices.astype(np.int64)
+        # column-wise, so each sample's stored counts are one contiguous run
+        sample_nums = first_sample_num + np.repeat(
+            np.arange(matrix.shape[1]), np.diff(matrix.indptr))
+
+        if self._coverage_keys is None:
+            percent_coverages = _calc_percent_coverages(
+                counts, self.lengths[genome_nums], self.read_length)
+        else:
+            percent_coverages = self._look_up_percent_coverages(
+                genome_nums, sample_nums)
+        is_covered = percent_coverages >= self.min_percent_coverage
+        is_low_coverage = (counts > 0) & ~is_covered
+        # items are named and ordered as pysyndna names and orders them
+        self._low_coverage_items.extend(
+            f"{self.sample_ids[x]};{self.genome_ids[y]}" for x, y in zip(
+                sample_nums[is_low_coverage], genome_nums[is_low_coverage]))
+
+        is_kept = is_covered & self.is_usable_sample[sample_nums]
+        return counts[is_kept], genome_nums[is_kept], sample_nums[is_kept], \
+            percent_coverages[is_kept]
+
+    def _get_position_keys(self, genome_nums: np.ndarray,
+                           sample_nums: np.ndarray) -> np.ndarray:
+        return sample_nums.astype(np.int64) * len(self.genome_ids) + \
+            genome_nums
+
+    def _look_up_percent_coverages(self, genome_nums: np.ndarray,
+                                   sample_nums: np.ndarray) -> np.ndarray:
+        # positions without a stored coverage have none
+        percent_coverages = np.zeros(len(genome_nums))
+        if len(self._coverage_keys) > 0:
+            keys = self._get_position_keys(genome_nums, sample_nums)
+            found_nums = np.minimum(
+                np.searchsorted(self._coverage_keys, keys),
+                len(self._coverage_keys) - 1)
+            is_found = self._coverage_keys[found_nums] == keys
+            percent_coverages[is_found] = \
+                self._coverage_values[found_nums[is_found]]
+        # as when calculated, genomes without a length never pass
+        percent_coverages[np.isnan(self.lengths[genome_nums])] = np.nan
+        return percent_coverages
+
+    def calc_cells_per_g(self, counts: np.ndarray, genome_nums: np.ndarray,
+                         sample_nums: np.ndarray) -> Dict[str, np.ndarray]:
+        # log10 mass (ng) = slope * log10(counts per million reads) +
+        # intercept
+        total_reads = self.sample_scales[SAMPLE_TOTAL_READS_KEY][sample_nums]
+        log_masses_ng = self.slopes[sample_nums] * np.log10(
+            counts / total_reads * 1e6) + self.intercepts[sample_nums]
+        # genomes = mass (g) * copies per g of a genome of that length ...
+        genomes = 10 ** log_masses_ng / NANOGRAMS_PER_GRAM * \
+            self.genome_copies_per_g[genome_nums]
+        # ... and, at one genome per cell, cells per g (of gDNA or sample)
+        return {x: genomes * self.sample_scales[x][sample_nums]
+                for x in self.output_metrics}
+
+    def get_log_msgs(self) -> List[str]:
+        log_msgs_list = []
+        if len(self._low_coverage_items) > 0:
+            log_msgs_list.append(
+                f"The following items have % coverage lower than the minimum "
+                f"of {float(self.min_percent_coverage)}: "
+                f"{self._low_coverage_items}")
+        return log_msgs_list + self._regression_log_msgs
+
+
+def _calc_percent_coverages(counts: np.ndarray, lengths: np.ndarray,
+                            read_length: int) -> np.ndarray:
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Per pysyndna, coverage is the percent of the genome's length that
+        # the sample's reads would cover; genomes without a length have nan
+        # coverage, so never pass
+        return counts * read_length / lengths * 100
+
+
+def _align_coverage_matrix(genome_coverages: biom.Table,
+                           genome_ids: List[str],
+                           sample_ids: List[str]) -> sparse.csc_matrix:
+    # Returns the coverages of genome_ids (rows) in sample_ids (columns),
+    # with sorted indices
+    matrix = sparse.csc_matrix(genome_coverages.matrix_data)
+    positions = []
+    for axis, ids in [('observation', genome_ids), ('sample', sample_ids)]:
+        coverage_ids = genome_coverages.ids(axis=axis)
+        if len(coverage_ids) == len(ids) and (coverage_ids == ids).all():
+            # as when the coverages were calculated from the same counts
+            positions.append(None)
+            continue
+        curr_positions = pandas.Index(coverage_ids).get_indexer(ids)
+        missing_ids = [x for x, y in zip(ids, curr_positions) if y < 0]
+        if len(missing_ids) > 0:
+            raise ValueError(
+                f"The following {axis} ids have genome counts but are not "
+                f"in the genome coverages: {missing_ids}")
+        positions.append(curr_positions)
+
+    if positions[1] is not None:
+        matrix = matrix[:, positions[1]]
+    if positions[0] is not None:
+        matrix = matrix[positions[0]].tocsc()
+    matrix.sum_duplicates()
+    matrix.sort_indices()
+    return matrix
+
+
+def _get_sample_regressions(
+        linregs_dict: Dict[str, Optional[Dict[str, float]]],
+        sample_ids: List[str], min_rsquared: float,
+        log_msgs_list: List[str]) -> \
+        Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    slopes = np.full(len(sample_ids), np.nan)
+    intercepts = np.full(len(sample_ids), np.nan)
+    is_usable = np.zeros(len(sample_ids), dtype=bool)
+    # samples without a usable regression are logged one by one, in sample
+    # order, with pysyndna's messages
+    for i, sample_id in enumerate(sample_ids):
+        curr_linreg = linregs_dict.get(sample_id)
+        if curr_linreg is None:
+            log_msgs_list.append(
+                f"No linear regression fitted for sample {sample_id}")
+            continue
+
+        r_squared = float(curr_linreg[_RVALUE]) ** 2
+        if r_squared < min_rsquared:
+            log_msgs_list.append(
+                f"R^2 of linear regression for sample {sample_id} is "
+                f"{r_squared}, which is below the minimum allowed value of "
+                f"{min_rsquared}.")
+        else:
+            slopes[i] = curr_linreg[_SLOPE]
+            intercepts[i] = curr_linreg[_INTERCEPT]
+            is_usable[i] = True
+    return slopes, intercepts, is_usable
+
+
+def _get_sample_scales(sample_info_df: pandas.DataFrame,
+                       sample_ids: List[str],
+                       output_metrics: List[str]) -> Dict[str, np.ndarray]:
+    # Returns, for each sample (in sample_ids order), its total reads and
+    # the factors that turn its genome counts into the output metrics
+    sample_info_df = sample_info_df.set_index(SAMPLE_ID_KEY)
+    missing_ids = [x for x in sample_ids if x not in sample_info_df.index]
+    if len(missing_ids) > 0:
+        raise ValueError(
+            f"The following sample ids have genome counts but are not in "
+            f"the metadata: {missing_ids}")
+    sample_info_df = sample_info_df.loc[sample_ids]
+
+    def _get_values(key):
+        return sample_info_df[key].to_numpy(dtype=float)
+
+    sequenced_gdna_masses_g = \
+        _get_values(SEQUENCED_SAMPLE_GDNA_MASS_NG_KEY) / NANOGRAMS_PER_GRAM
+    scales = {SAMPLE_TOTAL_READS_KEY: _get_values(SAMPLE_TOTAL_READS_KEY),
+              OGU_CELLS_PER_G_OF_GDNA_KEY: 1 / sequenced_gdna_masses_g}
+    if OGU_CELLS_PER_G_OF_SAMPLE_KEY in output_metrics:
+        # the mass of gDNA extracted from each gram of sample
+        gdna_masses_g = _get_values(GDNA_CONCENTRATION_NG_UL_KEY) * \
+            _get_values(ELUTE_VOL_UL_KEY) / NANOGRAMS_PER_GRAM
+        gdna_to_sample_mass_ratios = \
+            gdna_masses_g / _get_values(SAMPLE_IN_ALIQUOT_MASS_G_KEY)
+        scales[OGU_CELLS_PER_G_OF_SAMPLE_KEY] = \
+            scales[OGU_CELLS_PER_G_OF_GDNA_KEY] * gdna_to_sample_mass_ratios
+    return scales
+
+
+def _make_sorted_biom(values: np.ndarray, genome_nums: np.ndarray,
+                      sample_nums: np.ndarray, genome_ids: List[str],
+                      sample_ids: List[str]) -> biom.Table:
+    # Like pysyndna's output, holds only the genomes and samples with any
+    # values, each sorted by id
+    kept_genome_nums = np.unique(genome_nums)
+    kept_genome_nums = kept_genome_nums[
+        np.argsort(np.array(genome_ids, dtype=object)[kept_genome_nums],
+                   kind='stable')]
+    kept_sample_nums = np.unique(sample_nums)
+    kept_sample_nums = kept_sample_nums[
+        np.argsort(np.array(sample_ids, dtype=object)[kept_sample_nums],
+                   kind='stable')]
+
+    genome_rows = np.full(len(genome_ids), -1)
+    genome_rows[kept_genome_nums] = np.arange(len(kept_genome_nums))
+    sample_cols = np.full(len(sample_ids), -1)
+    sample_cols[kept_sample_nums] = np.arange(len(kept_sample_nums))
+    matrix = sparse.csr_matrix(
+        (values, (genome_rows[genome_nums], sample_cols[sample_nums])),
+        shape=(len(kept_genome_nums), len(kept_sample_nums)))
+
+    return biom.Table(
+        matrix, [genome_ids[x] for x in kept_genome_nums],
+        [sample_ids[x] for x in kept_sample_nums])
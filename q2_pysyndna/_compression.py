@@ -0,0 +1,82 @@
+import gzip
+import lzma
+from typing import IO, Optional
+
+from qiime2.plugin import ValidationError
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Compression is recognized by the leading "magic" bytes of the file rather
+# than by its extension, because QIIME 2 copies imported files to fixed
+# names (e.g. lengths.tsv) that say nothing about how they are compressed.
+GZIP_COMPRESSION = 'gzip'
+XZ_COMPRESSION = 'xz'
+ZSTD_COMPRESSION = 'zstd'
+_MAGIC_BYTES = {
+    GZIP_COMPRESSION: b'\x1f\x8b',
+    XZ_COMPRESSION: b'\xfd7zXZ\x00',
+    ZSTD_COMPRESSION: b'\x28\xb5\x2f\xfd'}
+_MAX_MAGIC_LEN = max(len(x) for x in _MAGIC_BYTES.values())
+
+
+def get_compression(fp: str) -> Optional[str]:
+    """Identify how a file is compressed from its first few bytes.
+
+    Parameters
+    ----------
+    fp : str
+        Path to a file.
+
+    Returns
+    -------
+    compression : str or None
+        One of GZIP_COMPRESSION, XZ_COMPRESSION or ZSTD_COMPRESSION, or None
+        if the file is not compressed in any of those formats.
+    """
+    with open(fp, 'rb') as fh:
+        leading_bytes = fh.read(_MAX_MAGIC_LEN)
+
+    for compression, magic in _MAGIC_BYTES.items():
+        if leading_bytes.startswith(magic):
+            return compression
+    return None
+
+
+def open_maybe_compressed(fp: str, mode: str = 'rb') -> IO:
+    """Open a file for reading, decompressing it on the fly if needed.
+
+    The data is decompressed as it is read, so no decompressed copy of the
+    file is ever written.
+
+    Parameters
+    ----------
+    fp : str
+        Path to a plain, gzip, xz or zstd file.
+    mode : str
+        'rb' (the default) to read bytes or 'r' to read text.
+
+    Returns
+    -------
+    fh : IO
+        A file object yielding the decompressed contents.
+    """
+    compression = get_compression(fp)
+    if compression == GZIP_COMPRESSION:
+        return gzip.open(fp, _to_explicit_mode(mode))
+    if compression == XZ_COMPRESSION:
+        return lzma.open(fp, _to_explicit_mode(mode))
+    if compression == ZSTD_COMPRESSION:
+        if zstandard is None:
+            raise ValidationError(
+                f"File {fp} is zstd-compressed, but reading it requires the "
+                f"zstandard package, which is not installed.")
+        return zstandard.open(fp, _to_explicit_mode(mode))
+    return open(fp, mode)
+
+
+def _to_explicit_mode(mode: str) -> str:
+    # The compression libraries open in binary mode unless told 't'
+    return mode if 'b' in mode or 't' in mode else mode + 't'
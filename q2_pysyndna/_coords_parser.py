@@ -0,0 +1,505 @@
+import collections
+import itertools
+import os
+import random
+import re
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+import numpy as np
+from qiime2.plugin import ValidationError
+
+from q2_pysyndna._compression import get_compression, open_maybe_compressed
+
+# Size of each read from the coords file; big enough that the per-read
+# overhead disappears, small enough to keep the working set modest.
+_READ_BLOCK_BYTES = 32 * 1024 * 1024
+# Rough number of bytes per ORF line in a WoL coords file, used to guess how
+# many rows to preallocate before any data has been read.
+_EST_BYTES_PER_ORF_LINE = 20
+_MIN_INITIAL_ROWS = 1024
+_HEADER_LINE_REGEX = re.compile(rb'^>', re.MULTILINE)
+_NEWLINE = ord('\n')
+_TAB = ord('\t')
+_FIELDS_PER_ORF_LINE = 3
+# Bounds on the sampled ("min" level) validation: the leading genome blocks
+# (up to a byte cap) are checked in full, plus a fixed number of windows
+# read from random offsets elsewhere in the file.
+_SAMPLE_MAX_BLOCKS = 100
+_SAMPLE_MAX_BYTES = 4 * 1024 * 1024
+_NUM_PROBES = 16
+_PROBE_BYTES = 64 * 1024
+# Files smaller than this are parsed in-process by default; above it, the
+# file is split into byte ranges (each beginning at a genome header) that
+# are parsed in a pool of processes.
+_PARALLEL_MIN_BYTES = 256 * 1024 * 1024
+# More ranges than workers evens out the load when genome blocks vary a lot
+# in size.
+_RANGES_PER_JOB = 4
+_HEADER_SEARCH_BYTES = 1024 * 1024
+
+# The parsed contents of a coords file, as parallel arrays. Each genome block
+# (a `>genome` header and the ORF lines following it) contributes one entry
+# to genome_ids and block_sizes; each ORF line contributes one entry to
+# orf_ids, starts and ends, in file order. orf_lens, if not None, holds each
+# ORF's length; the parser leaves it None, but it is stored in (and read
+# back from) coords artifacts.
+CoordsArrays = collections.namedtuple(
+    "CoordsArrays",
+    ["genome_ids", "block_sizes", "orf_ids", "starts", "ends", "orf_lens"],
+    defaults=[None])
+
+
+class _MalformedLineError(Exception):
+    """A malformed line, numbered relative to the start of a byte range."""
+
+    def __init__(self, line_num: int, problem: str, range_start: int = 0):
+        super().__init__(line_num, problem, range_start)
+        self.line_num = line_num
+        self.problem = problem
+        self.range_start = range_start
+
+
+class _GrowableArray:
+    """Append-only 1-D numpy array that doubles its capacity as it fills."""
+
+    def __init__(self, initial_capacity: int, dtype=np.int64):
+        self._data = np.empty(max(initial_capacity, 1), dtype=dtype)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def extend(self, values: np.ndarray):
+        needed = self._size + len(values)
+        if needed > len(self._data):
+            new_data = np.empty(max(needed, 2 * len(self._data)),
+                                dtype=self._data.dtype)
+            new_data[:self._size] = self._data[:self._size]
+            self._data = new_data
+        self._data[self._size:needed] = values
+        self._size = needed
+
+    def to_array(self) -> np.ndarray:
+        # Shrink in place rather than copying; nothing else holds a
+        # reference to the buffer.
+        self._data.resize(self._size, refcheck=False)
+        return self._data
+
+
+class _CoordsAccumulator:
+    """Collects genome blocks and ORF rows as a coords file is parsed."""
+
+    def __init__(self, est_rows: int):
+        self.genome_ids: List[str] = []
+        self.block_sizes: List[int] = []
+        self.orf_ids = _GrowableArray(est_rows)
+        self.starts = _GrowableArray(est_rows)
+        self.ends = _GrowableArray(est_rows)
+
+    def start_block(self, genome_id: str):
+        self.genome_ids.append(genome_id)
+        self.block_sizes.append(0)
+
+    def add_rows(self, values: np.ndarray):
+        # values is a flat array of (orf, start, end) triples, all of which
+        # belong to the current block
+        self.orf_ids.extend(values[0::_FIELDS_PER_ORF_LINE])
+        self.starts.extend(values[1::_FIELDS_PER_ORF_LINE])
+        self.ends.extend(values[2::_FIELDS_PER_ORF_LINE])
+        self.block_sizes[-1] += len(values) // _FIELDS_PER_ORF_LINE
+
+    def add_blocks(self, genome_ids: List[str], rows_per_block: List[int],
+                   values: np.ndarray):
+        # rows_per_block has one more entry than genome_ids: its first entry
+        # is the number of rows that continue the current block.
+        self.orf_ids.extend(values[0::_FIELDS_PER_ORF_LINE])
+        self.starts.extend(values[1::_FIELDS_PER_ORF_LINE])
+        self.ends.extend(values[2::_FIELDS_PER_ORF_LINE])
+        if rows_per_block[0]:
+            self.block_sizes[-1] += rows_per_block[0]
+        self.genome_ids.extend(genome_ids)
+        self.block_sizes.extend(rows_per_block[1:])
+
+    def to_coords_arrays(self) -> CoordsArrays:
+        return CoordsArrays(
+            genome_ids=self.genome_ids,
+            block_sizes=np.array(self.block_sizes, dtype=np.int64),
+            orf_ids=self.orf_ids.to_array(),
+            starts=self.starts.to_array(),
+            ends=self.ends.to_array())
+
+
+def parse_coords_fp(fp: str, n_jobs: Optional[int] = None) -> CoordsArrays:
+    """Parse a WoL-format coords file into numpy arrays.
+
+    Each byte range of the file is parsed in a single buffered pass; large
+    files are split into several ranges, each beginning at a genome header,
+    that are parsed in parallel processes and then concatenated.  Compressed
+    (gzip, xz or zstd) files are decompressed as they are read, in a single
+    process since they cannot be split.
+
+    Parameters
+    ----------
+    fp : str
+        Path to a coords file made of `>genome` header lines, each followed
+        by tab-separated `orf start end` lines of integers.
+    n_jobs : int, optional
+        Number of processes to parse with.  If None, files smaller than a few
+        hundred MB are parsed in-process and larger ones use all available
+        cores.  Ignored for compressed files.
+
+    Returns
+    -------
+    coords_arrays : CoordsArrays
+        The file's genome blocks and ORF rows as parallel arrays.
+
+    Raises
+    ------
+    ValidationError
+        If the file is malformed; the message includes the number of the
+        first offending line.
+    OSError
+        If the file is missing or cannot be read.
+    """
+    file_size = os.path.getsize(fp)
+    is_compressed = get_compression(fp) is not None
+    if is_compressed:
+        n_jobs = 1
+    elif n_jobs is None:
+        n_jobs = _get_default_num_jobs(file_size)
+
+    range_starts = [0]
+    if n_jobs > 1:
+        range_starts = _find_block_aligned_offsets(
+            fp, file_size, n_jobs * _RANGES_PER_JOB)
+    range_stops = range_starts[1:] + [file_size]
+
+    try:
+        if is_compressed:
+            with open_maybe_compressed(fp) as fh:
+                range_results = [_parse_coords_fh(fh, file_size)]
+        elif len(range_starts) == 1:
+            range_results = [_parse_coords_byte_range(fp, 0, file_size)]
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                # map yields in range order, so the first error raised is
+                # the earliest in the file
+                range_results = list(executor.map(
+                    _parse_coords_byte_range, itertools.repeat(fp),
+                    range_starts, range_stops))
+    except _MalformedLineError as e:
+        line_num = e.line_num + _count_lines_before(fp, e.range_start)
+        _raise_validation_error(fp, line_num, e.problem)
+
+    result = _concatenate_coords_arrays(range_results)
+    if len(result.orf_ids) == 0:
+        raise ValidationError(
+            f"File {fp} is malformed or missing: no ORF lines found")
+
+    return result
+
+
+def validate_coords_fp_sample(fp: str):
+    """Check the structure of a sample of a WoL-format coords file.
+
+    The leading genome blocks of the file are parsed in full, and a fixed
+    number of windows at pseudo-random (but reproducible) offsets through
+    the rest of the file are checked line by line, so the cost is bounded
+    regardless of the size of the file.  Compressed files can't be read at
+    arbitrary offsets without decompressing everything before them, so for
+    those only the leading blocks are checked.
+
+    Parameters
+    ----------
+    fp : str
+        Path to a coords file.
+
+    Raises
+    ------
+    ValidationError
+        If a problem is found in the sampled portions of the file.
+    OSError
+        If the file is missing or cannot be read.
+    """
+    file_size = os.path.getsize(fp)
+    is_compressed = get_compression(fp) is not None
+    with open_maybe_compressed(fp) as fh:
+        head = fh.read(_SAMPLE_MAX_BYTES)
+        head_is_whole_file = len(head) < _SAMPLE_MAX_BYTES or \
+            not fh.read(1)
+        if head_is_whole_file:
+            if head and not head.endswith(b'\n'):
+                head += b'\n'
+        else:
+            head_headers = _HEADER_LINE_REGEX.finditer(head)
+            header_starts = [m.start() for _, m in
+                             zip(range(_SAMPLE_MAX_BLOCKS + 1), head_headers)]
+            if len(header_starts) > _SAMPLE_MAX_BLOCKS:
+                head = head[:header_starts[-1]]
+            else:
+                head = head[:head.rfind(b'\n') + 1]
+
+        parsed = _CoordsAccumulator(_MIN_INITIAL_ROWS)
+        try:
+            _parse_coords_chunk(head, 1, parsed)
+        except _MalformedLineError as e:
+            _raise_validation_error(fp, e.line_num, e.problem)
+        if head_is_whole_file:
+            if len(parsed.orf_ids) == 0:
+                raise ValidationError(
+                    f"File {fp} is malformed or missing: no ORF lines found")
+            return
+        if is_compressed:
+            return
+
+        # Seed from the file size so repeated validations of the same file
+        # probe the same places.
+        rng = random.Random(file_size)
+        probe_offsets = sorted(
+            rng.randrange(len(head), file_size) for _ in range(_NUM_PROBES))
+        for offset in probe_offsets:
+            fh.seek(offset)
+            window = fh.read(_PROBE_BYTES)
+            # drop the partial lines at either end of the window
+            first_newline = window.find(b'\n')
+            last_newline = window.rfind(b'\n')
+            if first_newline == last_newline:
+                continue
+            window = window[first_newline + 1:last_newline + 1]
+
+            # Lines at the top of a window may continue a genome block whose
+            # header lies before the window, so start inside a dummy block.
+            probe_parsed = _CoordsAccumulator(_MIN_INITIAL_ROWS)
+            probe_parsed.start_block('')
+            try:
+                _parse_coords_chunk(window, 1, probe_parsed)
+            except _MalformedLineError as e:
+                # Line numbers within a window are meaningless, so count the
+                # lines before it to report exactly where the problem is.
+                line_num = e.line_num + _count_lines_before(
+                    fp, offset + first_newline + 1)
+                _raise_validation_error(fp, line_num, e.problem)
+
+
+def _get_default_num_jobs(file_size: int) -> int:
+    if file_size < _PARALLEL_MIN_BYTES:
+        return 1
+    try:
+        # respects any CPU affinity set by a cluster scheduler
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _find_block_aligned_offsets(fp: str, file_size: int,
+                                num_ranges: int) -> List[int]:
+    # Returns the start offsets of (up to) num_ranges roughly equal byte
+    # ranges, each moved forward to the start of the next genome header line
+    offsets = [0]
+    with open(fp, 'rb') as fh:
+        for i in range(1, num_ranges):
+            target = max(file_size * i // num_ranges, offsets[-1] + 1)
+            # start one byte early so a header right at target is found
+            search_pos = target - 1
+            header_start = None
+            while search_pos < file_size - 1 and header_start is None:
+                fh.seek(search_pos)
+                window = fh.read(_HEADER_SEARCH_BYTES)
+                idx = window.find(b'\n>')
+                if idx >= 0:
+                    header_start = search_pos + idx + 1
+                else:
+                    # overlap by one byte in case the window split '\n>'
+                    search_pos += max(len(window) - 1, 1)
+
+            if header_start is None:
+                break
+            offsets.append(header_start)
+    return offsets
+
+
+def _parse_coords_byte_range(fp: str, start: int, stop: int) -> CoordsArrays:
+    # Parses the lines in [start, stop); start must be 0 or the start of a
+    # genome header line, and stop the end of the file or the start of a
+    # genome header line.
+    with open(fp, 'rb') as fh:
+        fh.seek(start)
+        try:
+            return _parse_coords_fh(fh, stop - start, stop - start)
+        except _MalformedLineError as e:
+            raise _MalformedLineError(e.line_num, e.problem, start)
+
+
+def _parse_coords_fh(fh, est_num_bytes: int,
+                     max_bytes: Optional[int] = None) -> CoordsArrays:
+    # Parses from the current position of fh to the end of the file, or to
+    # max_bytes beyond it if given (in which case it must end at the start of
+    # a genome header line).
+    parsed = _CoordsAccumulator(
+        max(est_num_bytes // _EST_BYTES_PER_ORF_LINE, _MIN_INITIAL_ROWS))
+    line_num = 1
+    leftover = b''
+    remaining = max_bytes
+    while True:
+        read_size = _READ_BLOCK_BYTES if remaining is None else \
+            min(_READ_BLOCK_BYTES, remaining)
+        block = fh.read(read_size)
+        if remaining is not None:
+            remaining -= len(block)
+        at_end = len(block) == 0
+        data = leftover + block
+        if at_end:
+            if data and not data.endswith(b'\n'):
+                data += b'\n'
+            chunk, leftover = data, b''
+        else:
+            # only hand complete lines to the chunk parser
+            last_newline = data.rfind(b'\n')
+            chunk, leftover = \
+                data[:last_newline + 1], data[last_newline + 1:]
+
+        if chunk:
+            _parse_coords_chunk(chunk, line_num, parsed)
+            line_num += chunk.count(b'\n')
+
+        if at_end:
+            break
+
+    return parsed.to_coords_arrays()
+
+
+def _concatenate_coords_arrays(
+        coords_arrays_list: List[CoordsArrays]) -> CoordsArrays:
+    if len(coords_arrays_list) == 1:
+        return coords_arrays_list[0]
+
+    return CoordsArrays(
+        genome_ids=[genome_id for x in coords_arrays_list
+                    for genome_id in x.genome_ids],
+        block_sizes=np.concatenate(
+            [x.block_sizes for x in coords_arrays_list]),
+        orf_ids=np.concatenate([x.orf_ids for x in coords_arrays_list]),
+        starts=np.concatenate([x.starts for x in coords_arrays_list]),
+        ends=np.concatenate([x.ends for x in coords_arrays_list]))
+
+
+def _count_lines_before(fp: str, offset: int) -> int:
+    num_lines = 0
+    with open(fp, 'rb') as fh:
+        remaining = offset
+        while remaining > 0:
+            block = fh.read(min(_READ_BLOCK_BYTES, remaining))
+            if not block:
+                break
+            num_lines += block.count(b'\n')
+            remaining -= len(block)
+    return num_lines
+
+
+def _parse_coords_chunk(chunk: bytes, first_line_num: int,
+                        parsed: _CoordsAccumulator):
+    # chunk holds complete lines only, each ending in a newline; it may
+    # begin partway through a genome block started in an earlier chunk, so
+    # its first body holds any ORF lines that come before its first header.
+    header_starts = [m.start() for m in _HEADER_LINE_REGEX.finditer(chunk)]
+    genome_ids = []
+    bodies = [chunk[:header_starts[0] if header_starts else len(chunk)]]
+    for i, header_start in enumerate(header_starts):
+        header_end = chunk.index(b'\n', header_start)
+        body_end = header_starts[i + 1] \
+            if i + 1 < len(header_starts) else len(chunk)
+        genome_ids.append(chunk[header_start + 1:header_end].strip())
+        bodies.append(chunk[header_end + 1:body_end])
+
+    values = None
+    if all(genome_ids) and (parsed.genome_ids or not bodies[0].strip()):
+        values = _convert_orf_lines(b''.join(bodies))
+    if values is None:
+        _parse_coords_chunk_slowly(
+            genome_ids, bodies, first_line_num, parsed)
+        return
+
+    parsed.add_blocks([x.decode('utf-8') for x in genome_ids],
+                      [body.count(b'\n') for body in bodies], values)
+
+
+def _convert_orf_lines(orf_lines: bytes) -> Optional[np.ndarray]:
+    # Vectorized check that every line has exactly three tab-separated
+    # fields, then a single numpy conversion of all the values. Returns None
+    # if anything is amiss (including blank lines, which are legal) so the
+    # caller can fall back to going line by line.
+    buf = np.frombuffer(orf_lines, dtype=np.uint8)
+    line_ends = np.flatnonzero(buf == _NEWLINE)
+    tab_positions = np.flatnonzero(buf == _TAB)
+    tabs_per_line = np.diff(
+        np.searchsorted(tab_positions, line_ends), prepend=0)
+    if not (tabs_per_line == _FIELDS_PER_ORF_LINE - 1).all():
+        return None
+
+    try:
+        with warnings.catch_warnings():
+            # older numpy versions warn, rather than raise, when they hit
+            # a non-integer value and just stop converting there
+            warnings.simplefilter("ignore", DeprecationWarning)
+            values = np.fromstring(orf_lines, dtype=np.int64, sep=' ')
+    except ValueError:
+        return None
+    if len(values) != _FIELDS_PER_ORF_LINE * len(line_ends):
+        return None
+
+    return values
+
+
+def _parse_coords_chunk_slowly(genome_ids: List[bytes], bodies: List[bytes],
+                               first_line_num: int,
+                               parsed: _CoordsAccumulator):
+    # Line-by-line fallback: tolerates blank lines and pinpoints the first
+    # malformed line when the fast path cannot be used.
+    line_num = first_line_num
+    for i, body in enumerate(bodies):
+        if i > 0:
+            genome_id = genome_ids[i - 1]
+            if not genome_id:
+                _raise_malformed(line_num, "empty genome header")
+            parsed.start_block(genome_id.decode('utf-8'))
+            line_num += 1
+
+        values = []
+        for line_offset, line in enumerate(body.split(b'\n')[:-1]):
+            if not line.strip():
+                continue
+
+            curr_line_num = line_num + line_offset
+            if not parsed.genome_ids:
+                _raise_malformed(
+                    curr_line_num,
+                    "ORF line found before any '>' genome header")
+
+            fields = line.rstrip(b'\r').split(b'\t')
+            if len(fields) != _FIELDS_PER_ORF_LINE:
+                _raise_malformed(
+                    curr_line_num,
+                    f"expected {_FIELDS_PER_ORF_LINE} tab-separated fields "
+                    f"but found {len(fields)}")
+            try:
+                values.extend(int(x) for x in fields)
+            except ValueError:
+                _raise_malformed(
+                    curr_line_num,
+                    f"ORF, start and end must be integers, found "
+                    f"{line.decode('utf-8', 'replace')!r}")
+
+        if values:
+            parsed.add_rows(np.array(values, dtype=np.int64))
+        line_num += body.count(b'\n')
+
+
+def _raise_malformed(line_num: int, problem: str):
+    raise _MalformedLineError(line_num, problem)
+
+
+def _raise_validation_error(fp: str, line_num: int, problem: str):
+    raise ValidationError(
+        f"File {fp} is malformed or missing: line {line_num}: {problem}")
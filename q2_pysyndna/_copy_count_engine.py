@@ -0,0 +1,298 @@
+import hashlib
+import os
+import sys
+from typing import Callable, Dict, List, Optional, Tuple
+
+import biom
+import numpy as np
+import pandas
+from scipy import sparse
+
+from pysyndna.src.quant_orfs import SAMPLE_ID_KEY, \
+    SAMPLE_IN_ALIQUOT_MASS_G_KEY, SSRNA_CONCENTRATION_NG_UL_KEY, \
+    ELUTE_VOL_UL_KEY, TOTAL_BIOLOGICAL_READS_KEY
+from pysyndna.src.util import calc_copies_genomic_element_per_g_series, \
+    SSRNA_NUCLEOTIDE_G_PER_MOLE, NANOGRAMS_PER_GRAM
+from q2_pysyndna._disk_cache import DiskCache, DiskCodec
+from q2_pysyndna._version import get_versions
+
+PYSYNDNA_COPY_COUNT_ENGINE = 'pysyndna'
+SPARSE_COPY_COUNT_ENGINE = 'sparse'
+COPY_COUNT_ENGINES = [PYSYNDNA_COPY_COUNT_ENGINE, SPARSE_COPY_COUNT_ENGINE]
+
+_SAMPLE_INFO_KEYS = [SAMPLE_IN_ALIQUOT_MASS_G_KEY,
+                     SSRNA_CONCENTRATION_NG_UL_KEY, ELUTE_VOL_UL_KEY,
+                     TOTAL_BIOLOGICAL_READS_KEY]
+# If the Q2_PYSYNDNA_CHECKPOINT_DIR environment variable names a directory,
+# count_copies run a block of samples at a time stores each finished block
+# there, so an interrupted run resumes after its last finished block.  (It is
+# a local path, so it isn't an action parameter, which would record it in
+# the output's provenance.)
+CHECKPOINT_DIR_ENV_VAR = "Q2_PYSYNDNA_CHECKPOINT_DIR"
+# A run's checkpointed blocks are all needed to assemble its result, so the
+# checkpoint directory is never trimmed to a size
+_CHECKPOINT_MAX_BYTES = sys.maxsize
+
+
+def calc_copies_of_ogu_orf_ssrna_per_g_sample_sparse(
+        sample_info_df: pandas.DataFrame,
+        genome_orf_counts: biom.Table,
+        ogu_orf_lens: np.ndarray) -> Tuple[biom.Table, List[str]]:
+    """Calculate the copies of each genome+ORF ssRNA per gram of sample.
+
+    Does the calculation pysyndna's
+    calc_copies_of_ogu_orf_ssrna_per_g_sample_from_dfs does, but as sparse
+    scalings of the matrix of genome_orf_counts, so memory tracks its
+    nonzero counts rather than its genome+ORFs x samples: each count is the
+    fraction of its sample's total biological reads times the sample's
+    ssRNA mass per gram of sample (a column scaling), times the copies per
+    gram of its genome+ORF's ssRNA (a row scaling).
+
+    Parameters
+    ----------
+    sample_info_df : pandas.DataFrame
+        A DataFrame with SAMPLE_ID_KEY, SAMPLE_IN_ALIQUOT_MASS_G_KEY,
+        SSRNA_CONCENTRATION_NG_UL_KEY, ELUTE_VOL_UL_KEY and
+        TOTAL_BIOLOGICAL_READS_KEY columns.
+    genome_orf_counts : biom.Table
+        A biom.Table with the number of reads per genome+ORF per sample.
+    ogu_orf_lens : np.ndarray
+        The length in bp of each genome+ORF of genome_orf_counts, in its
+        order, as looked up by coords_directory_format_to_ogu_orf_lens.
+
+    Returns
+    -------
+    copies_of_ogu_orf_ssrna_per_g_sample : biom.Table
+        A biom.Table, with the ids of genome_orf_counts, of the copies of
+        each genome+ORF ssRNA per gram of sample.
+    log_msgs_list : List[str]
+        Log messages generated during the calculation.  Empty if there were
+        none.
+    """
+    ogu_orf_ids = genome_orf_counts.ids(axis='observation').tolist()
+    sample_ids = genome_orf_counts.ids(axis='sample').tolist()
+    ogu_orf_lens = np.asarray(ogu_orf_lens, dtype=float)
+    missing_ids = [x for x, y in zip(ogu_orf_ids, np.isnan(ogu_orf_lens))
+                   if y]
+    if len(missing_ids) > 0:
+        raise ValueError(
+            f"The following genome+ORF ids have counts but are not in the "
+            f"coords: {missing_ids}")
+
+    # copies per g of ssRNA, as pysyndna converts them
+    copies_per_g_ssrna = calc_copies_genomic_element_per_g_series(
+        pandas.Series(ogu_orf_lens), SSRNA_NUCLEOTIDE_G_PER_MOLE).to_numpy(
+            dtype=float)
+    matrix = sparse.diags(copies_per_g_ssrna) @ \
+        sparse.csr_matrix(genome_orf_counts.matrix_data, dtype=float) @ \
+        sparse.diags(_get_sample_scales(sample_info_df, sample_ids))
+
+    # (the ids are those of a valid table, so needn't be checked again)
+    return biom.Table(sparse.csr_matrix(matrix), ogu_orf_ids, sample_ids,
+                      validate=False), []
+
+
+def _get_sample_scales(sample_info_df: pandas.DataFrame,
+                       sample_ids: List[str]) -> np.ndarray:
+    # Returns, for each sample (in sample_ids order), the factor that turns
+    # its counts into grams of ssRNA per gram of sample
+    sample_info_df = sample_info_df.set_index(SAMPLE_ID_KEY)
+    missing_ids = [x for x in sample_ids if x not in sample_info_df.index]
+    if len(missing_ids) > 0:
+        raise ValueError(
+            f"The following sample ids have genome+ORF counts but are not in "
+            f"the metadata: {missing_ids}")
+    sample_info_df = sample_info_df.loc[sample_ids]
+
+    def _get_values(key):
+        return sample_info_df[key].to_numpy(dtype=float)
+
+    # the mass of ssRNA extracted from the sample aliquot ...
+    ssrna_masses_g = _get_values(SSRNA_CONCENTRATION_NG_UL_KEY) * \
+        _get_values(ELUTE_VOL_UL_KEY) / NANOGRAMS_PER_GRAM
+    # ... divided among the reads, and per g of the sample aliquot
+    return ssrna_masses_g / _get_values(TOTAL_BIOLOGICAL_READS_KEY) / \
+        _get_values(SAMPLE_IN_ALIQUOT_MASS_G_KEY)
+
+
+def get_checkpoint_dir_from_env() -> Optional[str]:
+    """Get the checkpoint directory the environment names, or None if it
+    doesn't.
+    """
+    checkpoint_dir = os.environ.get(CHECKPOINT_DIR_ENV_VAR)
+    if not checkpoint_dir:
+        return None
+    return checkpoint_dir
+
+
+def calc_copies_of_ogu_orf_ssrna_per_g_sample_chunked(
+        sample_info_df: pandas.DataFrame,
+        genome_orf_counts: biom.Table,
+        ogu_orf_lens: Optional[np.ndarray],
+        calc_func: Callable[[pandas.DataFrame, biom.Table],
+                            Tuple[biom.Table, List[str]]],
+        engine: str,
+        sample_block_size: int,
+        checkpoint_dir: Optional[str] = None) -> \
+        Tuple[biom.Table, List[str]]:
+    """Calculate the copies of each genome+ORF ssRNA a block of samples at
+    a time, checkpointing each finished block.
+
+    Parameters
+    ----------
+    sample_info_df : pandas.DataFrame
+        A DataFrame with SAMPLE_ID_KEY, SAMPLE_IN_ALIQUOT_MASS_G_KEY,
+        SSRNA_CONCENTRATION_NG_UL_KEY, ELUTE_VOL_UL_KEY and
+        TOTAL_BIOLOGICAL_READS_KEY columns.
+    genome_orf_counts : biom.Table
+        A biom.Table with the number of reads per genome+ORF per sample.
+    ogu_orf_lens : np.ndarray or None
+        The length in bp of each genome+ORF of genome_orf_counts, in its
+        order, which (with the ids) fingerprints the coords used.  Only
+        needed if checkpoint_dir is given.
+    calc_func : Callable
+        Calculates a block's copies (and log messages) from sample_info_df
+        and a biom.Table of the block's samples' counts.
+    engine : str
+        One of COPY_COUNT_ENGINES: the engine that calc_func uses.
+    sample_block_size : int
+        The number of samples in each block; the last block may have fewer.
+    checkpoint_dir : str, optional
+        A local directory in which to store each block's results as soon as
+        it is finished.  Blocks whose results are already stored there, from
+        an earlier run with the same inputs for their samples, are loaded
+        rather than recalculated, so a run that was interrupted resumes
+        after its last finished block.
+
+    Returns
+    -------
+    copies_of_ogu_orf_ssrna_per_g_sample : biom.Table
+        A biom.Table of the blocks' copies of each genome+ORF ssRNA per gram
+        of sample, with the genome+ORFs of any block's output and the
+        blocks' samples, each in the order of genome_orf_counts.
+    log_msgs_list : List[str]
+        The blocks' log messages, in block order.
+    """
+    ogu_orf_ids = genome_orf_counts.ids(axis='observation').tolist()
+    sample_ids = genome_orf_counts.ids(axis='sample').tolist()
+    checkpoints = None
+    if checkpoint_dir is not None:
+        checkpoints = DiskCache(checkpoint_dir, _CHECKPOINT_MAX_BYTES)
+        shared_hasher = _make_shared_hasher(ogu_orf_ids, ogu_orf_lens, engine)
+        indexed_sample_info_df = sample_info_df.set_index(SAMPLE_ID_KEY)
+
+    # columns of the whole table are sliced into blocks without copying it,
+    # and the blocks' tables share its (unchanged) genome+ORF ids' index
+    counts_matrix = sparse.csc_matrix(genome_orf_counts.matrix_data)
+    ogu_orf_index = pandas.Index(ogu_orf_ids)
+    ogu_orf_nums_by_id = {x: i for i, x in enumerate(ogu_orf_ids)}
+    blocks = []
+    for start in range(0, len(sample_ids), sample_block_size):
+        block_sample_ids = sample_ids[start:start + sample_block_size]
+        block_counts = counts_matrix[:, start:start + sample_block_size]
+
+        block, key = None, None
+        if checkpoints is not None:
+            key = _calc_block_key(shared_hasher, indexed_sample_info_df,
+                                  block_sample_ids, block_counts)
+            block = checkpoints.get(key, _BLOCK_CODEC)
+        if block is None:
+            block_copies, block_log_msgs = calc_func(
+                sample_info_df, biom.Table(
+                    block_counts, ogu_orf_ids, block_sample_ids,
+                    validate=False, observation_index=ogu_orf_nums_by_id))
+            block = _make_block(block_copies, block_log_msgs, ogu_orf_index)
+            if checkpoints is not None:
+                checkpoints.put(key, block, _BLOCK_CODEC)
+        blocks.append(block)
+
+    return _assemble_blocks(blocks, ogu_orf_ids)
+
+
+def _make_shared_hasher(ogu_orf_ids: List[str], ogu_orf_lens: np.ndarray,
+                        engine: str):
+    # Digests what every block depends on: the calculation and the ORFs
+    shared_hasher = hashlib.blake2b(digest_size=16)
+    shared_hasher.update(repr(
+        [get_versions()['version'], engine, len(ogu_orf_ids)]).encode())
+    shared_hasher.update('\n'.join(ogu_orf_ids).encode())
+    shared_hasher.update(np.asarray(ogu_orf_lens, dtype=float).tobytes())
+    return shared_hasher
+
+
+def _calc_block_key(shared_hasher, sample_info_df: pandas.DataFrame,
+                    block_sample_ids: List[str],
+                    block_counts: sparse.csc_matrix) -> str:
+    # Digests a block's inputs: its samples, their info and their counts
+    hasher = shared_hasher.copy()
+    hasher.update(repr(block_sample_ids).encode())
+    block_info_df = sample_info_df.reindex(block_sample_ids)
+    hasher.update(repr(
+        block_info_df[_SAMPLE_INFO_KEYS].values.tolist()).encode())
+    block_counts = block_counts.copy()
+    block_counts.sort_indices()
+    for array in [block_counts.data.astype(float),
+                  block_counts.indices.astype(np.int64),
+                  block_counts.indptr.astype(np.int64)]:
+        hasher.update(array.tobytes())
+    return hasher.hexdigest()
+
+
+def _make_block(block_copies: biom.Table, block_log_msgs: List[str],
+                ogu_orf_index: pandas.Index) -> dict:
+    # A block's copies are kept in compressed sparse column form, with the
+    # positions of their rows' genome+ORFs in the whole table
+    matrix = sparse.csc_matrix(block_copies.matrix_data, dtype=float)
+    return {'data': matrix.data,
+            'indices': matrix.indices.astype(np.int64),
+            'indptr': matrix.indptr.astype(np.int64),
+            'ogu_orf_nums': ogu_orf_index.get_indexer(
+                block_copies.ids(axis='observation')).astype(np.int64),
+            'sample_ids': block_copies.ids(axis='sample').tolist(),
+            'log_msgs': list(block_log_msgs)}
+
+
+def _block_to_columns(
+        block: dict) -> Tuple[Dict[str, np.ndarray], dict]:
+    columns = {x: block[x] for x in
+               ['data', 'indices', 'indptr', 'ogu_orf_nums']}
+    codec_meta = {x: block[x] for x in ['sample_ids', 'log_msgs']}
+    return columns, codec_meta
+
+
+def _columns_to_block(columns: Dict[str, np.ndarray],
+                      codec_meta: dict) -> dict:
+    block = {x: np.asarray(y) for x, y in columns.items()}
+    block.update(codec_meta)
+    return block
+
+
+_BLOCK_CODEC = DiskCodec(to_columns=_block_to_columns,
+                         from_columns=_columns_to_block)
+
+
+def _assemble_blocks(blocks: List[dict],
+                     ogu_orf_ids: List[str]) -> Tuple[biom.Table, List[str]]:
+    # (starting from empty arrays, for a table without samples)
+    values = [np.zeros(0)]
+    ogu_orf_nums = [np.zeros(0, dtype=np.int64)]
+    col_nums = [np.zeros(0, dtype=np.int64)]
+    sample_ids, log_msgs_list = [], []
+    for block in blocks:
+        values.append(block['data'])
+        ogu_orf_nums.append(block['ogu_orf_nums'][block['indices']])
+        col_nums.append(len(sample_ids) + np.repeat(
+            np.arange(len(block['sample_ids'])), np.diff(block['indptr'])))
+        sample_ids.extend(block['sample_ids'])
+        log_msgs_list.extend(block['log_msgs'])
+
+    # the genome+ORFs in any block's output, in the order of the input
+    out_ogu_orf_nums = np.unique(np.concatenate(
+        [ogu_orf_nums[0]] + [x['ogu_orf_nums'] for x in blocks]))
+    matrix = sparse.csr_matrix(
+        (np.concatenate(values),
+         (np.searchsorted(out_ogu_orf_nums, np.concatenate(ogu_orf_nums)),
+          np.concatenate(col_nums))),
+        shape=(len(out_ogu_orf_nums), len(sample_ids)))
+    return biom.Table(matrix, [ogu_orf_ids[x] for x in out_ogu_orf_nums],
+                      sample_ids), log_msgs_list
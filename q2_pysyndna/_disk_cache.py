@@ -0,0 +1,217 @@
+import collections
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import numpy as np
+import pandas
+
+from q2_pysyndna._version import get_versions
+
+# Reference artifacts (coords, lengths, synDNA pools) are reused across many
+# actions, each of which would otherwise reparse their text.  If the
+# Q2_PYSYNDNA_DISK_CACHE_DIR environment variable names a directory, the
+# parsed results of files inside QIIME 2 artifacts are stored there as
+# columns of .npy files, keyed by the artifact's UUID and the plugin version
+# (artifacts are immutable, so the UUID identifies the contents), and later
+# runs load those columns instead of parsing.  The cache's total size is
+# capped, evicting the least recently used entries first.
+DISK_CACHE_DIR_ENV_VAR = "Q2_PYSYNDNA_DISK_CACHE_DIR"
+DISK_CACHE_MAX_BYTES_ENV_VAR = "Q2_PYSYNDNA_DISK_CACHE_MAX_BYTES"
+_DEFAULT_MAX_BYTES = 20 * 1024 ** 3
+_META_FNAME = 'meta.json'
+_TMP_PREFIX = '.tmp-'
+# QIIME 2 extracts an artifact's payload to <...>/<artifact uuid>/data/
+_UUID_REGEX = re.compile(
+    r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+_ARTIFACT_DATA_DIR = 'data'
+
+# A way to store a parsed result as named numpy arrays plus JSON-able
+# metadata, and to rebuild it from them.  to_columns returns None for
+# results it can't store faithfully, which are then just not cached.
+DiskCodec = collections.namedtuple(
+    "DiskCodec", ["to_columns", "from_columns"])
+
+
+class DiskCache:
+    """A size-capped LRU cache of parsed artifact files in a local directory.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def get(self, key: str, codec: DiskCodec) -> Optional[Any]:
+        entry_dir = os.path.join(self.cache_dir, key)
+        meta_fp = os.path.join(entry_dir, _META_FNAME)
+        try:
+            with open(meta_fp) as fh:
+                meta = json.load(fh)
+            columns = {
+                name: np.load(os.path.join(entry_dir, fname),
+                              mmap_mode='r', allow_pickle=False)
+                for name, fname in meta['column_fnames'].items()}
+            # the metadata file's mtime records when the entry was last used
+            os.utime(meta_fp)
+        except (OSError, ValueError, KeyError):
+            # absent, or evicted/damaged by another process: a miss
+            return None
+        return codec.from_columns(columns, meta['codec_meta'])
+
+    def put(self, key: str, value: Any, codec: DiskCodec):
+        to_store = codec.to_columns(value)
+        if to_store is None:
+            return
+        columns, codec_meta = to_store
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix=_TMP_PREFIX, dir=self.cache_dir)
+        try:
+            column_fnames = {}
+            for i, (name, values) in enumerate(columns.items()):
+                column_fnames[name] = f'{i}.npy'
+                np.save(os.path.join(tmp_dir, column_fnames[name]), values,
+                        allow_pickle=False)
+            with open(os.path.join(tmp_dir, _META_FNAME), 'w') as fh:
+                json.dump({'column_fnames': column_fnames,
+                           'codec_meta': codec_meta}, fh)
+            # Renaming is atomic, so other processes never see a partial
+            # entry; if one of them stored this entry first, theirs is kept.
+            os.rename(tmp_dir, os.path.join(self.cache_dir, key))
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry_name in os.listdir(self.cache_dir):
+            if entry_name.startswith(_TMP_PREFIX):
+                continue
+            entry_dir = os.path.join(self.cache_dir, entry_name)
+            try:
+                last_used = os.stat(
+                    os.path.join(entry_dir, _META_FNAME)).st_mtime_ns
+                num_bytes = sum(x.stat().st_size
+                                for x in os.scandir(entry_dir))
+            except OSError:
+                continue
+            entries.append((last_used, num_bytes, entry_dir))
+
+        total_bytes = sum(x[1] for x in entries)
+        for _, num_bytes, entry_dir in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_bytes -= num_bytes
+
+
+def get_disk_cache_from_env() -> Optional[DiskCache]:
+    """Make the DiskCache the environment asks for, or None if it doesn't.
+    """
+    cache_dir = os.environ.get(DISK_CACHE_DIR_ENV_VAR)
+    if not cache_dir:
+        return None
+
+    max_bytes_str = os.environ.get(
+        DISK_CACHE_MAX_BYTES_ENV_VAR, str(_DEFAULT_MAX_BYTES))
+    try:
+        max_bytes = int(max_bytes_str)
+    except ValueError:
+        raise ValueError(
+            f"{DISK_CACHE_MAX_BYTES_ENV_VAR} must be an integer number of "
+            f"bytes, but is '{max_bytes_str}'")
+    return DiskCache(cache_dir, max_bytes)
+
+
+def get_disk_cache_key(fp: str, parse_func: Callable) -> Optional[str]:
+    """Key a file's parsed result by artifact UUID and plugin version.
+
+    Parameters
+    ----------
+    fp : str
+        Path to a file.
+    parse_func : Callable
+        The function that parses the file.
+
+    Returns
+    -------
+    key : str or None
+        A hex digest identifying the artifact, the file's path within it,
+        the parser and the plugin version, or None if the file is not
+        inside an extracted QIIME 2 artifact.
+    """
+    artifact_file = get_artifact_uuid_and_relpath(fp)
+    if artifact_file is None:
+        return None
+
+    key_parts = list(artifact_file) + [
+        get_versions()['version'], parse_func.__module__,
+        parse_func.__qualname__]
+    return hashlib.sha256(json.dumps(key_parts).encode()).hexdigest()
+
+
+def get_artifact_uuid_and_relpath(fp: str) -> Optional[Tuple[str, str]]:
+    path_parts = os.path.realpath(str(fp)).split(os.sep)
+    # the innermost artifact wins (e.g. for artifacts inside provenance)
+    for i in range(len(path_parts) - 2, 0, -1):
+        if path_parts[i] == _ARTIFACT_DATA_DIR and \
+                _UUID_REGEX.match(path_parts[i - 1]):
+            return path_parts[i - 1], '/'.join(path_parts[i + 1:])
+    return None
+
+
+def _df_to_columns(
+        df: pandas.DataFrame) -> Optional[Tuple[Dict[str, np.ndarray], dict]]:
+    columns = {}
+    dtypes = []
+    all_values = [df.index] + [df[x] for x in df.columns]
+    for i, values in enumerate(all_values):
+        array = _values_to_array(values)
+        if array is None:
+            return None
+        columns[str(i)] = array
+        dtypes.append(str(values.dtype))
+
+    codec_meta = {'index_name': df.index.name,
+                  'column_names': list(df.columns),
+                  'dtypes': dtypes}
+    # JSON is how the metadata is stored, so it must survive the round trip
+    if json.loads(json.dumps(codec_meta)) != codec_meta:
+        return None
+    return columns, codec_meta
+
+
+def _values_to_array(values) -> Optional[np.ndarray]:
+    if pandas.api.types.is_numeric_dtype(values.dtype) and \
+            not isinstance(values.dtype, pandas.CategoricalDtype) and \
+            not pandas.api.types.is_extension_array_dtype(values.dtype):
+        return np.asarray(values)
+    if pandas.api.types.is_string_dtype(values.dtype) and \
+            all(isinstance(x, str) for x in values):
+        return np.array(list(values), dtype=str)
+    return None
+
+
+def _columns_to_df(columns: Dict[str, np.ndarray],
+                   codec_meta: dict) -> pandas.DataFrame:
+    dtypes = codec_meta['dtypes']
+    index = pandas.Index(
+        columns['0'].tolist(), dtype=dtypes[0], name=codec_meta['index_name'])
+    data = {}
+    for i, name in enumerate(codec_meta['column_names'], start=1):
+        values = columns[str(i)]
+        if values.dtype.kind == 'U':
+            values = values.tolist()
+        data[name] = pandas.Series(values, dtype=dtypes[i], index=index)
+    return pandas.DataFrame(data, index=index)
+
+
+# DataFrames of numeric and string columns (with a string or numeric index)
+DATAFRAME_CODEC = DiskCodec(to_columns=_df_to_columns,
+                            from_columns=_columns_to_df)
@@ -0,0 +1,438 @@
+import concurrent.futures
+import hashlib
+from typing import Dict, List, Optional, Tuple
+
+import biom
+import numpy as np
+import pandas
+from scipy import special
+
+from pysyndna import fit_linear_regression_models
+from pysyndna.src.fit_syndna_models import REGRESSION_KEYS, SAMPLE_ID_KEY, \
+    SYNDNA_ID_KEY, SYNDNA_INDIV_NG_UL_KEY, SYNDNA_POOL_MASS_NG_KEY, \
+    SAMPLE_TOTAL_READS_KEY
+
+PYSYNDNA_FIT_ENGINE = 'pysyndna'
+BATCHED_FIT_ENGINE = 'batched'
+FIT_ENGINES = [PYSYNDNA_FIT_ENGINE, BATCHED_FIT_ENGINE]
+
+# names of the LinregressResult properties that make up a regression, which
+# is what pysyndna's REGRESSION_KEYS are
+_SLOPE = 'slope'
+_INTERCEPT = 'intercept'
+_RVALUE = 'rvalue'
+_PVALUE = 'pvalue'
+_STDERR = 'stderr'
+_INTERCEPT_STDERR = 'intercept_stderr'
+# as in scipy.stats.linregress, keeps the t statistic finite when |r| is 1
+_TINY = 1.0e-20
+
+
+def fit_linear_regression_models_batched(
+        syndna_concs_df: pandas.DataFrame,
+        sample_syndna_weights_and_total_reads_df: pandas.DataFrame,
+        syndna_counts: biom.Table,
+        min_sample_count: int) -> \
+        Tuple[Dict[str, Optional[Dict[str, float]]], List[str]]:
+    """Fit every sample's regression of log mass on log counts at once.
+
+    For each sample, the log10 of each synDNA's mass in ng (its fraction of
+    the pool's total concentration times the sample's synDNA pool mass) is
+    regressed on the log10 of its counts per million reads.  Instead of
+    fitting samples one by one, the values for all samples are laid out in
+    a 2-D (sample x synDNA) array and all regressions solved together.
+    The few samples that can't be fit this way (those with fewer than two
+    synDNAs with reads, or the same counts per million for all of them) are
+    passed to pysyndna's fit_linear_regression_models instead, so their
+    results and log messages are worded exactly as pysyndna's are.
+
+    Parameters
+    ----------
+    syndna_concs_df : pandas.DataFrame
+        A DataFrame with SYNDNA_ID_KEY and SYNDNA_INDIV_NG_UL_KEY columns.
+    sample_syndna_weights_and_total_reads_df : pandas.DataFrame
+        A DataFrame with at least SAMPLE_ID_KEY, SYNDNA_POOL_MASS_NG_KEY and
+        SAMPLE_TOTAL_READS_KEY columns.
+    syndna_counts : biom.Table
+        Feature table of synDNA counts, with synDNAs as observations.  Only
+        the counts of the pool's synDNAs are used; a pool synDNA that isn't
+        in the table has no reads.
+    min_sample_count : int
+        SynDNAs with fewer total reads than this (across all samples) are
+        dropped before fitting.
+
+    Returns
+    -------
+    linregs_dict : Dict[str, Optional[Dict[str, float]]]
+        Keyed by sample id (in syndna_counts order): None if no model could
+        be fit for the sample, or otherwise a dictionary of each of
+        REGRESSION_KEYS and its value, as a float.
+    log_msgs_list : List[str]
+        Log messages generated during fitting.  Empty if there were none.
+    """
+    log_msgs_list = []
+    syndna_ids = syndna_concs_df[SYNDNA_ID_KEY].tolist()
+    sample_ids = syndna_counts.ids(axis='sample').tolist()
+    counts = _get_pool_counts(syndna_counts, syndna_ids)
+    syndna_concs = syndna_concs_df[SYNDNA_INDIV_NG_UL_KEY].to_numpy(
+        dtype=float)
+    pool_masses, total_reads = _get_sample_pool_masses_and_total_reads(
+        sample_syndna_weights_and_total_reads_df, sample_ids)
+
+    syndna_totals = counts.sum(axis=0)
+    is_kept_syndna = syndna_totals >= min_sample_count
+    dropped_syndna_ids = \
+        [x for x, y in zip(syndna_ids, is_kept_syndna) if not y]
+    if len(dropped_syndna_ids) > 0:
+        log_msgs_list.append(make_dropped_syndnas_msg(
+            dropped_syndna_ids, min_sample_count))
+
+    # The fraction is of the whole pool, including any dropped synDNAs
+    syndna_fractions = syndna_concs[is_kept_syndna] / syndna_concs.sum()
+    counts = counts[:, is_kept_syndna]
+
+    # Zero counts have no log, so they are left out of that sample's fit
+    is_used = (counts > 0) & (total_reads[:, np.newaxis] > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_cpms = np.log10(counts / total_reads[:, np.newaxis] * 1e6)
+        log_masses = np.log10(
+            pool_masses[:, np.newaxis] * syndna_fractions[np.newaxis, :])
+    is_used &= np.isfinite(log_masses)
+
+    results, is_fit = batched_linregress(log_cpms, log_masses, is_used)
+
+    linregs_dict = {}
+    for i, sample_id in enumerate(sample_ids):
+        if is_fit[i]:
+            linregs_dict[sample_id] = \
+                {k: float(results[k][i]) for k in REGRESSION_KEYS}
+        else:
+            linregs_dict[sample_id] = None
+
+    unfit_sample_ids = [x for x, y in zip(sample_ids, is_fit) if not y]
+    if len(unfit_sample_ids) > 0:
+        # pysyndna is given just the pool's synDNAs kept above (their totals
+        # over only these samples could be lower), and left none to drop.
+        kept_syndna_ids = set(syndna_ids) - set(dropped_syndna_ids)
+        unfit_counts = syndna_counts.filter(
+            unfit_sample_ids, axis='sample', inplace=False)
+        unfit_counts = unfit_counts.filter(
+            lambda v, i, md: i in kept_syndna_ids, axis='observation',
+            inplace=False)
+        unfit_linregs_dict, unfit_log_msgs_list = \
+            fit_linear_regression_models(
+                syndna_concs_df,
+                sample_syndna_weights_and_total_reads_df[
+                    sample_syndna_weights_and_total_reads_df[
+                        SAMPLE_ID_KEY].isin(unfit_sample_ids)],
+                # pysyndna works on a dense DataFrame (see fit)
+                unfit_counts.to_dataframe(dense=True),
+                0)
+        linregs_dict.update(unfit_linregs_dict)
+        log_msgs_list.extend(unfit_log_msgs_list)
+
+    return linregs_dict, log_msgs_list
+
+
+def fit_linear_regression_models_sharded(
+        syndna_concs_df: pandas.DataFrame,
+        sample_syndna_weights_and_total_reads_df: pandas.DataFrame,
+        syndna_counts: biom.Table,
+        min_sample_count: int,
+        n_jobs: int) -> \
+        Tuple[Dict[str, Optional[Dict[str, float]]], List[str]]:
+    """Fit each sample's regression with pysyndna, across a process pool.
+
+    The samples are split into n_jobs contiguous shards, and each worker
+    process is sent only its shard's synDNA counts and metadata, which it
+    fits with pysyndna.  The shards' results are then combined in sample
+    order, so they are the same as those of fitting all samples with
+    pysyndna in one process.
+
+    Parameters
+    ----------
+    syndna_concs_df : pandas.DataFrame
+        A DataFrame with SYNDNA_ID_KEY and SYNDNA_INDIV_NG_UL_KEY columns.
+    sample_syndna_weights_and_total_reads_df : pandas.DataFrame
+        A DataFrame with at least SAMPLE_ID_KEY, SYNDNA_POOL_MASS_NG_KEY and
+        SAMPLE_TOTAL_READS_KEY columns.
+    syndna_counts : biom.Table
+        Feature table of synDNA counts, with synDNAs as observations.
+    min_sample_count : int
+        SynDNAs with fewer total reads than this (across all samples) are
+        dropped before fitting.
+    n_jobs : int
+        The number of worker processes to fit with.
+
+    Returns
+    -------
+    linregs_dict : Dict[str, Optional[Dict[str, float]]]
+        Keyed by sample id (in syndna_counts order): None if no model could
+        be fit for the sample, or otherwise a dictionary of each of
+        REGRESSION_KEYS and its value, as a float.
+    log_msgs_list : List[str]
+        Log messages generated during fitting.  Empty if there were none.
+    """
+    # Whether a synDNA is dropped depends on its total reads across *all*
+    # samples, which no shard knows, so the dropping is done here and the
+    # workers are left nothing to drop.
+    log_msgs_list = []
+    dropped_syndna_ids = get_dropped_syndna_ids(
+        syndna_concs_df, syndna_counts, min_sample_count)
+    if len(dropped_syndna_ids) > 0:
+        log_msgs_list.append(make_dropped_syndnas_msg(
+            dropped_syndna_ids, min_sample_count))
+        syndna_counts = syndna_counts.filter(
+            lambda v, i, md: i not in dropped_syndna_ids,
+            axis='observation', inplace=False)
+
+    sample_ids = syndna_counts.ids(axis='sample').tolist()
+    shards_sample_ids = [
+        x.tolist() for x in np.array_split(
+            np.array(sample_ids, dtype=object), min(n_jobs, len(sample_ids)))]
+    is_in_shard = sample_syndna_weights_and_total_reads_df[
+        SAMPLE_ID_KEY].isin
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        futures = [
+            pool.submit(
+                fit_linear_regression_models,
+                syndna_concs_df,
+                sample_syndna_weights_and_total_reads_df[
+                    is_in_shard(curr_sample_ids)],
+                # pysyndna works on a dense DataFrame (see fit)
+                syndna_counts.filter(
+                    curr_sample_ids, axis='sample',
+                    inplace=False).to_dataframe(dense=True),
+                0)
+            for curr_sample_ids in shards_sample_ids]
+
+        linregs_dict = {}
+        # Each shard's results and messages are in its samples' order, and
+        # the shards are in sample order
+        for curr_future in futures:
+            curr_linregs_dict, curr_log_msgs_list = curr_future.result()
+            linregs_dict.update(curr_linregs_dict)
+            log_msgs_list.extend(curr_log_msgs_list)
+
+    return linregs_dict, log_msgs_list
+
+
+def get_dropped_syndna_ids(
+        syndna_concs_df: pandas.DataFrame,
+        syndna_counts: biom.Table,
+        min_sample_count: int) -> List[str]:
+    """List the pool's synDNAs that have too few reads to be fit with.
+
+    Parameters
+    ----------
+    syndna_concs_df : pandas.DataFrame
+        A DataFrame with SYNDNA_ID_KEY and SYNDNA_INDIV_NG_UL_KEY columns.
+    syndna_counts : biom.Table
+        Feature table of synDNA counts, with synDNAs as observations.
+    min_sample_count : int
+        The minimum total reads (across all samples) for a synDNA to be used
+        in the fit.
+
+    Returns
+    -------
+    dropped_syndna_ids : List[str]
+        The ids of the pool's synDNAs (in pool order) with fewer total reads
+        than min_sample_count; a pool synDNA that isn't in the table has no
+        reads.
+    """
+    syndna_ids = syndna_concs_df[SYNDNA_ID_KEY].tolist()
+    is_dropped = _get_pool_counts(syndna_counts, syndna_ids).sum(axis=0) < \
+        min_sample_count
+    return [x for x, y in zip(syndna_ids, is_dropped) if y]
+
+
+def make_dropped_syndnas_msg(dropped_syndna_ids: List[str],
+                             min_sample_count: int) -> str:
+    """Word the log message for dropped synDNAs as pysyndna words it.
+
+    Parameters
+    ----------
+    dropped_syndna_ids : List[str]
+        The ids of the dropped synDNAs.
+    min_sample_count : int
+        The minimum total reads for a synDNA to be used in the fit.
+
+    Returns
+    -------
+    log_msg : str
+        The log message.
+    """
+    return f"The following syndnas were dropped because they had fewer " \
+           f"than {min_sample_count} total reads aligned:{dropped_syndna_ids}"
+
+
+def calc_sample_input_fingerprints(
+        syndna_concs_df: pandas.DataFrame,
+        sample_syndna_weights_and_total_reads_df: pandas.DataFrame,
+        syndna_counts: biom.Table,
+        min_sample_count: int,
+        engine: str) -> Dict[str, str]:
+    """Digest the inputs that each sample's regression is fit from.
+
+    Parameters
+    ----------
+    syndna_concs_df : pandas.DataFrame
+        A DataFrame with SYNDNA_ID_KEY and SYNDNA_INDIV_NG_UL_KEY columns.
+    sample_syndna_weights_and_total_reads_df : pandas.DataFrame
+        A DataFrame with at least SAMPLE_ID_KEY, SYNDNA_POOL_MASS_NG_KEY and
+        SAMPLE_TOTAL_READS_KEY columns.
+    syndna_counts : biom.Table
+        Feature table of synDNA counts, with synDNAs as observations.
+    min_sample_count : int
+        The minimum total reads for a synDNA to be used in the fit.
+    engine : str
+        One of FIT_ENGINES.
+
+    Returns
+    -------
+    input_fingerprints : Dict[str, str]
+        Keyed by sample id (for each sample in syndna_counts that is in the
+        metadata), a hex digest of the fit settings, the synDNA pool, the
+        synDNAs dropped for having too few reads across all the samples in
+        syndna_counts, and the sample's synDNA pool mass, total reads and
+        counts of the pool's synDNAs.  Samples not in the metadata have no
+        fingerprint.
+    """
+    syndna_ids = syndna_concs_df[SYNDNA_ID_KEY].tolist()
+    sample_ids = syndna_counts.ids(axis='sample').tolist()
+    counts = _get_pool_counts(syndna_counts, syndna_ids)
+    # A sample's model depends on which synDNAs are dropped, which depends on
+    # the counts of every sample
+    is_dropped = counts.sum(axis=0) < min_sample_count
+
+    is_in_metadata = np.isin(
+        sample_ids,
+        sample_syndna_weights_and_total_reads_df[SAMPLE_ID_KEY].to_numpy())
+    sample_ids = [x for x, y in zip(sample_ids, is_in_metadata) if y]
+    counts = counts[is_in_metadata]
+    pool_masses, total_reads = _get_sample_pool_masses_and_total_reads(
+        sample_syndna_weights_and_total_reads_df, sample_ids)
+
+    shared_hasher = hashlib.blake2b(digest_size=16)
+    shared_hasher.update(repr(
+        [engine, min_sample_count, syndna_ids,
+         syndna_concs_df[SYNDNA_INDIV_NG_UL_KEY].astype(float).tolist(),
+         is_dropped.tolist()]
+    ).encode())
+
+    input_fingerprints = {}
+    for i, sample_id in enumerate(sample_ids):
+        hasher = shared_hasher.copy()
+        hasher.update(np.array([pool_masses[i], total_reads[i]]).tobytes())
+        hasher.update(counts[i].tobytes())
+        input_fingerprints[sample_id] = hasher.hexdigest()
+    return input_fingerprints
+
+
+def batched_linregress(x: np.ndarray, y: np.ndarray, mask: np.ndarray) -> \
+        Tuple[Dict[str, np.ndarray], np.ndarray]:
+    """Fit a least-squares line to each row of x and y, as linregress does.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        2-D array of independent variable values, one regression per row.
+    y : np.ndarray
+        2-D array of dependent variable values, the same shape as x.
+    mask : np.ndarray
+        2-D boolean array, the same shape as x; only the values where it is
+        True are used in each row's regression.
+
+    Returns
+    -------
+    results : Dict[str, np.ndarray]
+        The slope, intercept, rvalue, pvalue, stderr and intercept_stderr
+        of each row's regression (as scipy.stats.linregress would calculate
+        them), keyed by those names.  Values are nan for rows that can't be
+        fit.
+    is_fit : np.ndarray
+        1-D boolean array that is True for rows with a regression: those
+        with at least two used values and not all the same x.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    # Unused values are zeroed, so they drop out of the sums whatever they
+    # are (including inf or nan)
+    x = np.where(mask, x, 0.0)
+    y = np.where(mask, y, 0.0)
+    n = mask.sum(axis=1).astype(float)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_mean = x.sum(axis=1) / n
+        y_mean = y.sum(axis=1) / n
+        x_dev = np.where(mask, x - x_mean[:, np.newaxis], 0.0)
+        y_dev = np.where(mask, y - y_mean[:, np.newaxis], 0.0)
+        # (biased) variances and covariance, like np.cov(x, y, bias=1)
+        ssxm = (x_dev * x_dev).sum(axis=1) / n
+        ssym = (y_dev * y_dev).sum(axis=1) / n
+        ssxym = (x_dev * y_dev).sum(axis=1) / n
+
+        is_fit = (n >= 2) & (ssxm > 0)
+
+        r_den = np.sqrt(ssxm * ssym)
+        rvalue = np.where(r_den == 0, 0.0, ssxym / r_den)
+        rvalue = np.clip(rvalue, -1.0, 1.0)
+        slope = ssxym / ssxm
+        intercept = y_mean - slope * x_mean
+
+        # With only two points the line fits exactly, so (as in linregress)
+        # the errors are 0 and the p-value is 0, unless the line is flat.
+        dof = n - 2
+        t_stat = rvalue * np.sqrt(
+            dof / ((1.0 - rvalue + _TINY) * (1.0 + rvalue + _TINY)))
+        pvalue = np.where(
+            dof > 0, 2 * special.stdtr(dof, -np.abs(t_stat)),
+            np.where(ssym == 0, 1.0, 0.0))
+        stderr = np.where(
+            dof > 0, np.sqrt((1 - rvalue ** 2) * ssym / ssxm / dof), 0.0)
+        intercept_stderr = stderr * np.sqrt(ssxm + x_mean ** 2)
+
+    results = {_SLOPE: slope, _INTERCEPT: intercept, _RVALUE: rvalue,
+               _PVALUE: pvalue, _STDERR: stderr,
+               _INTERCEPT_STDERR: intercept_stderr}
+    for curr_values in results.values():
+        curr_values[~is_fit] = np.nan
+    return results, is_fit
+
+
+def _get_pool_counts(syndna_counts: biom.Table,
+                     pool_syndna_ids: List[str]) -> np.ndarray:
+    # The pool's rows are gathered straight from the table's sparse matrix
+    # (never converting it to a DataFrame, which is slow for tables wide in
+    # samples) into a dense (sample x synDNA) array, which is small because
+    # pools hold only a handful of synDNAs.
+    row_nums = {x: i for i, x in
+                enumerate(syndna_counts.ids(axis='observation'))}
+    counts = np.zeros(
+        (len(syndna_counts.ids(axis='sample')), len(pool_syndna_ids)))
+    pool_cols, table_rows = [], []
+    for pool_col, syndna_id in enumerate(pool_syndna_ids):
+        if syndna_id in row_nums:
+            pool_cols.append(pool_col)
+            table_rows.append(row_nums[syndna_id])
+
+    if len(table_rows) > 0:
+        matrix = syndna_counts.matrix_data.tocsr()
+        counts[:, pool_cols] = matrix[table_rows, :].T.toarray()
+    return counts
+
+
+def _get_sample_pool_masses_and_total_reads(
+        sample_syndna_weights_and_total_reads_df: pandas.DataFrame,
+        sample_ids: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    sample_info_df = sample_syndna_weights_and_total_reads_df.set_index(
+        SAMPLE_ID_KEY)
+    missing_ids = [x for x in sample_ids if x not in sample_info_df.index]
+    if len(missing_ids) > 0:
+        raise ValueError(
+            f"The following sample ids have syndna counts but are not in "
+            f"the metadata: {missing_ids}")
+
+    sample_info_df = sample_info_df.loc[sample_ids]
+    return (sample_info_df[SYNDNA_POOL_MASS_NG_KEY].to_numpy(dtype=float),
+            sample_info_df[SAMPLE_TOTAL_READS_KEY].to_numpy(dtype=float))
@@ -1,12 +1,37 @@
 import biom
 import pandas
 from qiime2.plugin import Metadata
+from q2_types.feature_table import BIOMV210DirFmt
 
 from pysyndna import fit_linear_regression_models, calc_ogu_cell_counts_biom, \
     calc_copies_of_ogu_orf_ssrna_per_g_sample_from_dfs, \
-    OGU_CELLS_PER_G_OF_SAMPLE_KEY, OGU_ID_KEY, OGU_LEN_IN_BP_KEY
+    OGU_CELLS_PER_G_OF_GDNA_KEY, OGU_CELLS_PER_G_OF_SAMPLE_KEY, OGU_ID_KEY, \
+    OGU_LEN_IN_BP_KEY
+from q2_pysyndna._biom_hdf5 import biom_dir_fmt_to_table, \
+    table_to_biom_dir_fmt, read_biom_ids
+from q2_pysyndna._cell_count_engine import PYSYNDNA_CELL_COUNT_ENGINE, \
+    SPARSE_CELL_COUNT_ENGINE, calc_ogu_cell_counts_sparse, \
+    calc_ogu_cell_counts_blocked, calc_ogu_cell_counts_sparse_metrics, \
+    calc_ogu_cell_counts_blocked_metrics, calc_ogu_cell_counts_sweep, \
+    calc_percent_coverages_sparse
+from q2_pysyndna._copy_count_engine import PYSYNDNA_COPY_COUNT_ENGINE, \
+    SPARSE_COPY_COUNT_ENGINE, \
+    calc_copies_of_ogu_orf_ssrna_per_g_sample_sparse, \
+    calc_copies_of_ogu_orf_ssrna_per_g_sample_chunked, \
+    get_checkpoint_dir_from_env
+from q2_pysyndna._fit_engine import PYSYNDNA_FIT_ENGINE, \
+    BATCHED_FIT_ENGINE, fit_linear_regression_models_batched, \
+    fit_linear_regression_models_sharded, calc_sample_input_fingerprints, \
+    get_dropped_syndna_ids, make_dropped_syndnas_msg
+from q2_pysyndna._type_format_coords import CoordsDirectoryFormat, \
+    coords_directory_format_to_df, coords_directory_format_to_ogu_orf_lens
+from q2_pysyndna._type_format_length import TSVLengthDirectoryFormat, \
+    tsv_length_directory_format_to_df, LENGTH_KEY
 from q2_pysyndna._type_format_linear_regressions import \
-    LinearRegressionsObjects
+    LinearRegressionsObjects, LinearRegressionsDirectoryFormat, \
+    ERROR_COLLISION_POLICY, merge_linear_regressions_directory_formats
+from q2_pysyndna._type_format_pysyndna_log import \
+    extract_fp_from_directory_format
 
 
 def _make_pysydna_metadata(metadata: pandas.DataFrame) -> pandas.DataFrame:
@@ -15,6 +40,12 @@ def _make_pysydna_metadata(metadata: pandas.DataFrame) -> pandas.DataFrame:
     return metadata_df
 
 
+def _get_genome_ids_from_ogu_orf_ids(ogu_orf_ids) -> list:
+    # OGU_ORF_IDs are "<genome id>_<orf id>", e.g. G000005825_1
+    return pandas.Series(ogu_orf_ids, dtype=object).str.rsplit(
+        '_', n=1).str[0].unique().tolist()
+
+
 # NB: Because there is a transformer on the plugin that can turn a
 # SyndnaPoolConcentrationTable (which is what the plugin gets as its first
 # argument) into a pandas.DataFrame, that transformation will be done
@@ -22,7 +53,11 @@ def _make_pysydna_metadata(metadata: pandas.DataFrame) -> pandas.DataFrame:
 def fit(syndna_concs: pandas.DataFrame,
         syndna_counts: biom.Table,
         metadata: Metadata,
-        min_sample_count: int = 1) -> LinearRegressionsObjects:
+        min_sample_count: int = 1,
+        engine: str = PYSYNDNA_FIT_ENGINE,
+        existing_regression_models: LinearRegressionsObjects = None,
+        n_jobs: int = 1) -> \
+        LinearRegressionsObjects:
     """Fit linear regression models predicting input mass from read counts.
 
     Parameters
@@ -36,6 +71,26 @@ def fit(syndna_concs: pandas.DataFrame,
     min_sample_count : int, optional
         Minimum number of counts required for a sample to be included in the
         regression.  Samples with fewer counts will be excluded.
+    engine : str, optional
+        PYSYNDNA_FIT_ENGINE (the default) to fit each sample's model with
+        pysyndna, or BATCHED_FIT_ENGINE to fit all samples' models at once
+        with vectorized numpy operations, which is much faster for runs
+        with many samples.
+    existing_regression_models : LinearRegressionsObjects, optional
+        Regression models from an earlier fit to extend.  If given, only the
+        samples in syndna_counts that have no existing model, or whose
+        inputs have changed since their model was fit, are fit; the result
+        holds those models plus all the existing ones, and the existing log
+        followed by this fit's.  SynDNAs are dropped for having too few
+        reads based on their totals across all the samples in
+        syndna_counts, as in a full fit, and a change in which are dropped
+        means every sample is refit.
+    n_jobs : int, optional
+        The number of processes to fit with PYSYNDNA_FIT_ENGINE across
+        (default 1).  The samples are split between the processes and their
+        results combined in sample order, so the output is the same as with
+        one process.  Ignored by BATCHED_FIT_ENGINE, which fits all samples
+        at once.
 
     Returns
     -------
@@ -51,29 +106,142 @@ def fit(syndna_concs: pandas.DataFrame,
     """
 
     metadata_df = _make_pysydna_metadata(metadata)
+    input_fingerprints = calc_sample_input_fingerprints(
+        syndna_concs, metadata_df, syndna_counts, min_sample_count, engine)
+
+    dropped_log_msgs_list = []
+    if existing_regression_models is not None:
+        sample_ids_to_fit = _get_sample_ids_to_refit(
+            existing_regression_models, input_fingerprints,
+            syndna_counts.ids(axis='sample'))
+        # The synDNAs a full fit would drop are dropped here, rather than
+        # leaving the engine to drop those with too few reads across just
+        # the samples being refit.
+        dropped_syndna_ids = get_dropped_syndna_ids(
+            syndna_concs, syndna_counts, min_sample_count)
+        if len(dropped_syndna_ids) > 0 and len(sample_ids_to_fit) > 0:
+            dropped_log_msgs_list.append(make_dropped_syndnas_msg(
+                dropped_syndna_ids, min_sample_count))
+        syndna_counts = syndna_counts.filter(
+            sample_ids_to_fit, axis='sample', inplace=False)
+        syndna_counts = syndna_counts.filter(
+            lambda v, i, md: i not in dropped_syndna_ids,
+            axis='observation', inplace=False)
+        min_sample_count = 0
+
+    if syndna_counts.shape[1] == 0:
+        linregs_dict, log_msgs_list = {}, []
+    elif engine == BATCHED_FIT_ENGINE:
+        linregs_dict, log_msgs_list = fit_linear_regression_models_batched(
+            syndna_concs, metadata_df, syndna_counts, min_sample_count)
+    elif n_jobs > 1:
+        linregs_dict, log_msgs_list = fit_linear_regression_models_sharded(
+            syndna_concs, metadata_df, syndna_counts, min_sample_count,
+            n_jobs)
+    else:
+        # pysyndna works on a DataFrame.  A dense one is used because
+        # pandas' sparse columns make pysyndna's per-sample operations
+        # slow, and synDNA tables have only a handful of rows.
+        reads_per_syndna_per_sample_df = syndna_counts.to_dataframe(
+            dense=True)
 
-    # convert input biom table to a pd.SparseDataFrame, which is should act
-    # basically like a pd.DataFrame but take up less memory
-    reads_per_syndna_per_sample_df = syndna_counts.to_dataframe(dense=False)
+        linregs_dict, log_msgs_list = fit_linear_regression_models(
+            syndna_concs, metadata_df, reads_per_syndna_per_sample_df,
+            min_sample_count)
 
-    linregs_dict, log_msgs_list = fit_linear_regression_models(
-        syndna_concs, metadata_df, reads_per_syndna_per_sample_df,
-        min_sample_count)
+    if existing_regression_models is not None:
+        return _merge_incremental_fit(
+            existing_regression_models, linregs_dict,
+            dropped_log_msgs_list + log_msgs_list, input_fingerprints)
 
-    result = LinearRegressionsObjects(linregs_dict, log_msgs_list)
+    result = LinearRegressionsObjects(
+        linregs_dict, log_msgs_list, input_fingerprints)
     return result
 
 
+def _get_sample_ids_to_refit(
+        existing_regression_models: LinearRegressionsObjects,
+        input_fingerprints: dict, sample_ids) -> list:
+    existing_fingerprints = existing_regression_models.input_fingerprints
+    if existing_fingerprints is None:
+        existing_fingerprints = {}
+
+    # Samples without a fingerprint (those not in the metadata) are always
+    # refit, so the engine handles them as in a full fit
+    return [x for x in sample_ids
+            if x not in input_fingerprints or
+            x not in existing_regression_models.linregs_dict or
+            existing_fingerprints.get(x) != input_fingerprints[x]]
+
+
+def _merge_incremental_fit(
+        existing_regression_models: LinearRegressionsObjects,
+        linregs_dict: dict, log_msgs_list: list,
+        input_fingerprints: dict) -> LinearRegressionsObjects:
+    # Refit samples' models replace their existing ones in place; models
+    # of new samples follow the existing ones.
+    merged_linregs_dict = dict(existing_regression_models.linregs_dict)
+    merged_linregs_dict.update(linregs_dict)
+
+    merged_fingerprints = {}
+    if existing_regression_models.input_fingerprints is not None:
+        merged_fingerprints.update(
+            existing_regression_models.input_fingerprints)
+    # Unchanged samples' fingerprints are the same as before, and those of
+    # samples fit this time are new
+    merged_fingerprints.update(input_fingerprints)
+
+    num_kept = len(merged_linregs_dict) - len(linregs_dict)
+    merged_log_msgs_list = \
+        list(existing_regression_models.log_msgs_list) + \
+        [f"Incremental fit kept {num_kept} existing regressions and fit "
+         f"{len(linregs_dict)} new or changed samples."] + \
+        list(log_msgs_list)
+
+    return LinearRegressionsObjects(
+        merged_linregs_dict, merged_log_msgs_list, merged_fingerprints)
+
+
+def merge_regressions(
+        regression_models: LinearRegressionsDirectoryFormat,
+        collision_policy: str = ERROR_COLLISION_POLICY) -> \
+        LinearRegressionsDirectoryFormat:
+    """Merge the linear regression models of many fits into one collection.
+
+    Parameters
+    ----------
+    regression_models : list of LinearRegressionsDirectoryFormat
+        Linear regression models (and logs) from fits to merge.  These are
+        read one at a time, so the merge never holds all of them at once.
+    collision_policy : str, optional
+        What to do if a sample has models in more than one input: one of
+        ERROR_COLLISION_POLICY (the default) to raise an error, or
+        FIRST_COLLISION_POLICY or LAST_COLLISION_POLICY to keep the model
+        from the first or last input that has one.
+
+    Returns
+    -------
+    merged_regression_models : LinearRegressionsDirectoryFormat
+        The merged linear regression models, with the inputs' log messages
+        in input order followed by any about collisions.
+    """
+    return merge_linear_regressions_directory_formats(
+        regression_models, collision_policy)
+
+
 def count_cells(
         regression_models: LinearRegressionsObjects,
-        genome_counts: biom.Table,
-        genome_lengths:  pandas.DataFrame,
+        genome_counts: BIOMV210DirFmt,
+        genome_lengths: TSVLengthDirectoryFormat,
         metadata: Metadata,
         read_length: int = 150,
         min_percent_coverage: float = 1,
         min_rsquared: float = 0.8,
-        output_metric: str = OGU_CELLS_PER_G_OF_SAMPLE_KEY) -> \
-        (biom.Table, list):
+        output_metric: str = OGU_CELLS_PER_G_OF_SAMPLE_KEY,
+        engine: str = PYSYNDNA_CELL_COUNT_ENGINE,
+        sample_block_size: int = None,
+        genome_coverages: BIOMV210DirFmt = None) -> \
+        (BIOMV210DirFmt, list):
 
     """Calculate number of cells of each genome per gram of sample.
 
@@ -81,10 +249,12 @@ def count_cells(
     ----------
     regression_models : LinearRegressions
         Linear regression models trained for each qualifying sample, and logs.
-    genome_counts : biom.Table
-        Feature table of genome counts.
-    genome_lengths : pandas.DataFrame
-        Lengths of microbial genomes.
+    genome_counts : BIOMV210DirFmt
+        Feature table of genome counts.  It is read from its biom file only
+        as needed, so that with sample_block_size it is never all in memory.
+    genome_lengths : TSVLengthDirectoryFormat
+        Lengths of microbial genomes.  Only the lengths of genomes that
+        appear in genome_counts are looked up.
     metadata : Metadata
         A Metadata file with sample information.
     read_length : int
@@ -98,33 +268,263 @@ def count_cells(
     output_metric : str
         The metric to output. One of OGU_CELLS_PER_G_OF_GDNA_KEY or
         OGU_CELLS_PER_G_OF_SAMPLE_KEY.
+    engine : str
+        PYSYNDNA_CELL_COUNT_ENGINE (the default) to calculate the cell
+        counts with pysyndna, or SPARSE_CELL_COUNT_ENGINE to calculate them
+        on just the nonzero counts of genome_counts, without ever making a
+        dense genome x sample matrix, which is what large tables need.
+    sample_block_size : int, optional
+        If given, genome_counts is read, and the cell counts calculated (as
+        SPARSE_CELL_COUNT_ENGINE does, whatever the engine) and written to
+        disk, this many samples at a time, so the memory used is bounded
+        by the block size rather than by the size of the table.
+    genome_coverages : BIOMV210DirFmt, optional
+        Percent coverages of the genomes of genome_counts in its samples,
+        as output by calc_genome_coverages.  If given, the coverages are
+        looked up in it rather than recalculated (so read_length is not
+        used), and the cell counts are calculated as
+        SPARSE_CELL_COUNT_ENGINE does, whatever the engine.  Can't be used
+        with sample_block_size.
 
     Returns
     -------
     cell_counts_objects_tuple: CellCountsObjects
         Tuple of cell counts and the log messages generated during the
-        calculation process. The cell counts are a biom.Table of cell counts
-        per gram for each genome in each sample. The log messages are a list of
-        log message strings generated during the calculation process.
+        calculation process. The cell counts are a biom file (in a
+        BIOMV210DirFmt) of cell counts per gram for each genome in each
+        sample. The log messages are a list of log message strings generated
+        during the calculation process.
     """
 
     metadata_df = _make_pysydna_metadata(metadata)
+    genome_counts_fp, genome_counts_biom, genome_lengths_df = \
+        _load_genome_counts_and_lengths(
+            genome_counts, genome_lengths, sample_block_size)
+
+    if sample_block_size is not None:
+        if genome_coverages is not None:
+            raise ValueError(
+                "Genome coverages can't be used with a sample block size")
+        return calc_ogu_cell_counts_blocked(
+            metadata_df, regression_models.linregs_dict, genome_counts_fp,
+            genome_lengths_df[LENGTH_KEY], read_length, min_percent_coverage,
+            min_rsquared, output_metric, sample_block_size)
+
+    if engine == SPARSE_CELL_COUNT_ENGINE or genome_coverages is not None:
+        genome_coverages_biom = None
+        if genome_coverages is not None:
+            genome_coverages_biom = biom_dir_fmt_to_table(genome_coverages)
+        cell_counts_biom, log_msgs_list = calc_ogu_cell_counts_sparse(
+            metadata_df, regression_models.linregs_dict, genome_counts_biom,
+            genome_lengths_df[LENGTH_KEY], read_length, min_percent_coverage,
+            min_rsquared, output_metric, genome_coverages_biom)
+    else:
+        genome_lengths_df.reset_index(inplace=True)
+        genome_lengths_df.columns = [OGU_ID_KEY, OGU_LEN_IN_BP_KEY]
 
-    genome_lengths.reset_index(inplace=True)
-    genome_lengths.columns = [OGU_ID_KEY, OGU_LEN_IN_BP_KEY]
+        cell_counts_biom, log_msgs_list = calc_ogu_cell_counts_biom(
+            metadata_df, regression_models.linregs_dict, genome_counts_biom,
+            genome_lengths_df, read_length, min_percent_coverage,
+            min_rsquared, output_metric)
 
-    cell_counts_biom, log_msgs_list = calc_ogu_cell_counts_biom(
-        metadata_df, regression_models.linregs_dict, genome_counts,
-        genome_lengths, read_length, min_percent_coverage, min_rsquared,
-        output_metric)
+    return table_to_biom_dir_fmt(cell_counts_biom), log_msgs_list
 
-    return cell_counts_biom, log_msgs_list
+
+def calc_genome_coverages(
+        genome_counts: BIOMV210DirFmt,
+        genome_lengths: TSVLengthDirectoryFormat,
+        read_length: int = 150) -> BIOMV210DirFmt:
+
+    """Calculate the percent coverage of each genome by each sample's reads.
+
+    Parameters
+    ----------
+    genome_counts : BIOMV210DirFmt
+        Feature table of genome counts.
+    genome_lengths : TSVLengthDirectoryFormat
+        Lengths of microbial genomes.  Only the lengths of genomes that
+        appear in genome_counts are looked up.
+    read_length : int
+        Length of sequencing reads in basepairs.
+
+    Returns
+    -------
+    genome_coverages : BIOMV210DirFmt
+        A biom file of the percent coverage of each genome in each sample,
+        with the ids of genome_counts, that count_cells can use instead of
+        recalculating the coverages.
+    """
+
+    _, genome_counts_biom, genome_lengths_df = \
+        _load_genome_counts_and_lengths(genome_counts, genome_lengths, None)
+    genome_coverages_biom = calc_percent_coverages_sparse(
+        genome_counts_biom, genome_lengths_df[LENGTH_KEY], read_length)
+    return table_to_biom_dir_fmt(genome_coverages_biom)
+
+
+def count_cells_gdna_and_sample(
+        regression_models: LinearRegressionsObjects,
+        genome_counts: BIOMV210DirFmt,
+        genome_lengths: TSVLengthDirectoryFormat,
+        metadata: Metadata,
+        read_length: int = 150,
+        min_percent_coverage: float = 1,
+        min_rsquared: float = 0.8,
+        sample_block_size: int = None) -> \
+        (BIOMV210DirFmt, BIOMV210DirFmt, list):
+
+    """Calculate cells of each genome per gram of gDNA and of sample at once.
+
+    Gives the same cell counts as running count_cells (with
+    SPARSE_CELL_COUNT_ENGINE) once with each of OGU_CELLS_PER_G_OF_GDNA_KEY
+    and OGU_CELLS_PER_G_OF_SAMPLE_KEY, but reads the inputs and calculates
+    the coverages and genomes per sample, which the two share, only once.
+
+    Parameters
+    ----------
+    regression_models : LinearRegressions
+        Linear regression models trained for each qualifying sample, and logs.
+    genome_counts : BIOMV210DirFmt
+        Feature table of genome counts.
+    genome_lengths : TSVLengthDirectoryFormat
+        Lengths of microbial genomes.
+    metadata : Metadata
+        A Metadata file with sample information.
+    read_length : int
+        Length of sequencing reads in basepairs.
+    min_percent_coverage : float
+        Minimum percent coverage of a genome by a sample's reads required for
+        that genome/sample to be included in the output.
+    min_rsquared : float
+        Minimum r-squared value required for a sample to be included in the
+        output.
+    sample_block_size : int, optional
+        As for count_cells.
+
+    Returns
+    -------
+    cell_counts_objects_tuple: tuple
+        Tuple of the cell counts per gram of gDNA, the cell counts per gram
+        of sample (each a biom file in a BIOMV210DirFmt), and the log
+        messages generated during the calculation process.
+    """
+
+    metadata_df = _make_pysydna_metadata(metadata)
+    genome_counts_fp, genome_counts_biom, genome_lengths_df = \
+        _load_genome_counts_and_lengths(
+            genome_counts, genome_lengths, sample_block_size)
+    output_metrics = [OGU_CELLS_PER_G_OF_GDNA_KEY,
+                      OGU_CELLS_PER_G_OF_SAMPLE_KEY]
+
+    if sample_block_size is not None:
+        cell_counts_dict, log_msgs_list = \
+            calc_ogu_cell_counts_blocked_metrics(
+                metadata_df, regression_models.linregs_dict,
+                genome_counts_fp, genome_lengths_df[LENGTH_KEY], read_length,
+                min_percent_coverage, min_rsquared, output_metrics,
+                sample_block_size)
+    else:
+        cell_counts_biom_dict, log_msgs_list = \
+            calc_ogu_cell_counts_sparse_metrics(
+                metadata_df, regression_models.linregs_dict,
+                genome_counts_biom, genome_lengths_df[LENGTH_KEY],
+                read_length, min_percent_coverage, min_rsquared,
+                output_metrics)
+        cell_counts_dict = {x: table_to_biom_dir_fmt(y)
+                            for x, y in cell_counts_biom_dict.items()}
+
+    return cell_counts_dict[OGU_CELLS_PER_G_OF_GDNA_KEY], \
+        cell_counts_dict[OGU_CELLS_PER_G_OF_SAMPLE_KEY], log_msgs_list
+
+
+def count_cells_sweep(
+        regression_models: LinearRegressionsObjects,
+        genome_counts: BIOMV210DirFmt,
+        genome_lengths: TSVLengthDirectoryFormat,
+        metadata: Metadata,
+        min_percent_coverages: list,
+        min_rsquareds: list,
+        read_length: int = 150,
+        output_metric: str = OGU_CELLS_PER_G_OF_SAMPLE_KEY) -> \
+        (BIOMV210DirFmt, list):
+
+    """Calculate cell counts for each combination of filter thresholds.
+
+    Parameters
+    ----------
+    regression_models : LinearRegressions
+        Linear regression models trained for each qualifying sample, and logs.
+    genome_counts : BIOMV210DirFmt
+        Feature table of genome counts.
+    genome_lengths : TSVLengthDirectoryFormat
+        Lengths of microbial genomes.
+    metadata : Metadata
+        A Metadata file with sample information.
+    min_percent_coverages : list
+        The minimum percent coverages (as for count_cells) to sweep.
+    min_rsquareds : list
+        The minimum r-squared values (as for count_cells) to sweep.
+    read_length : int
+        Length of sequencing reads in basepairs.
+    output_metric : str
+        The metric to output. One of OGU_CELLS_PER_G_OF_GDNA_KEY or
+        OGU_CELLS_PER_G_OF_SAMPLE_KEY.
+
+    Returns
+    -------
+    cell_counts_sweep_tuple: tuple
+        Tuple of a dictionary of cell counts, keyed by
+        make_sweep_key(min_rsquared, min_percent_coverage), holding for each
+        combination of thresholds the cell counts (as
+        SPARSE_CELL_COUNT_ENGINE calculates them) in a BIOMV210DirFmt, and a
+        summary of the samples and genomes each combination retains.  The
+        genome counts are loaded, and the coverages and cell counts
+        calculated, only once for all combinations.
+    """
+
+    metadata_df = _make_pysydna_metadata(metadata)
+    _, genome_counts_biom, genome_lengths_df = \
+        _load_genome_counts_and_lengths(genome_counts, genome_lengths, None)
+
+    cell_counts_biom_dict, summary_msgs_list = calc_ogu_cell_counts_sweep(
+        metadata_df, regression_models.linregs_dict, genome_counts_biom,
+        genome_lengths_df[LENGTH_KEY], read_length, min_percent_coverages,
+        min_rsquareds, output_metric)
+
+    cell_counts_dict = {x: table_to_biom_dir_fmt(y)
+                        for x, y in cell_counts_biom_dict.items()}
+    return cell_counts_dict, summary_msgs_list
+
+
+def _load_genome_counts_and_lengths(
+        genome_counts: BIOMV210DirFmt,
+        genome_lengths: TSVLengthDirectoryFormat,
+        sample_block_size: int) -> tuple:
+    # Without a sample block size the genome counts are loaded; with one,
+    # only their ids are read, and the counts are left to be read in blocks
+    genome_counts_fp = extract_fp_from_directory_format(
+        genome_counts, genome_counts.file)
+    genome_counts_biom = None
+    if sample_block_size is None:
+        genome_counts_biom = biom_dir_fmt_to_table(genome_counts)
+        genome_ids = genome_counts_biom.ids(axis='observation')
+    else:
+        genome_ids, _ = read_biom_ids(genome_counts_fp)
+
+    # Look up just the counted genomes' lengths (by binary search in the
+    # stored length index, if there is one) rather than joining pysyndna
+    # against the whole reference's lengths
+    genome_lengths_df = tsv_length_directory_format_to_df(
+        genome_lengths, genome_ids)
+    return genome_counts_fp, genome_counts_biom, genome_lengths_df
 
 
 def count_copies(
         genome_orf_counts: biom.Table,
-        genome_orf_coords: pandas.DataFrame,
-        metadata: Metadata) -> \
+        genome_orf_coords: CoordsDirectoryFormat,
+        metadata: Metadata,
+        engine: str = PYSYNDNA_COPY_COUNT_ENGINE,
+        sample_block_size: int = None) -> \
         (biom.Table, list):
 
     """Calculate the copies of each genome+ORF ssRNA per gram of sample.
@@ -134,13 +534,27 @@ def count_copies(
     genome_orf_counts : biom.Table
         A biom.Table with the number of reads per genome+ORF per sample, such
         as that output by woltka.
-    genome_orf_coords: pandas.DataFrame
-        A DataFrame with columns for OGU_ORF_ID_KEY, OGU_ORF_START_KEY, and
-        OGU_ORF_END_KEY.
+    genome_orf_coords: CoordsDirectoryFormat
+        The start and end coordinates of genome+ORFs.  Only the ORFs of
+        genomes that appear in genome_orf_counts are loaded from it.
     metadata : Metadata
         A Metadata object containing SAMPLE_ID_KEY as key and
         SAMPLE_IN_ALIQUOT_MASS_G_KEY, SSRNA_CONCENTRATION_NG_UL_KEY,
         ELUTE_VOL_UL_KEY, and TOTAL_BIOLOGICAL_READS_KEY.
+    engine : str
+        PYSYNDNA_COPY_COUNT_ENGINE (the default) to calculate the copies
+        with pysyndna, or SPARSE_COPY_COUNT_ENGINE to calculate them on just
+        the nonzero counts of genome_orf_counts, without ever making a dense
+        genome+ORF x sample matrix, which is what large tables need.
+    sample_block_size : int, optional
+        If given, the copies are calculated (by the engine) this many
+        samples at a time, and the blocks' results then combined.  If the
+        Q2_PYSYNDNA_CHECKPOINT_DIR environment variable names a local
+        directory, each block's results are stored there as soon as it is
+        finished, and blocks whose results with the same inputs it already
+        holds (from an earlier run that was interrupted) are loaded rather
+        than recalculated.  The directory can be deleted once the run is
+        done.
 
     Returns
     -------
@@ -152,11 +566,39 @@ def count_copies(
     """
 
     metadata_df = _make_pysydna_metadata(metadata)
+    # (only blocks of samples are checkpointed)
+    checkpoint_dir = None
+    if sample_block_size is not None:
+        checkpoint_dir = get_checkpoint_dir_from_env()
+
+    ogu_orf_ids = genome_orf_counts.ids(axis='observation')
+    ogu_orf_lens = None
+    # The sparse engine calculates with the ORFs' lengths, and checkpointed
+    # blocks are keyed by them (whatever the engine)
+    if engine == SPARSE_COPY_COUNT_ENGINE or checkpoint_dir is not None:
+        ogu_orf_lens = coords_directory_format_to_ogu_orf_lens(
+            genome_orf_coords, ogu_orf_ids)
+
+    if engine == SPARSE_COPY_COUNT_ENGINE:
+        def calc_func(sample_info_df, counts):
+            return calc_copies_of_ogu_orf_ssrna_per_g_sample_sparse(
+                sample_info_df, counts, ogu_orf_lens)
+    else:
+        # A count table usually touches only a small fraction of the
+        # reference's genomes, so load just the ORFs of those rather than
+        # the whole reference (their full OGU_ORF_IDs, which pysyndna needs,
+        # are only spelled out once the coords are cut down to them)
+        genome_ids = _get_genome_ids_from_ogu_orf_ids(ogu_orf_ids)
+        genome_orf_coords_df = coords_directory_format_to_df(
+            genome_orf_coords, genome_ids)
+
+        def calc_func(sample_info_df, counts):
+            return calc_copies_of_ogu_orf_ssrna_per_g_sample_from_dfs(
+                sample_info_df, counts, genome_orf_coords_df)
 
-    copies_of_ogu_orf_ssrna_per_g_sample, log_msgs_list = \
-        calc_copies_of_ogu_orf_ssrna_per_g_sample_from_dfs(
-            metadata_df,
-            genome_orf_counts,
-            genome_orf_coords)
+    if sample_block_size is None:
+        return calc_func(metadata_df, genome_orf_counts)
 
-    return copies_of_ogu_orf_ssrna_per_g_sample, log_msgs_list
+    return calc_copies_of_ogu_orf_ssrna_per_g_sample_chunked(
+        metadata_df, genome_orf_counts, ogu_orf_lens, calc_func, engine,
+        sample_block_size, checkpoint_dir)
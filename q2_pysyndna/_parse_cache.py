@@ -0,0 +1,216 @@
+import collections
+import copy
+import functools
+import hashlib
+import os
+import sys
+import threading
+from typing import Any, Callable, Hashable, Optional
+
+import numpy as np
+import pandas
+
+from q2_pysyndna._disk_cache import DiskCache, DiskCodec, \
+    get_disk_cache_from_env, get_disk_cache_key
+
+# Each input file is typically parsed once by its format's _validate_ and
+# again by the transformer that turns it into the view an action asked for.
+# Parsed results are therefore kept, keyed on the file's identity and
+# contents, so the second parse is a lookup.  The cache is bounded by both
+# an (estimated) memory ceiling and a number of entries, evicting the least
+# recently used results first; setting the ceiling to 0 turns it off.
+PARSE_CACHE_MAX_BYTES_ENV_VAR = "Q2_PYSYNDNA_PARSE_CACHE_MAX_BYTES"
+_DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+_DEFAULT_MAX_ENTRIES = 32
+# The content hash covers every byte of the file (an edit that keeps its size
+# and mtime must still miss the cache); it is read in chunks of this size.
+_HASH_CHUNK_BYTES = 1024 ** 2
+# Rough per-object overhead of a Python str, for estimating memory use
+_EST_BYTES_PER_STR = 60
+
+
+class ParseCache:
+    """A thread-safe, size-bounded LRU cache of parsed file contents."""
+
+    def __init__(self, max_bytes: int, max_entries: int):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, num_bytes: int):
+        with self._lock:
+            if key in self._entries:
+                self._total_bytes -= self._entries.pop(key)[1]
+            # Something bigger than the whole cache would only evict
+            # everything else and then be evicted itself
+            if num_bytes > self.max_bytes:
+                return
+
+            self._entries[key] = (value, num_bytes)
+            self._total_bytes += num_bytes
+            while self._total_bytes > self.max_bytes or \
+                    len(self._entries) > self.max_entries:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self._total_bytes -= evicted_bytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+
+def _get_max_bytes_from_env() -> int:
+    max_bytes_str = os.environ.get(PARSE_CACHE_MAX_BYTES_ENV_VAR)
+    if max_bytes_str is None:
+        return _DEFAULT_MAX_BYTES
+    try:
+        return int(max_bytes_str)
+    except ValueError:
+        raise ValueError(
+            f"{PARSE_CACHE_MAX_BYTES_ENV_VAR} must be an integer number of "
+            f"bytes, but is '{max_bytes_str}'")
+
+
+PARSE_CACHE = ParseCache(_get_max_bytes_from_env(), _DEFAULT_MAX_ENTRIES)
+# None unless the (opt-in) on-disk cache is configured
+DISK_CACHE = get_disk_cache_from_env()
+
+
+def cached_parse(fp: str, parse_func: Callable[[str], Any],
+                 copy_func: Callable[[Any], Any] = copy.deepcopy,
+                 cache: ParseCache = PARSE_CACHE,
+                 disk_codec: Optional[DiskCodec] = None,
+                 disk_cache: Optional[DiskCache] = None) -> Any:
+    """Parse a file, or return a copy of the result of parsing it before.
+
+    Parameters
+    ----------
+    fp : str
+        Path to the file to parse.
+    parse_func : Callable[[str], Any]
+        Function that parses the file at the path it is given.  Its
+        (qualified) name is part of the cache key, so different parsers of
+        the same file don't collide.
+    copy_func : Callable[[Any], Any]
+        Function that copies a parsed result, so callers can modify what
+        they get back without changing what is cached.  Defaults to
+        copy.deepcopy.
+    cache : ParseCache
+        The cache to use; defaults to the plugin-wide one.
+    disk_codec : DiskCodec, optional
+        How to store the parsed result in the on-disk cache.  If None (the
+        default), the result is only cached in memory.
+    disk_cache : DiskCache, optional
+        The on-disk cache to use; defaults to the one configured by the
+        environment, if any.  Only files inside QIIME 2 artifacts are cached
+        on disk; these are also cached in memory by their artifact's UUID,
+        rather than by a hash of their contents.
+
+    Returns
+    -------
+    parsed : Any
+        A copy of parse_func's result for the file's current contents.
+    """
+    if disk_cache is None:
+        disk_cache = DISK_CACHE
+    disk_key = None
+    if disk_codec is not None and disk_cache is not None:
+        disk_key = get_disk_cache_key(fp, parse_func)
+        if disk_key is not None:
+            parse_func = _make_disk_cached(
+                parse_func, disk_key, disk_codec, disk_cache)
+
+    if cache.max_bytes <= 0:
+        return parse_func(fp)
+
+    if disk_key is not None:
+        # An artifact's files never change, so the disk key (which names the
+        # artifact's UUID) identifies the contents without hashing them, and
+        # a hit in either cache never reads the file
+        key = (disk_key,)
+    else:
+        key = (parse_func.__module__, parse_func.__qualname__) + \
+            get_file_fingerprint(fp)
+    parsed = cache.get(key)
+    if parsed is None:
+        parsed = parse_func(fp)
+        cache.put(key, parsed, estimate_num_bytes(parsed))
+    return copy_func(parsed)
+
+
+def _make_disk_cached(parse_func: Callable[[str], Any], disk_key: str,
+                      disk_codec: DiskCodec,
+                      disk_cache: DiskCache) -> Callable[[str], Any]:
+    # wrapping keeps the in-memory cache key the same as for parse_func
+    @functools.wraps(parse_func)
+    def parse_via_disk_cache(fp):
+        parsed = disk_cache.get(disk_key, disk_codec)
+        if parsed is None:
+            parsed = parse_func(fp)
+            disk_cache.put(disk_key, parsed, disk_codec)
+        return parsed
+
+    return parse_via_disk_cache
+
+
+def get_file_fingerprint(fp: str) -> tuple:
+    """Identify a file by its resolved path, size, mtime and content hash.
+
+    Parameters
+    ----------
+    fp : str
+        Path to a file.
+
+    Returns
+    -------
+    fingerprint : tuple
+        (resolved path, size in bytes, mtime in ns, hex digest of a hash of
+        the file's full contents).
+    """
+    resolved_fp = os.path.realpath(str(fp))
+    stat = os.stat(resolved_fp)
+    file_size = stat.st_size
+
+    hasher = hashlib.blake2b()
+    with open(resolved_fp, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(_HASH_CHUNK_BYTES), b''):
+            hasher.update(chunk)
+
+    return resolved_fp, file_size, stat.st_mtime_ns, hasher.hexdigest()
+
+
+def estimate_num_bytes(obj: Any) -> int:
+    # Good enough for deciding what to evict; not an exact accounting
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (pandas.DataFrame, pandas.Series)):
+        return int(obj.memory_usage(index=True, deep=True).sum())
+    if isinstance(obj, str):
+        return _EST_BYTES_PER_STR + len(obj)
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(
+            estimate_num_bytes(k) + estimate_num_bytes(v)
+            for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        if len(obj) > 0 and all(isinstance(x, str) for x in obj):
+            return sys.getsizeof(obj) + \
+                sum(_EST_BYTES_PER_STR + len(x) for x in obj)
+        return sys.getsizeof(obj) + sum(estimate_num_bytes(x) for x in obj)
+    return sys.getsizeof(obj)
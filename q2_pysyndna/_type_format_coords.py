@@ -1,16 +1,50 @@
+import os
+from typing import Iterable, Optional
+
+import numpy as np
 import pandas
 from qiime2.plugin import SemanticType, ValidationError
 import qiime2.plugin.model as model
 from q2_types.feature_data import FeatureData
 
-from pysyndna import read_ogu_orf_coords_to_df, \
-    validate_and_cast_ogu_orf_coords_df
+from pysyndna import validate_and_cast_ogu_orf_coords_df, OGU_ID_KEY
+from pysyndna.src.quant_orfs import \
+    OGU_ORF_ID_KEY, OGU_ORF_START_KEY, OGU_ORF_END_KEY
+from q2_pysyndna._coords_parser import CoordsArrays, parse_coords_fp, \
+    validate_coords_fp_sample
+from q2_pysyndna._disk_cache import DiskCodec
+from q2_pysyndna._parse_cache import cached_parse
+from q2_pysyndna._type_format_pysyndna_log import \
+    extract_fp_from_directory_format
+
+# names of the CoordsDirectoryFormat fields holding the parsed arrays
+_GENOME_IDS = 'genome_ids'
+_GENOME_CODES = 'genome_codes'
+_ORF_IDS = 'orf_ids'
+_STARTS = 'starts'
+_ENDS = 'ends'
+_COORDS_ARRAY_FIELDS = [_GENOME_IDS, _GENOME_CODES, _ORF_IDS, _STARTS, _ENDS]
+
+# column of the coords DataFrame holding each ORF's number within its genome
+# (the genome is in the OGU_ID_KEY column)
+ORF_NUM_KEY = 'orf_num'
+# column of the coords DataFrame holding each ORF's length in bp
+ORF_LEN_KEY = 'orf_len'
+_INT_DTYPES = [np.int8, np.int16, np.int32, np.int64]
+# Rows are formatted (with one %-format per block) and written in buffers of
+# about this many bytes.
+_WRITE_BUFFER_BYTES = 32 * 1024 * 1024
+_ORF_LINE_TEMPLATE = '%d\t%d\t%d\n'
+
+# columns of the block index: one row per genome block, holding the block's
+# genome code and the row of the coords arrays at which the block starts
+_BLOCK_GENOME_CODE_COL = 0
+_BLOCK_ROW_START_COL = 1
+_NUM_BLOCK_INDEX_COLS = 2
 
 Coords = SemanticType('Coords', variant_of=FeatureData.field['type'])
 
 
-# The text file format is rather specialized so its parsing and validation is
-# punted to the pysyndna library, which really knows and cares :)
 class CoordsFormat(model.TextFileFormat):
     """Text coords format used by woltka
 
@@ -27,24 +61,593 @@ class CoordsFormat(model.TextFileFormat):
     """
 
     def _validate_(self, level):
-        _ = coords_fp_to_df(str(self.path))
+        # Reference coords files can be many GB, so "min" validation checks
+        # only a bounded sample of the file; "max" parses all of it (but
+        # skips building the DataFrame, which adds nothing to the check).
+        fp = str(self.path)
+        if level == 'min':
+            try:
+                validate_coords_fp_sample(fp)
+            except OSError as e:
+                raise ValidationError(
+                    f"File {fp} is malformed or missing: {e}")
+        else:
+            _ = coords_fp_to_arrays(fp)
+
+
+class CoordsArrayFormat(model.BinaryFileFormat):
+    """Represents one column of parsed coords as a numpy .npy array."""
+
+    def _validate_(self, level):
+        # Reading just the header (by memory-mapping) confirms it is an
+        # array file without pulling a potentially huge array into memory.
+        try:
+            _ = np.load(str(self.path), mmap_mode='r', allow_pickle=False)
+        except (OSError, ValueError) as e:
+            raise ValidationError(
+                f"File {self.path} is not a numpy array file: {e}")
+
+
+class CoordsDirectoryFormat(model.SingleFileDirectoryFormatBase):
+    """Represents a coords text file plus its parsed columnar arrays.
+
+    The arrays are optional (artifacts created before they existed have only
+    the text file) but, when present, hold the whole parsed table: the
+    distinct genome IDs as a fixed-width string array, and, per ORF, an
+    integer code into those genome IDs, the ORF id, and its start and end.
+    The optional block index records where each genome's block of rows starts
+    in those arrays, so one genome's ORFs can be read without scanning them,
+    and the optional ORF lengths array holds each ORF's length so it needn't
+    be recomputed from the start and end every time the coords are loaded.
+
+    The text file is its single file (as when it was the only one), so a
+    plain coords file is still imported without naming an input format,
+    and the CoordsFormat transformer then adds the arrays.
+    """
+
+    file = model.File(r'coords.txt', format=CoordsFormat)
+    genome_ids = model.File(
+        r'coords_genome_ids.npy', format=CoordsArrayFormat, optional=True)
+    genome_codes = model.File(
+        r'coords_genome_codes.npy', format=CoordsArrayFormat, optional=True)
+    orf_ids = model.File(
+        r'coords_orf_ids.npy', format=CoordsArrayFormat, optional=True)
+    starts = model.File(
+        r'coords_starts.npy', format=CoordsArrayFormat, optional=True)
+    ends = model.File(
+        r'coords_ends.npy', format=CoordsArrayFormat, optional=True)
+    block_index = model.File(
+        r'coords_block_index.npy', format=CoordsArrayFormat, optional=True)
+    orf_lens = model.File(
+        r'coords_orf_lens.npy', format=CoordsArrayFormat, optional=True)
+
+    def _validate_(self, level):
+        array_fps = _get_coords_array_fps(self)
+        block_index_fp = extract_fp_from_directory_format(
+            self, self.block_index)
+        orf_lens_fp = extract_fp_from_directory_format(self, self.orf_lens)
+        num_present = sum(os.path.exists(x) for x in array_fps.values())
+        if num_present == 0:
+            if os.path.exists(block_index_fp):
+                raise ValidationError(
+                    "Coords block index must not be present without the "
+                    "coords arrays.")
+            if os.path.exists(orf_lens_fp):
+                raise ValidationError(
+                    "Coords ORF lengths must not be present without the "
+                    "coords arrays.")
+            return
+        if num_present != len(array_fps):
+            raise ValidationError(
+                "Coords arrays must be either all present or all absent.")
+
+        arrays = {k: np.load(v, mmap_mode='r', allow_pickle=False)
+                  for k, v in array_fps.items()}
+        num_rows = len(arrays[_GENOME_CODES])
+        for key in [_ORF_IDS, _STARTS, _ENDS]:
+            if len(arrays[key]) != num_rows:
+                raise ValidationError(
+                    f"Coords arrays must all have the same length, but "
+                    f"{_GENOME_CODES} has {num_rows} entries and {key} has "
+                    f"{len(arrays[key])}")
+
+        if level == 'max' and num_rows > 0:
+            codes = arrays[_GENOME_CODES]
+            if codes.min() < 0 or codes.max() >= len(arrays[_GENOME_IDS]):
+                raise ValidationError(
+                    "Coords genome codes must index into the genome IDs.")
+
+        if os.path.exists(block_index_fp):
+            block_index = np.load(
+                block_index_fp, mmap_mode='r', allow_pickle=False)
+            _validate_block_index(block_index, arrays, level)
+
+        if os.path.exists(orf_lens_fp):
+            orf_lens = np.load(orf_lens_fp, mmap_mode='r', allow_pickle=False)
+            if len(orf_lens) != num_rows:
+                raise ValidationError(
+                    f"Coords ORF lengths must have one entry per ORF, but "
+                    f"there are {num_rows} ORFs and {len(orf_lens)} lengths")
+            if level == 'max' and num_rows > 0 and orf_lens.min() < 1:
+                raise ValidationError("Coords ORF lengths must be positive.")
 
 
-CoordsDirectoryFormat = model.SingleFileDirectoryFormat(
-    'CoordsDirectoryFormat', 'coords.txt', CoordsFormat)
+def _validate_block_index(block_index, arrays, level):
+    if block_index.ndim != 2 or \
+            block_index.shape[1] != _NUM_BLOCK_INDEX_COLS:
+        raise ValidationError(
+            f"Coords block index must have {_NUM_BLOCK_INDEX_COLS} columns, "
+            f"but has shape {block_index.shape}")
 
+    if level == 'max' and len(block_index) > 0:
+        block_codes = block_index[:, _BLOCK_GENOME_CODE_COL]
+        row_starts = block_index[:, _BLOCK_ROW_START_COL]
+        if block_codes.min() < 0 or \
+                block_codes.max() >= len(arrays[_GENOME_IDS]):
+            raise ValidationError(
+                "Coords block index genome codes must index into the "
+                "genome IDs.")
+        if row_starts[0] != 0 or np.any(np.diff(row_starts) < 0) or \
+                row_starts[-1] > len(arrays[_GENOME_CODES]):
+            raise ValidationError(
+                "Coords block index row starts must begin at 0 and increase "
+                "through the coords arrays.")
 
-def coords_fp_to_df(fp: str) -> pandas.DataFrame:
+
+# WoL reference coords files run to tens of millions of ORF lines, so rather
+# than reading them line-by-line (as pysyndna's read_ogu_orf_coords_to_df
+# does) they are parsed in buffered passes straight into numpy arrays, with
+# large files split across processes.
+def coords_fp_to_df(fp: str, n_jobs: Optional[int] = None) -> \
+        pandas.DataFrame:
+    return coords_arrays_to_df(coords_fp_to_arrays(fp, n_jobs))
+
+
+def coords_fp_to_arrays(fp: str, n_jobs: Optional[int] = None) -> \
+        CoordsArrays:
+    # The cached arrays are read-only and shared rather than copied (they
+    # can be GB); only the genome ID list is copied.
+    return cached_parse(
+        fp, lambda x: _parse_coords_fp_read_only(x, n_jobs),
+        copy_func=lambda x: x._replace(genome_ids=list(x.genome_ids)),
+        disk_codec=_COORDS_ARRAYS_CODEC)
+
+
+def _parse_coords_fp_read_only(fp: str, n_jobs: Optional[int]) -> \
+        CoordsArrays:
     try:
-        df = read_ogu_orf_coords_to_df(fp)
-    except Exception as e:
+        coords_arrays = parse_coords_fp(fp, n_jobs)
+    except OSError as e:
         raise ValidationError(f"File {fp} is malformed or missing: {e}")
-    checked_df = validate_and_cast_ogu_orf_coords_df(df)
-    return checked_df
+
+    for curr_array in coords_arrays:
+        if isinstance(curr_array, np.ndarray):
+            curr_array.flags.writeable = False
+    return coords_arrays
+
+
+def _coords_arrays_to_columns(coords_arrays: CoordsArrays) -> tuple:
+    columns = {k: v for k, v in coords_arrays._asdict().items()
+               if v is not None}
+    columns['genome_ids'] = np.array(coords_arrays.genome_ids, dtype=str)
+    return columns, {}
+
+
+def _columns_to_coords_arrays(columns: dict, _) -> CoordsArrays:
+    # the other columns stay memory-mapped (and so read-only)
+    return CoordsArrays(**dict(
+        columns, genome_ids=columns['genome_ids'].tolist()))
+
+
+_COORDS_ARRAYS_CODEC = DiskCodec(to_columns=_coords_arrays_to_columns,
+                                 from_columns=_columns_to_coords_arrays)
+
+
+def coords_arrays_to_df(coords_arrays: CoordsArrays) -> pandas.DataFrame:
+    """Build the coords DataFrame pysyndna expects from parsed coords arrays.
+
+    Parameters
+    ----------
+    coords_arrays : CoordsArrays
+        Parsed (or memory-mapped) coords arrays.
+
+    Returns
+    -------
+    ogu_orf_coords_df : pandas.DataFrame
+        A DataFrame with columns for OGU_ORF_ID_KEY (as
+        "<genome id>_<orf num>"), OGU_ORF_START_KEY, and OGU_ORF_END_KEY.
+    """
+    # Each ORF's id is its genome's id, held once per block, joined to its
+    # ORF number, so no per-row genome column is built along the way
+    genome_id_prefixes = np.array(
+        [f'{x}_' for x in coords_arrays.genome_ids], dtype=object)
+    ogu_orf_ids = \
+        np.repeat(genome_id_prefixes, coords_arrays.block_sizes) + \
+        np.asarray(coords_arrays.orf_ids).astype(str).astype(object)
+
+    return validate_and_cast_ogu_orf_coords_df(pandas.DataFrame({
+        OGU_ORF_ID_KEY: ogu_orf_ids,
+        OGU_ORF_START_KEY: _to_narrowest_int(coords_arrays.starts),
+        OGU_ORF_END_KEY: _to_narrowest_int(coords_arrays.ends)}))
+
+
+def _coords_arrays_to_compact_df(
+        coords_arrays: CoordsArrays) -> pandas.DataFrame:
+    # The compact form, used internally, has a categorical OGU_ID_KEY column
+    # holding each ORF's genome, and ORF_NUM_KEY, OGU_ORF_START_KEY,
+    # OGU_ORF_END_KEY and ORF_LEN_KEY columns each in the narrowest integer
+    # dtype that holds its values.  The ORF lengths are computed only if
+    # coords_arrays doesn't already hold them.
+    # Genome IDs repeat on every ORF row, so hold them as categorical codes
+    # rather than one string object per row.
+    block_codes, unique_genome_ids = pandas.factorize(
+        pandas.Series(coords_arrays.genome_ids, dtype=object))
+    genomes = pandas.Categorical.from_codes(
+        np.repeat(block_codes, coords_arrays.block_sizes),
+        categories=pandas.Index(unique_genome_ids, dtype=object))
+
+    orf_lens = coords_arrays.orf_lens
+    if orf_lens is None:
+        orf_lens = calc_orf_lens(coords_arrays.starts, coords_arrays.ends)
+
+    return pandas.DataFrame({
+        OGU_ID_KEY: genomes,
+        ORF_NUM_KEY: _to_narrowest_int(coords_arrays.orf_ids),
+        OGU_ORF_START_KEY: _to_narrowest_int(coords_arrays.starts),
+        OGU_ORF_END_KEY: _to_narrowest_int(coords_arrays.ends),
+        ORF_LEN_KEY: _to_narrowest_int(orf_lens)})
+
+
+def calc_orf_lens(starts, ends) -> np.ndarray:
+    # ORFs on the reverse strand have start > end; either way the
+    # coordinates are inclusive.
+    return np.abs(np.asarray(ends) - np.asarray(starts)) + 1
+
+
+def _to_narrowest_int(values) -> np.ndarray:
+    values = np.asarray(values)
+    for dtype in _INT_DTYPES[:-1]:
+        dtype_info = np.iinfo(dtype)
+        if len(values) == 0 or (values.min() >= dtype_info.min and
+                                values.max() <= dtype_info.max):
+            return values.astype(dtype)
+    return values.astype(_INT_DTYPES[-1])
+
+
+def coords_format_to_coords_directory_format(
+        ff: CoordsFormat) -> CoordsDirectoryFormat:
+    coords_arrays = coords_fp_to_arrays(str(ff))
+
+    result = CoordsDirectoryFormat()
+    result.file.write_data(ff, CoordsFormat)
+    write_coords_arrays(result, coords_arrays)
+    return result
+
+
+def coords_directory_format_to_df(
+        data: CoordsDirectoryFormat,
+        genome_ids: Optional[Iterable[str]] = None) -> pandas.DataFrame:
+    """Load the coords in a directory format, optionally for some genomes.
+
+    Parameters
+    ----------
+    data : CoordsDirectoryFormat
+        A coords directory format, with or without the parsed arrays.
+    genome_ids : Iterable[str], optional
+        If given, only the ORFs of these genomes are loaded; genome IDs not
+        in the coords are ignored.  If None (the default), all ORFs are.
+
+    Returns
+    -------
+    ogu_orf_coords_df : pandas.DataFrame
+        A DataFrame with columns for OGU_ORF_ID_KEY (as
+        "<genome id>_<orf num>"), OGU_ORF_START_KEY, and OGU_ORF_END_KEY.
+    """
+    return coords_arrays_to_df(_load_coords_arrays(data, genome_ids))
+
+
+def coords_directory_format_to_ogu_orf_lens(
+        data: CoordsDirectoryFormat,
+        ogu_orf_ids: Iterable[str]) -> np.ndarray:
+    """Look up the lengths of genome+ORFs in a coords directory format.
+
+    Parameters
+    ----------
+    data : CoordsDirectoryFormat
+        A coords directory format, with or without the parsed arrays (and
+        with or without the stored ORF lengths).
+    ogu_orf_ids : Iterable[str]
+        OGU_ORF_IDs, as "<genome id>_<orf num>".  Only the ORFs of their
+        genomes are loaded.
+
+    Returns
+    -------
+    ogu_orf_lens : np.ndarray
+        The length in bp of each of ogu_orf_ids (as floats), or nan for
+        those not in the coords.
+    """
+    genome_and_orf_ids = pandas.Series(
+        ogu_orf_ids, dtype=object).str.rsplit('_', n=1)
+    orf_genome_ids = genome_and_orf_ids.str[0]
+    orf_nums = pandas.to_numeric(
+        genome_and_orf_ids.str[1], errors='coerce').to_numpy(dtype=float)
+    coords_arrays = _load_coords_arrays(data, orf_genome_ids.unique())
+
+    orf_lens = coords_arrays.orf_lens
+    if orf_lens is None:
+        orf_lens = calc_orf_lens(coords_arrays.starts, coords_arrays.ends)
+
+    # Each ORF is keyed by its genome's code and its number, and the ORF
+    # ids' keys are found among the coords' sorted keys, rather than
+    # building and merging the DataFrames of their full OGU_ORF_IDs
+    block_codes, unique_genome_ids = pandas.factorize(
+        pandas.Series(coords_arrays.genome_ids, dtype=object))
+    coords_keys = np.repeat(block_codes, coords_arrays.block_sizes).astype(
+        np.int64)
+    orf_codes = pandas.Index(unique_genome_ids).get_indexer(orf_genome_ids)
+    is_valid = (orf_codes >= 0) & (orf_nums >= 0) & \
+        (orf_nums == np.floor(orf_nums))
+    num_keys_per_genome = int(max(
+        np.max(coords_arrays.orf_ids, initial=0),
+        np.max(orf_nums[is_valid], initial=0))) + 1
+    coords_keys = coords_keys * num_keys_per_genome + coords_arrays.orf_ids
+    orf_keys = orf_codes[is_valid].astype(np.int64) * num_keys_per_genome + \
+        orf_nums[is_valid].astype(np.int64)
+
+    sort_order = np.argsort(coords_keys, kind='stable')
+    sorted_keys = coords_keys[sort_order]
+    found_nums = np.minimum(np.searchsorted(sorted_keys, orf_keys),
+                            max(len(sorted_keys) - 1, 0))
+    is_found = np.zeros(len(orf_keys), dtype=bool)
+    if len(sorted_keys) > 0:
+        is_found = sorted_keys[found_nums] == orf_keys
+
+    result = np.full(len(orf_nums), np.nan)
+    valid_nums = np.flatnonzero(is_valid)
+    result[valid_nums[is_found]] = np.asarray(orf_lens)[
+        sort_order[found_nums[is_found]]]
+    return result
+
+
+def _load_coords_arrays(
+        data: CoordsDirectoryFormat,
+        genome_ids: Optional[Iterable[str]]) -> CoordsArrays:
+    coords_arrays = read_coords_arrays(data, genome_ids)
+    if coords_arrays is None:
+        # Only the text is available, so it has to be parsed in full
+        coords_fp = extract_fp_from_directory_format(data, data.file)
+        coords_arrays = coords_fp_to_arrays(coords_fp)
+        if genome_ids is not None:
+            coords_arrays = _subset_coords_arrays(coords_arrays, genome_ids)
+    return coords_arrays
+
+
+def write_coords_arrays(data: CoordsDirectoryFormat,
+                        coords_arrays: CoordsArrays):
+    # Genome IDs repeat across blocks only if a genome's header appears more
+    # than once in the text, but a dictionary plus per-ORF codes handles that
+    # and is what a categorical column needs anyway.
+    block_codes, unique_genome_ids = pandas.factorize(
+        pandas.Series(coords_arrays.genome_ids, dtype=object))
+    genome_codes = np.repeat(
+        block_codes.astype(np.int32), coords_arrays.block_sizes)
+    block_index = np.column_stack([
+        block_codes.astype(np.int64),
+        np.cumsum(coords_arrays.block_sizes) - coords_arrays.block_sizes])
+
+    orf_lens = coords_arrays.orf_lens
+    if orf_lens is None:
+        orf_lens = calc_orf_lens(coords_arrays.starts, coords_arrays.ends)
+
+    arrays = {
+        _GENOME_IDS: np.array(unique_genome_ids, dtype=str),
+        _GENOME_CODES: genome_codes,
+        _ORF_IDS: coords_arrays.orf_ids,
+        _STARTS: coords_arrays.starts,
+        _ENDS: coords_arrays.ends}
+    for key, fp in _get_coords_array_fps(data).items():
+        np.save(fp, arrays[key], allow_pickle=False)
+    np.save(extract_fp_from_directory_format(data, data.block_index),
+            block_index, allow_pickle=False)
+    np.save(extract_fp_from_directory_format(data, data.orf_lens),
+            orf_lens, allow_pickle=False)
+
+
+def read_coords_arrays(
+        data: CoordsDirectoryFormat,
+        genome_ids: Optional[Iterable[str]] = None) -> Optional[CoordsArrays]:
+    """Memory-map the parsed arrays stored with a coords text file.
+
+    Parameters
+    ----------
+    data : CoordsDirectoryFormat
+        A coords directory format, with or without the parsed arrays.
+    genome_ids : Iterable[str], optional
+        If given, only the blocks of these genomes are read (into memory
+        rather than memory-mapped); genome IDs not in the coords are ignored.
+        If None (the default), all blocks are.
+
+    Returns
+    -------
+    coords_arrays : CoordsArrays or None
+        The memory-mapped arrays, or None if the directory holds only the
+        coords text file.
+    """
+    array_fps = _get_coords_array_fps(data)
+    if not all(os.path.exists(x) for x in array_fps.values()):
+        return None
+
+    arrays = {k: np.load(v, mmap_mode='r', allow_pickle=False)
+              for k, v in array_fps.items()}
+    num_rows = len(arrays[_GENOME_CODES])
+
+    block_index_fp = extract_fp_from_directory_format(data, data.block_index)
+    if os.path.exists(block_index_fp):
+        block_index = np.load(block_index_fp, allow_pickle=False)
+        block_codes = block_index[:, _BLOCK_GENOME_CODE_COL]
+        block_starts = block_index[:, _BLOCK_ROW_START_COL]
+    else:
+        # Arrays written without an index: rebuild the block structure from
+        # the runs of equal genome codes
+        genome_codes = arrays[_GENOME_CODES]
+        block_starts = np.flatnonzero(
+            np.concatenate([[True], genome_codes[1:] != genome_codes[:-1]]))
+        block_codes = genome_codes[block_starts]
+    block_sizes = np.diff(np.append(block_starts, num_rows))
+
+    # Artifacts written before the ORF lengths were stored lack them
+    orf_lens_fp = extract_fp_from_directory_format(data, data.orf_lens)
+    orf_lens = None
+    if os.path.exists(orf_lens_fp):
+        orf_lens = np.load(orf_lens_fp, mmap_mode='r', allow_pickle=False)
+
+    if genome_ids is None:
+        return CoordsArrays(
+            genome_ids=arrays[_GENOME_IDS][block_codes].tolist(),
+            block_sizes=block_sizes, orf_ids=arrays[_ORF_IDS],
+            starts=arrays[_STARTS], ends=arrays[_ENDS], orf_lens=orf_lens)
+
+    wanted_codes = np.flatnonzero(
+        np.isin(arrays[_GENOME_IDS], list(genome_ids)))
+    is_wanted = np.isin(block_codes, wanted_codes)
+    return _select_coords_blocks(
+        arrays[_ORF_IDS], arrays[_STARTS], arrays[_ENDS], orf_lens,
+        arrays[_GENOME_IDS][block_codes[is_wanted]].tolist(),
+        block_starts[is_wanted], block_sizes[is_wanted])
+
+
+def _subset_coords_arrays(coords_arrays: CoordsArrays,
+                          genome_ids: Iterable[str]) -> CoordsArrays:
+    block_sizes = coords_arrays.block_sizes
+    block_starts = np.cumsum(block_sizes) - block_sizes
+    is_wanted = np.isin(
+        np.array(coords_arrays.genome_ids, dtype=object), list(genome_ids))
+    return _select_coords_blocks(
+        coords_arrays.orf_ids, coords_arrays.starts, coords_arrays.ends,
+        coords_arrays.orf_lens,
+        [x for x, y in zip(coords_arrays.genome_ids, is_wanted) if y],
+        block_starts[is_wanted], block_sizes[is_wanted])
+
+
+def _select_coords_blocks(orf_ids, starts, ends, orf_lens, genome_ids,
+                          block_starts, block_sizes) -> CoordsArrays:
+    # Gather the rows of the selected blocks in order; with memory-mapped
+    # inputs only the pages holding those rows are read from disk.
+    block_sizes = np.asarray(block_sizes, dtype=np.int64)
+    row_offsets = np.repeat(
+        np.asarray(block_starts, dtype=np.int64) -
+        (np.cumsum(block_sizes) - block_sizes), block_sizes)
+    rows = np.arange(len(row_offsets), dtype=np.int64) + row_offsets
+
+    return CoordsArrays(
+        genome_ids=list(genome_ids), block_sizes=block_sizes,
+        orf_ids=np.asarray(orf_ids[rows]), starts=np.asarray(starts[rows]),
+        ends=np.asarray(ends[rows]),
+        orf_lens=None if orf_lens is None else np.asarray(orf_lens[rows]))
+
+
+def _get_coords_array_fps(data: CoordsDirectoryFormat) -> dict:
+    return {x: extract_fp_from_directory_format(data, getattr(data, x))
+            for x in _COORDS_ARRAY_FIELDS}
 
 
 def df_to_coords_format(df):
-    df = validate_and_cast_ogu_orf_coords_df(df)
+    # Accepts either the compact coords DataFrame or the pysyndna one
+    if ORF_NUM_KEY in df.columns:
+        coords_arrays = _compact_coords_df_to_coords_arrays(df)
+    else:
+        df = validate_and_cast_ogu_orf_coords_df(df)
+        coords_arrays = _ogu_orf_coords_df_to_coords_arrays(df)
+
     ff = CoordsFormat()
-    df.to_csv(str(ff), sep='\t', header=False, index=False)
+    write_coords_fp(str(ff), coords_arrays)
     return ff
+
+
+def write_coords_fp(fp: str, coords_arrays: CoordsArrays):
+    """Write coords arrays as a WoL-format coords text file.
+
+    Parameters
+    ----------
+    fp : str
+        Path to write to.
+    coords_arrays : CoordsArrays
+        The genome blocks and ORF rows to write, in order.
+    """
+    with open(fp, 'w') as fh:
+        buffer = []
+        buffered_bytes = 0
+        row_start = 0
+        for genome_id, block_size in zip(coords_arrays.genome_ids,
+                                         coords_arrays.block_sizes.tolist()):
+            row_stop = row_start + block_size
+            block_values = np.column_stack([
+                coords_arrays.orf_ids[row_start:row_stop],
+                coords_arrays.starts[row_start:row_stop],
+                coords_arrays.ends[row_start:row_stop]]).ravel().tolist()
+            block_text = f">{genome_id}\n" + \
+                (_ORF_LINE_TEMPLATE * block_size) % tuple(block_values)
+
+            buffer.append(block_text)
+            buffered_bytes += len(block_text)
+            if buffered_bytes >= _WRITE_BUFFER_BYTES:
+                fh.write(''.join(buffer))
+                buffer = []
+                buffered_bytes = 0
+            row_start = row_stop
+
+        fh.write(''.join(buffer))
+
+
+def _compact_coords_df_to_coords_arrays(
+        coords_df: pandas.DataFrame) -> CoordsArrays:
+    try:
+        values = coords_df[
+            [ORF_NUM_KEY, OGU_ORF_START_KEY, OGU_ORF_END_KEY]].to_numpy(
+            dtype=np.int64)
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValidationError(
+            f"Coords DataFrame must have integer {ORF_NUM_KEY}, "
+            f"{OGU_ORF_START_KEY} and {OGU_ORF_END_KEY} columns: {e}")
+
+    return _group_coords_by_genome(
+        coords_df[OGU_ID_KEY], values[:, 0], values[:, 1], values[:, 2])
+
+
+def _ogu_orf_coords_df_to_coords_arrays(
+        ogu_orf_coords_df: pandas.DataFrame) -> CoordsArrays:
+    # OGU_ORF_IDs are "<genome id>_<orf num>", e.g. G000005825_1
+    id_parts = ogu_orf_coords_df[OGU_ORF_ID_KEY].astype(str).str.rsplit(
+        '_', n=1, expand=True)
+    orf_nums = None
+    if id_parts.shape[1] == 2:
+        orf_nums = pandas.to_numeric(id_parts[1], errors='coerce')
+    if orf_nums is None or orf_nums.isna().any() or \
+            orf_nums.dtype.kind not in 'iu':
+        raise ValidationError(
+            f"{OGU_ORF_ID_KEY} values must all be '<genome id>_<integer ORF "
+            f"number>'")
+
+    return _group_coords_by_genome(
+        id_parts[0], orf_nums.to_numpy(dtype=np.int64),
+        ogu_orf_coords_df[OGU_ORF_START_KEY].to_numpy(dtype=np.int64),
+        ogu_orf_coords_df[OGU_ORF_END_KEY].to_numpy(dtype=np.int64))
+
+
+def _group_coords_by_genome(genomes, orf_ids, starts, ends) -> CoordsArrays:
+    # One block per genome, in order of first appearance, holding that
+    # genome's rows in their original order.
+    genome_codes, unique_genome_ids = pandas.factorize(genomes)
+    if np.any(genome_codes < 0):
+        raise ValidationError("Coords genome IDs must not be missing.")
+    if len(genome_codes) > 1 and np.any(np.diff(genome_codes) < 0):
+        row_order = np.argsort(genome_codes, kind='stable')
+        genome_codes = genome_codes[row_order]
+        orf_ids, starts, ends = \
+            orf_ids[row_order], starts[row_order], ends[row_order]
+
+    return CoordsArrays(
+        genome_ids=[str(x) for x in unique_genome_ids],
+        block_sizes=np.bincount(
+            genome_codes, minlength=len(unique_genome_ids)).astype(np.int64),
+        orf_ids=orf_ids, starts=starts, ends=ends)
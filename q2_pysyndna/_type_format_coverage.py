@@ -0,0 +1,8 @@
+from qiime2.plugin import SemanticType
+from q2_types.feature_table import FeatureTable
+
+# The percent of each genome (feature) that each sample's reads cover, which
+# depends only on the genome counts, genome lengths and read length.  Like
+# other feature tables, it is stored as a biom table (in a BIOMV210DirFmt).
+PercentCoverage = SemanticType(
+    'PercentCoverage', variant_of=FeatureTable.field['content'])
@@ -1,12 +1,27 @@
+import collections
+import os
+from typing import Iterable, Optional
+
+import numpy as np
 import pandas
 from qiime2.plugin import SemanticType, ValidationError
 import qiime2.plugin.model as model
 from q2_types.feature_data import FeatureData
 
+from q2_pysyndna._compression import open_maybe_compressed
+from q2_pysyndna._disk_cache import DATAFRAME_CODEC
+from q2_pysyndna._parse_cache import cached_parse
+from q2_pysyndna._type_format_pysyndna_log import \
+    extract_fp_from_directory_format
+
 FEATURE_NAME_KEY = 'Feature ID'
 LENGTH_KEY = 'length'
 OBSERVATION_KEY = 'observation'
 
+# A genome-length lookup table: feature IDs sorted ascending (as a
+# fixed-width string array) and their lengths, aligned, as int64.
+LengthIndex = collections.namedtuple("LengthIndex", ["ids", "lengths"])
+
 Length = SemanticType('Length', variant_of=FeatureData.field['type'])
 
 
@@ -14,29 +29,243 @@ class TSVLengthFormat(model.TextFileFormat):
     """Format for a 2 column TSV file without a header.
 
     There must be at least one line of data and second column must be integers.
+    The file may be gzip-, xz- or zstd-compressed.
     """
 
     def _validate_(self, level):
         _ = length_fp_to_df(str(self.path))
 
 
-TSVLengthDirectoryFormat = model.SingleFileDirectoryFormat(
-    'TSVLengthDirectoryFormat', 'lengths.tsv', TSVLengthFormat)
+class LengthArrayFormat(model.BinaryFileFormat):
+    """Represents one column of a length index as a numpy .npy array."""
+
+    def _validate_(self, level):
+        # Memory-mapping reads just the header
+        try:
+            _ = np.load(str(self.path), mmap_mode='r', allow_pickle=False)
+        except (OSError, ValueError) as e:
+            raise ValidationError(
+                f"File {self.path} is not a numpy array file: {e}")
+
+
+class TSVLengthDirectoryFormat(model.SingleFileDirectoryFormatBase):
+    """Represents a lengths TSV file plus an optional sorted length index.
+
+    The index (absent from artifacts created before it existed) holds the
+    feature IDs sorted, as a fixed-width string array, and their lengths in
+    an aligned int64 array, so lengths can be looked up by binary search in
+    memory-mapped arrays without reading the TSV.
+
+    The TSV is its single file, so a plain lengths file is still imported
+    without naming an input format, and the TSVLengthFormat transformer
+    then adds the index.
+    """
+
+    file = model.File(r'lengths.tsv', format=TSVLengthFormat)
+    index_ids = model.File(
+        r'lengths_index_ids.npy', format=LengthArrayFormat, optional=True)
+    index_lengths = model.File(
+        r'lengths_index_lengths.npy', format=LengthArrayFormat,
+        optional=True)
+
+    def _validate_(self, level):
+        index_fps = _get_length_index_fps(self)
+        num_present = sum(os.path.exists(x) for x in index_fps)
+        if num_present == 0:
+            return
+        if num_present != len(index_fps):
+            raise ValidationError(
+                "Length index arrays must be either both present or both "
+                "absent.")
+
+        length_index = read_length_index(self)
+        if len(length_index.ids) != len(length_index.lengths):
+            raise ValidationError(
+                f"Length index arrays must have the same length, but there "
+                f"are {len(length_index.ids)} IDs and "
+                f"{len(length_index.lengths)} lengths")
+
+        if level == 'max' and len(length_index.ids) > 0:
+            if np.any(length_index.ids[1:] <= length_index.ids[:-1]):
+                raise ValidationError(
+                    "Length index IDs must be unique and sorted.")
+            if length_index.lengths.min() < 0:
+                raise ValidationError(
+                    "Length index lengths must be non-negative.")
 
 
 def length_fp_to_df(fp: str) -> pandas.DataFrame:
-    # Using `dtype=object` and `set_index()` to avoid type casting/inference of
-    # any columns or the index.
-    df = pandas.read_csv(fp, sep='\t', header=None, index_col=0,
-                         skip_blank_lines=True, dtype=object)
+    return cached_parse(fp, _parse_length_fp, copy_func=pandas.DataFrame.copy,
+                        disk_codec=DATAFRAME_CODEC)
+
+
+def _parse_length_fp(fp: str) -> pandas.DataFrame:
+    # The IDs are read as strings (so nothing that looks like a number is
+    # cast) and the lengths straight to int64, in one pass; only if that
+    # fails is the file re-scanned line by line to say where the problem is.
+    # The C engine is used because it honors the dtypes, whereas the pyarrow
+    # engine infers its own (turning an ID like 001 into 1, and truncating
+    # a length like 1.5 to 1).
+    try:
+        with open_maybe_compressed(fp) as fh:
+            df = pandas.read_csv(
+                fh, sep='\t', header=None, index_col=0,
+                skip_blank_lines=True, dtype={0: str, 1: np.int64},
+                engine='c')
+    except pandas.errors.EmptyDataError:
+        raise ValidationError(
+            "Length format requires at least one row of data.")
+    except ValueError as e:
+        _raise_for_first_bad_length_line(fp)
+        raise ValidationError(f"File {fp} could not be read: {e}")
 
     df.index.name = FEATURE_NAME_KEY
-    df.columns = [LENGTH_KEY]
+    if len(df.columns) == 1:
+        df.columns = [LENGTH_KEY]
+        if (df[LENGTH_KEY] < 0).any():
+            _raise_for_first_bad_length_line(fp)
 
     checked_df = _validate_and_cast_tsvlength_df(df)
     return checked_df
 
 
+def _raise_for_first_bad_length_line(fp: str):
+    with open_maybe_compressed(fp, 'r') as fh:
+        for line_num, line in enumerate(fh, start=1):
+            line = line.rstrip('\r\n')
+            if not line:
+                continue
+            fields = line.split('\t')
+            if len(fields) != 2:
+                raise ValidationError(
+                    f"Length format requires two tab-separated columns, but "
+                    f"line {line_num} has {len(fields)}.")
+            try:
+                length = int(fields[1])
+            except ValueError:
+                raise ValidationError(
+                    f"Lengths must be integers, but found non-integer "
+                    f"values: line {line_num} has '{fields[1]}'.")
+            if length < 0:
+                raise ValidationError(
+                    f"Lengths must be non-negative integers, but line "
+                    f"{line_num} has {length}.")
+
+
+def tsv_length_format_to_tsv_length_directory_format(
+        ff: TSVLengthFormat) -> TSVLengthDirectoryFormat:
+    length_index = df_to_length_index(length_fp_to_df(str(ff)))
+
+    result = TSVLengthDirectoryFormat()
+    result.file.write_data(ff, TSVLengthFormat)
+    write_length_index(result, length_index)
+    return result
+
+
+def tsv_length_directory_format_to_df(
+        data: TSVLengthDirectoryFormat,
+        feature_ids: Optional[Iterable[str]] = None) -> pandas.DataFrame:
+    """Load the lengths in a directory format, optionally for some features.
+
+    Parameters
+    ----------
+    data : TSVLengthDirectoryFormat
+        A lengths directory format, with or without the length index.
+    feature_ids : Iterable[str], optional
+        If given, only the lengths of these features are returned, in this
+        order; feature IDs without a length are left out.  If None (the
+        default), all lengths are returned, in file order.
+
+    Returns
+    -------
+    lengths_df : pandas.DataFrame
+        A DataFrame indexed by FEATURE_NAME_KEY with a LENGTH_KEY column.
+    """
+    if feature_ids is None:
+        return length_fp_to_df(
+            extract_fp_from_directory_format(data, data.file))
+
+    length_index = read_length_index(data)
+    if length_index is None:
+        length_index = df_to_length_index(length_fp_to_df(
+            extract_fp_from_directory_format(data, data.file)))
+    return lookup_lengths(length_index, feature_ids)
+
+
+def df_to_length_index(df: pandas.DataFrame) -> LengthIndex:
+    ids = np.array(df.index, dtype=str)
+    sort_order = np.argsort(ids, kind='stable')
+    return LengthIndex(
+        ids=ids[sort_order],
+        lengths=df[LENGTH_KEY].to_numpy(dtype=np.int64)[sort_order])
+
+
+def lookup_lengths(length_index: LengthIndex,
+                   feature_ids: Iterable[str]) -> pandas.DataFrame:
+    """Look up the lengths of features by binary search in a length index.
+
+    Parameters
+    ----------
+    length_index : LengthIndex
+        Sorted feature IDs and their lengths.
+    feature_ids : Iterable[str]
+        The features whose lengths are wanted.
+
+    Returns
+    -------
+    lengths_df : pandas.DataFrame
+        A DataFrame indexed by FEATURE_NAME_KEY with a LENGTH_KEY column,
+        holding the features (in feature_ids order) found in the index.
+    """
+    query_ids = np.array(list(feature_ids), dtype=str)
+    positions = np.searchsorted(length_index.ids, query_ids)
+    is_found = positions < len(length_index.ids)
+    is_found[is_found] = \
+        length_index.ids[positions[is_found]] == query_ids[is_found]
+
+    return pandas.DataFrame(
+        {LENGTH_KEY: np.asarray(length_index.lengths[positions[is_found]])},
+        index=pandas.Index(query_ids[is_found].tolist(),
+                           name=FEATURE_NAME_KEY))
+
+
+def write_length_index(data: TSVLengthDirectoryFormat,
+                       length_index: LengthIndex):
+    ids_fp, lengths_fp = _get_length_index_fps(data)
+    np.save(ids_fp, length_index.ids, allow_pickle=False)
+    np.save(lengths_fp, length_index.lengths.astype(np.int64),
+            allow_pickle=False)
+
+
+def read_length_index(
+        data: TSVLengthDirectoryFormat) -> Optional[LengthIndex]:
+    """Memory-map the length index stored with a lengths TSV file.
+
+    Parameters
+    ----------
+    data : TSVLengthDirectoryFormat
+        A lengths directory format, with or without the length index.
+
+    Returns
+    -------
+    length_index : LengthIndex or None
+        The memory-mapped index, or None if the directory holds only the
+        lengths TSV file.
+    """
+    ids_fp, lengths_fp = _get_length_index_fps(data)
+    if not (os.path.exists(ids_fp) and os.path.exists(lengths_fp)):
+        return None
+
+    return LengthIndex(
+        ids=np.load(ids_fp, mmap_mode='r', allow_pickle=False),
+        lengths=np.load(lengths_fp, mmap_mode='r', allow_pickle=False))
+
+
+def _get_length_index_fps(data: TSVLengthDirectoryFormat) -> list:
+    return [extract_fp_from_directory_format(data, data.index_ids),
+            extract_fp_from_directory_format(data, data.index_lengths)]
+
+
 def df_to_tsv_length_format(df):
     df = _validate_and_cast_tsvlength_df(df)
     ff = TSVLengthFormat()
@@ -68,9 +297,10 @@ def _validate_and_cast_tsvlength_df(df: pandas.DataFrame) -> pandas.DataFrame:
             "are duplicated: %s" %
             ', '.join(df.index[df.index.duplicated()].unique()))
 
-    # convert the length column to integers
+    # convert the length column to integers (unless it was read as them)
     try:
-        df[LENGTH_KEY] = df[LENGTH_KEY].astype(int)
+        if not pandas.api.types.is_integer_dtype(df[LENGTH_KEY]):
+            df[LENGTH_KEY] = df[LENGTH_KEY].astype(int)
     except ValueError:
         raise ValidationError(
             "Lengths must be integers, but found non-integer values.")
@@ -1,5 +1,7 @@
 import collections
-from typing import Dict, Union, Optional
+import itertools
+import os
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple, Union
 from qiime2.plugin import SemanticType, ValidationError
 import qiime2.plugin.model as model
 import yaml
@@ -8,13 +10,45 @@ from pysyndna.src.fit_syndna_models import REGRESSION_KEYS
 from q2_pysyndna._type_format_pysyndna_log import PysyndnaLogFormat, \
     log_fp_to_list, extract_fp_from_directory_format, \
     list_to_pysyndna_log_format
+from q2_pysyndna._parse_cache import cached_parse
 
-LinearRegressionsObjects = collections.namedtuple(
+_LinearRegressionsObjectsTuple = collections.namedtuple(
     "LinearRegressionsObjects",
     ["linregs_dict", "log_msgs_list"])
 
+
+class LinearRegressionsObjects(_LinearRegressionsObjectsTuple):
+    """The linear regression models and log messages of a fit.
+
+    Unpacks into (linregs_dict, log_msgs_list).  input_fingerprints is an
+    attribute rather than a field: it maps each sample id to a digest of
+    the inputs its regression was fit from, so an incremental fit can tell
+    which samples' inputs have changed, and is None for regressions fit
+    before these were recorded.
+    """
+
+    input_fingerprints = None
+
+    def __new__(cls, linregs_dict, log_msgs_list, input_fingerprints=None):
+        self = super().__new__(cls, linregs_dict, log_msgs_list)
+        self.input_fingerprints = input_fingerprints
+        return self
+
+
 LinearRegressions = SemanticType("LinearRegressions")
 
+# What to do when merging regressions finds a sample in more than one input
+ERROR_COLLISION_POLICY = 'error'
+FIRST_COLLISION_POLICY = 'first'
+LAST_COLLISION_POLICY = 'last'
+COLLISION_POLICIES = [ERROR_COLLISION_POLICY, FIRST_COLLISION_POLICY,
+                      LAST_COLLISION_POLICY]
+
+# libyaml's loader and dumper (if PyYAML was built with it) are many times
+# faster than the pure-Python ones
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+_YAML_DUMPER = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
 
 class LinearRegressionsYamlFormat(model.TextFileFormat):
     """Represents a yaml file of linear regression models."""
@@ -23,25 +57,45 @@ class LinearRegressionsYamlFormat(model.TextFileFormat):
         _ = yaml_fp_to_linear_regressions_yaml_format(self.path)
 
 
+class LinearRegressionsInputsYamlFormat(model.TextFileFormat):
+    """Represents a yaml file of the fingerprint of each sample's fit inputs.
+    """
+
+    def _validate_(self, level):
+        _ = yaml_fp_to_input_fingerprints(str(self.path))
+
+
 class LinearRegressionsDirectoryFormat(model.DirectoryFormat):
-    """Represents a yaml file of linear regression models and a log."""
+    """Represents a yaml file of linear regression models and a log.
+
+    It may also hold a yaml file of the fingerprints of the inputs each
+    sample's model was fit from (absent from artifacts created before these
+    were recorded).
+    """
 
     linregs_yaml = model.File(
         r'linear_regressions.yaml', format=LinearRegressionsYamlFormat)
     log = model.File(
         r'linear_regressions.log', format=PysyndnaLogFormat)
+    inputs_yaml = model.File(
+        r'linear_regressions_inputs.yaml',
+        format=LinearRegressionsInputsYamlFormat, optional=True)
 
 
 def yaml_fp_to_linear_regressions_yaml_format(yaml_fp) -> \
         Dict[str, Union[Dict[str, float], None]]:
+    return cached_parse(str(yaml_fp), _parse_linear_regressions_yaml_fp)
+
 
+def _parse_linear_regressions_yaml_fp(yaml_fp: str) -> \
+        Dict[str, Union[Dict[str, float], None]]:
     # Not a lot we can validate here as we don't know the names of the
     # regressions or how many there will be, but we can at least make sure
     # that the file is legitimate yaml and that every top-level key has
     # a value that is None or is a dictionary that contains at least the
     # required keys, all of which are floats.
     with open(yaml_fp, "r") as f:
-        config_dict = yaml.safe_load(f)
+        config_dict = yaml.load(f, Loader=_YAML_LOADER)
 
     if config_dict is None:
         raise ValidationError(
@@ -79,6 +133,23 @@ def yaml_fp_to_linear_regressions_yaml_format(yaml_fp) -> \
     return config_dict
 
 
+def yaml_fp_to_input_fingerprints(yaml_fp) -> Dict[str, str]:
+    with open(yaml_fp, "r") as f:
+        fingerprints = yaml.load(f, Loader=_YAML_LOADER)
+
+    # no samples at all is fine
+    if fingerprints is None:
+        return {}
+
+    if not isinstance(fingerprints, dict) or not all(
+            isinstance(x, str) for x in fingerprints.values()):
+        raise ValidationError(
+            "Expected a dictionary of sample ids to input fingerprint "
+            "strings, but got %r" % fingerprints)
+
+    return fingerprints
+
+
 def dict_to_linear_regressions_yaml_format(
         data: Dict[str, Union[Dict[str, float], None]],
         ff: Optional[LinearRegressionsYamlFormat] = None) -> \
@@ -98,7 +169,13 @@ def linear_regressions_directory_format_to_linear_regressions_objects(
     log_fp = extract_fp_from_directory_format(data, data.log)
     log_msgs_list = log_fp_to_list(log_fp)
 
-    result = LinearRegressionsObjects(linregs_dict, log_msgs_list)
+    input_fingerprints = None
+    inputs_fp = extract_fp_from_directory_format(data, data.inputs_yaml)
+    if os.path.exists(inputs_fp):
+        input_fingerprints = yaml_fp_to_input_fingerprints(inputs_fp)
+
+    result = LinearRegressionsObjects(
+        linregs_dict, log_msgs_list, input_fingerprints)
     return result
 
 
@@ -110,4 +187,138 @@ def linear_regressions_objects_to_linear_regressions_directory_format(
     ff = LinearRegressionsDirectoryFormat()
     ff.linregs_yaml.write_data(fy, LinearRegressionsYamlFormat)
     ff.log.write_data(fl, PysyndnaLogFormat)
+
+    if data.input_fingerprints is not None:
+        fi = LinearRegressionsInputsYamlFormat()
+        with fi.open() as fh:
+            yaml.safe_dump(data.input_fingerprints, fh)
+        ff.inputs_yaml.write_data(fi, LinearRegressionsInputsYamlFormat)
     return ff
+
+
+def merge_linear_regressions_directory_formats(
+        formats: Iterable[LinearRegressionsDirectoryFormat],
+        collision_policy: str = ERROR_COLLISION_POLICY) -> \
+        LinearRegressionsDirectoryFormat:
+    """Merge the regressions, logs and input fingerprints of many formats.
+
+    Each input's files are read and written to the merged format in turn,
+    so only one input is held in memory at a time.  Regressions are copied
+    as yaml text rather than being parsed and re-written, because the
+    inputs' contents were validated when they were loaded.
+
+    Parameters
+    ----------
+    formats : Iterable[LinearRegressionsDirectoryFormat]
+        The regressions to merge.
+    collision_policy : str
+        What to do if a sample has regressions in more than one input: one
+        of ERROR_COLLISION_POLICY (the default) to raise a ValueError, or
+        FIRST_COLLISION_POLICY or LAST_COLLISION_POLICY to keep the
+        sample's regression (and input fingerprint) from the first or last
+        input, respectively, that has one.
+
+    Returns
+    -------
+    merged_format : LinearRegressionsDirectoryFormat
+        The merged regressions, with the inputs' logs concatenated (in input
+        order) followed by a message listing any collided sample ids.  It
+        holds input fingerprints if any of the inputs did.
+    """
+    formats = list(formats)
+    if collision_policy not in COLLISION_POLICIES:
+        raise ValueError(
+            f"Collision policy must be one of {COLLISION_POLICIES}, but got "
+            f"'{collision_policy}'")
+
+    result = LinearRegressionsDirectoryFormat()
+    linregs_fp = extract_fp_from_directory_format(result, result.linregs_yaml)
+    inputs_fp = extract_fp_from_directory_format(result, result.inputs_yaml)
+
+    # Under the "last" policy, the regression that is kept is the first one
+    # found going backwards through the inputs
+    ordered_formats = formats[::-1] \
+        if collision_policy == LAST_COLLISION_POLICY else formats
+    written_ids = set()
+    collided_ids = set()
+    has_fingerprints = False
+    with open(linregs_fp, 'w') as linregs_fh, \
+            open(inputs_fp, 'w') as inputs_fh:
+        for curr_format in ordered_formats:
+            kept_ids = set()
+            curr_collided_ids = set()
+            for sample_id, entry_text in _iter_yaml_mapping_entries(
+                    extract_fp_from_directory_format(
+                        curr_format, curr_format.linregs_yaml)):
+                if sample_id in written_ids:
+                    curr_collided_ids.add(sample_id)
+                    continue
+                # Each entry's key is new, so the concatenated entries are
+                # one valid mapping
+                linregs_fh.write(entry_text)
+                kept_ids.add(sample_id)
+
+            if len(curr_collided_ids) > 0:
+                if collision_policy == ERROR_COLLISION_POLICY:
+                    raise ValueError(
+                        f"The following sample ids have regressions in more "
+                        f"than one input: {sorted(curr_collided_ids)}")
+                collided_ids.update(curr_collided_ids)
+            written_ids.update(kept_ids)
+
+            curr_inputs_fp = extract_fp_from_directory_format(
+                curr_format, curr_format.inputs_yaml)
+            if os.path.exists(curr_inputs_fp):
+                has_fingerprints = True
+                for sample_id, entry_text in _iter_yaml_mapping_entries(
+                        curr_inputs_fp):
+                    if sample_id in kept_ids:
+                        inputs_fh.write(entry_text)
+
+    if not has_fingerprints:
+        os.remove(inputs_fp)
+
+    log_msgs = (x for curr_format in formats
+                for x in log_fp_to_list(extract_fp_from_directory_format(
+                    curr_format, curr_format.log)))
+    if len(collided_ids) > 0:
+        log_msgs = itertools.chain(log_msgs, [
+            f"Kept the {collision_policy} regression of each of the "
+            f"following sample ids, which had regressions in more than one "
+            f"input: {sorted(collided_ids)}"])
+    log_fp = extract_fp_from_directory_format(result, result.log)
+    with open(log_fp, 'w') as log_fh:
+        # written like list_to_pysyndna_log_format writes a list
+        for i, msg in enumerate(log_msgs):
+            log_fh.write(msg if i == 0 else '\n' + msg)
+
+    return result
+
+
+def _iter_yaml_mapping_entries(yaml_fp) -> Iterator[Tuple[Any, str]]:
+    # Yields each top-level key of a yaml mapping and the text of its entry.
+    # Only the keys are built into Python objects; the entries' text is
+    # sliced out of the file using the positions of the parsed nodes.
+    with open(yaml_fp, "r") as f:
+        lines = f.readlines()
+    root_node = yaml.compose(''.join(lines), Loader=_YAML_LOADER)
+    if root_node is None:
+        return
+
+    if not isinstance(root_node, yaml.MappingNode) or root_node.flow_style:
+        # e.g. {a: 1, b: 2}, whose entries aren't whole lines
+        for key, value in yaml.load(''.join(lines),
+                                    Loader=_YAML_LOADER).items():
+            yield key, yaml.dump({key: value}, Dumper=_YAML_DUMPER)
+        return
+
+    constructor = yaml.constructor.SafeConstructor()
+    for key_node, value_node in root_node.value:
+        # a value ends either at the start of the next key's line or part
+        # way along its own last line
+        end_mark = value_node.end_mark
+        end_line = end_mark.line + (1 if end_mark.column > 0 else 0)
+        entry_text = ''.join(lines[key_node.start_mark.line:end_line])
+        if not entry_text.endswith('\n'):
+            entry_text += '\n'
+        yield constructor.construct_object(key_node), entry_text
@@ -4,6 +4,9 @@ import qiime2.plugin.model as model
 
 from pysyndna.src.fit_syndna_models import \
    SYNDNA_ID_KEY, SYNDNA_INDIV_NG_UL_KEY
+from q2_pysyndna._compression import open_maybe_compressed
+from q2_pysyndna._disk_cache import DATAFRAME_CODEC
+from q2_pysyndna._parse_cache import cached_parse
 
 # Types
 SyndnaPoolConcentrationTable = SemanticType("SyndnaPoolConcentrationTable")
@@ -11,14 +14,16 @@ SyndnaPoolConcentrationTable = SemanticType("SyndnaPoolConcentrationTable")
 
 # Formats
 class SyndnaPoolCsvFormat(model.TextFileFormat):
-    """Represents a csv file of concentrations of each syndna in one pool."""
+    """Represents a csv file of concentrations of each syndna in one pool.
+
+    The file may be gzip-, xz- or zstd-compressed.
+    """
 
     def _validate_(self, level):
         # Validate that the file is a csv and that it has the expected columns.
         # Note that we don't validate the values in the columns, as we don't
         # know what they should be.
-        with self.path.open("r") as f:
-            df = pandas.read_csv(f, header=0, comment="#")
+        df = syndna_pool_fp_to_df(str(self.path))
 
         if (len(df.columns) != 2) or (df.columns[0] != SYNDNA_ID_KEY) or \
                 (df.columns[1] != SYNDNA_INDIV_NG_UL_KEY):
@@ -46,5 +51,16 @@ SyndnaPoolDirectoryFormat = model.SingleFileDirectoryFormat(
 
 
 def syndna_pool_csv_format_to_df(ff: SyndnaPoolCsvFormat) -> pandas.DataFrame:
-    result = pandas.read_csv(str(ff), header=0, comment='#')
+    return syndna_pool_fp_to_df(str(ff))
+
+
+def syndna_pool_fp_to_df(fp: str) -> pandas.DataFrame:
+    return cached_parse(fp, _parse_syndna_pool_fp,
+                        copy_func=pandas.DataFrame.copy,
+                        disk_codec=DATAFRAME_CODEC)
+
+
+def _parse_syndna_pool_fp(fp: str) -> pandas.DataFrame:
+    with open_maybe_compressed(fp, 'r') as f:
+        result = pandas.read_csv(f, header=0, comment='#')
     return result
@@ -1,21 +1,31 @@
 import pandas
 from qiime2.plugin import (Plugin, Int, Float, Range, Str, Choices,
-                           Metadata, Citations)
-from q2_types.feature_table import (FeatureTable, Frequency)
+                           List, Collection, Metadata, Citations)
+from q2_types.feature_table import (FeatureTable, Frequency, BIOMV210DirFmt)
 from q2_types.feature_data import FeatureData
 
 from pysyndna import OGU_CELLS_PER_G_OF_GDNA_KEY, OGU_CELLS_PER_G_OF_SAMPLE_KEY
 import q2_pysyndna
+from q2_pysyndna._cell_count_engine import (
+    CELL_COUNT_ENGINES, PYSYNDNA_CELL_COUNT_ENGINE, SPARSE_CELL_COUNT_ENGINE)
+from q2_pysyndna._copy_count_engine import (
+    COPY_COUNT_ENGINES, PYSYNDNA_COPY_COUNT_ENGINE, SPARSE_COPY_COUNT_ENGINE,
+    CHECKPOINT_DIR_ENV_VAR)
+from q2_pysyndna._fit_engine import (
+    FIT_ENGINES, PYSYNDNA_FIT_ENGINE, BATCHED_FIT_ENGINE)
 from q2_pysyndna._type_format_syndna_pool import (
     SyndnaPoolConcentrationTable,
     SyndnaPoolCsvFormat, SyndnaPoolDirectoryFormat,
     syndna_pool_csv_format_to_df)
 from q2_pysyndna._type_format_linear_regressions import (
     LinearRegressionsObjects, LinearRegressions,
-    LinearRegressionsYamlFormat, LinearRegressionsDirectoryFormat,
+    LinearRegressionsYamlFormat, LinearRegressionsInputsYamlFormat,
+    LinearRegressionsDirectoryFormat,
     yaml_fp_to_linear_regressions_yaml_format,
     linear_regressions_directory_format_to_linear_regressions_objects,
-    linear_regressions_objects_to_linear_regressions_directory_format)
+    linear_regressions_objects_to_linear_regressions_directory_format,
+    COLLISION_POLICIES, ERROR_COLLISION_POLICY, FIRST_COLLISION_POLICY,
+    LAST_COLLISION_POLICY)
 from q2_pysyndna._type_format_pysyndna_log import (
     PysyndnaLog,
     PysyndnaLogFormat, PysyndnaLogDirectoryFormat,
@@ -23,12 +33,15 @@ from q2_pysyndna._type_format_pysyndna_log import (
     pysyndna_log_directory_format_to_list)
 from q2_pysyndna._type_format_length import (
     Length,
-    TSVLengthFormat, TSVLengthDirectoryFormat,
-    length_fp_to_df)
+    TSVLengthFormat, LengthArrayFormat, TSVLengthDirectoryFormat,
+    length_fp_to_df, tsv_length_format_to_tsv_length_directory_format,
+    tsv_length_directory_format_to_df)
 from q2_pysyndna._type_format_coords import (
     Coords,
-    CoordsFormat, CoordsDirectoryFormat,
-    coords_fp_to_df)
+    CoordsFormat, CoordsArrayFormat, CoordsDirectoryFormat,
+    coords_fp_to_df, coords_format_to_coords_directory_format,
+    coords_directory_format_to_df)
+from q2_pysyndna._type_format_coverage import PercentCoverage
 
 # plugin instantiation
 plugin = Plugin(
@@ -50,7 +63,7 @@ plugin.register_semantic_type_to_format(
 
 plugin.register_semantic_types(LinearRegressions)
 plugin.register_formats(
-    LinearRegressionsYamlFormat,
+    LinearRegressionsYamlFormat, LinearRegressionsInputsYamlFormat,
     LinearRegressionsDirectoryFormat)
 plugin.register_semantic_type_to_format(
     LinearRegressions, LinearRegressionsDirectoryFormat)
@@ -61,20 +74,29 @@ plugin.register_semantic_type_to_format(
     PysyndnaLog, PysyndnaLogDirectoryFormat)
 
 plugin.register_semantic_types(Length)
-plugin.register_formats(TSVLengthFormat, TSVLengthDirectoryFormat)
+plugin.register_formats(
+    TSVLengthFormat, LengthArrayFormat, TSVLengthDirectoryFormat)
 plugin.register_artifact_class(
     FeatureData[Length],
     directory_format=TSVLengthDirectoryFormat,
     description="Integer lengths associated with a set of features.")
 
 plugin.register_semantic_types(Coords)
-plugin.register_formats(CoordsFormat, CoordsDirectoryFormat)
+plugin.register_formats(
+    CoordsFormat, CoordsArrayFormat, CoordsDirectoryFormat)
 plugin.register_artifact_class(
     FeatureData[Coords],
     directory_format=CoordsDirectoryFormat,
     description="Integer start and end positions associated with "
                 "a set of features.")
 
+plugin.register_semantic_types(PercentCoverage)
+plugin.register_artifact_class(
+    FeatureTable[PercentCoverage],
+    directory_format=BIOMV210DirFmt,
+    description="The percent of each feature (genome) covered by the reads "
+                "of each sample.")
+
 
 # Transformer registrations
 @plugin.register_transformer
@@ -123,11 +145,35 @@ def _tsv_length_format_to_df(ff: TSVLengthFormat) -> pandas.DataFrame:
     return length_fp_to_df(str(ff))
 
 
+@plugin.register_transformer
+def _tsv_length_format_to_tsv_length_directory_format(
+        ff: TSVLengthFormat) -> TSVLengthDirectoryFormat:
+    return tsv_length_format_to_tsv_length_directory_format(ff)
+
+
+@plugin.register_transformer
+def _tsv_length_directory_format_to_df(
+        data: TSVLengthDirectoryFormat) -> pandas.DataFrame:
+    return tsv_length_directory_format_to_df(data)
+
+
 @plugin.register_transformer
 def _coords_format_to_df(ff: CoordsFormat) -> pandas.DataFrame:
     return coords_fp_to_df(str(ff))
 
 
+@plugin.register_transformer
+def _coords_format_to_coords_directory_format(
+        ff: CoordsFormat) -> CoordsDirectoryFormat:
+    return coords_format_to_coords_directory_format(ff)
+
+
+@plugin.register_transformer
+def _coords_directory_format_to_df(
+        data: CoordsDirectoryFormat) -> pandas.DataFrame:
+    return coords_directory_format_to_df(data)
+
+
 # Method registrations
 plugin.methods.register_function(
     function=q2_pysyndna.fit,
@@ -136,18 +182,36 @@ plugin.methods.register_function(
         'Fit per-sample linear regression models predicting input mass from '
         'read counts using synDNA spike-ins'),
     inputs={'syndna_concs': SyndnaPoolConcentrationTable,
-            'syndna_counts': FeatureTable[Frequency]},
+            'syndna_counts': FeatureTable[Frequency],
+            'existing_regression_models': LinearRegressions},
     input_descriptions={
         'syndna_concs': "Syndna pool(s)' membership and concentrations.",
-        'syndna_counts': 'Feature table of syndna counts.'},
+        'syndna_counts': 'Feature table of syndna counts.',
+        'existing_regression_models': 'Regression models from an earlier '
+                                      'fit to extend.  If given, only '
+                                      'samples without a model or whose '
+                                      'inputs have changed are fit, and the '
+                                      'output holds their models plus all '
+                                      'the existing ones.'},
     parameters={
         'metadata': Metadata,
-        'min_sample_count': Int % Range(1, None)},
+        'min_sample_count': Int % Range(1, None),
+        'engine': Str % Choices(*FIT_ENGINES),
+        'n_jobs': Int % Range(1, None)},
     parameter_descriptions={
         'metadata': 'Metadata file with sample information.',
         'min_sample_count': 'Minimum number of counts required for a sample '
                             'to be included in the regression.  Samples with '
-                            'fewer counts will be excluded.'},
+                            'fewer counts will be excluded.',
+        'engine': f'How to fit the models: {PYSYNDNA_FIT_ENGINE} fits each '
+                  f'sample\'s model with pysyndna, while '
+                  f'{BATCHED_FIT_ENGINE} fits all samples\' models at once, '
+                  f'which is much faster for runs with many samples.',
+        'n_jobs': f'The number of processes to fit the {PYSYNDNA_FIT_ENGINE} '
+                  f'engine\'s models across.  Samples are split between the '
+                  f'processes and their results combined in sample order, so '
+                  f'the output is the same as with one process.  Ignored by '
+                  f'the {BATCHED_FIT_ENGINE} engine.'},
     outputs=[('regression_models', LinearRegressions)],
     output_descriptions={
         'regression_models': 'Linear regression models trained for each '
@@ -155,6 +219,30 @@ plugin.methods.register_function(
                              'regression fitting process.'}
 )
 
+plugin.methods.register_function(
+    function=q2_pysyndna.merge_regressions,
+    name='Merge linear regression models.',
+    description=(
+        'Merge the per-sample linear regression models (and logs) of many '
+        'fits, such as one per sequencing run, into one collection.'),
+    inputs={'regression_models': List[LinearRegressions]},
+    input_descriptions={
+        'regression_models': 'Linear regression models to merge.'},
+    parameters={
+        'collision_policy': Str % Choices(*COLLISION_POLICIES)},
+    parameter_descriptions={
+        'collision_policy': 'What to do if a sample has models in more than '
+                            f'one input: {ERROR_COLLISION_POLICY} raises an '
+                            f'error, while {FIRST_COLLISION_POLICY} and '
+                            f'{LAST_COLLISION_POLICY} keep the model from '
+                            'the first or last input that has one.'},
+    outputs=[('merged_regression_models', LinearRegressions)],
+    output_descriptions={
+        'merged_regression_models': 'The merged linear regression models, '
+                                    'and the log messages of all the '
+                                    'inputs.'}
+)
+
 plugin.methods.register_function(
     function=q2_pysyndna.count_cells,
     name='Calculate cell counts.',
@@ -163,19 +251,30 @@ plugin.methods.register_function(
         'per-sample linear regression models based on synDNA spike-ins'),
     inputs={'regression_models': LinearRegressions,
             'genome_counts': FeatureTable[Frequency],
-            'genome_lengths': FeatureData[Length]},
+            'genome_lengths': FeatureData[Length],
+            'genome_coverages': FeatureTable[PercentCoverage]},
     input_descriptions={
         'regression_models': 'Linear regression models trained for each '
                              'qualifying sample.',
         'genome_counts': 'Feature table of genome counts.',
-        'genome_lengths': 'Lengths of genomes.'},
+        'genome_lengths': 'Lengths of genomes.',
+        'genome_coverages': 'Optional percent coverages of the genomes in '
+                            'the samples of the genome counts, as output by '
+                            'calc-genome-coverages.  If given, they are '
+                            'used instead of recalculating the coverages '
+                            '(so the read length is not used), and the '
+                            'cell counts are calculated as the '
+                            f'{SPARSE_CELL_COUNT_ENGINE} engine does.  '
+                            "Can't be used with a sample block size."},
     parameters={
         'metadata': Metadata,
         'read_length': Int % Range(1, None),
         'min_percent_coverage': Float % Range(1, None),
         'min_rsquared': Float % Range(0, 1),
         'output_metric': Str % Choices(OGU_CELLS_PER_G_OF_GDNA_KEY,
-                                       OGU_CELLS_PER_G_OF_SAMPLE_KEY)},
+                                       OGU_CELLS_PER_G_OF_SAMPLE_KEY),
+        'engine': Str % Choices(*CELL_COUNT_ENGINES),
+        'sample_block_size': Int % Range(1, None)},
     parameter_descriptions={
         'metadata': 'Metadata file with sample information.',
         'read_length': 'Length of reads in basepairs (usually but not '
@@ -188,7 +287,19 @@ plugin.methods.register_function(
                         'the output.',
         'output_metric': 'The metric to calculate and output.  '
                          f'Choices are {OGU_CELLS_PER_G_OF_GDNA_KEY} and '
-                         f'{OGU_CELLS_PER_G_OF_SAMPLE_KEY}.'},
+                         f'{OGU_CELLS_PER_G_OF_SAMPLE_KEY}.',
+        'engine': f'How to calculate the cell counts: '
+                  f'{PYSYNDNA_CELL_COUNT_ENGINE} calculates them with '
+                  f'pysyndna, while {SPARSE_CELL_COUNT_ENGINE} calculates '
+                  f'them on just the nonzero genome counts, without making a '
+                  f'dense copy of the genome count table, which is needed '
+                  f'for large tables.',
+        'sample_block_size': 'If given, the genome counts are read, and the '
+                             'cell counts calculated (as the '
+                             f'{SPARSE_CELL_COUNT_ENGINE} engine does) and '
+                             'written, this many samples at a time, so the '
+                             'memory used depends on this rather than on '
+                             'the size of the genome count table.'},
     outputs=[('cell_counts', FeatureTable[Frequency]),
              ('cell_count_log', PysyndnaLog)],
     output_descriptions={
@@ -198,6 +309,125 @@ plugin.methods.register_function(
 )
 
 
+plugin.methods.register_function(
+    function=q2_pysyndna.calc_genome_coverages,
+    name='Calculate genome coverages.',
+    description=(
+        'Calculate the percent of each genome covered by the reads of each '
+        'sample, which count-cells filters on, so that it can be reused '
+        'rather than recalculated.'),
+    inputs={'genome_counts': FeatureTable[Frequency],
+            'genome_lengths': FeatureData[Length]},
+    input_descriptions={
+        'genome_counts': 'Feature table of genome counts.',
+        'genome_lengths': 'Lengths of genomes.'},
+    parameters={'read_length': Int % Range(1, None)},
+    parameter_descriptions={
+        'read_length': 'Length of reads in basepairs (usually but not '
+                       'always 150).'},
+    outputs=[('genome_coverages', FeatureTable[PercentCoverage])],
+    output_descriptions={
+        'genome_coverages': 'Percent coverage of each genome by the reads '
+                            'of each sample.'}
+)
+
+plugin.methods.register_function(
+    function=q2_pysyndna.count_cells_gdna_and_sample,
+    name='Calculate cell counts per g of gDNA and per g of sample.',
+    description=(
+        'Calculate number of cells of each genome both per gram of gDNA and '
+        'per gram of sample, in one pass over the inputs, using per-sample '
+        'linear regression models based on synDNA spike-ins.  The cell '
+        'counts are the same as those of count-cells with the '
+        f'{SPARSE_CELL_COUNT_ENGINE} engine and each output metric.'),
+    inputs={'regression_models': LinearRegressions,
+            'genome_counts': FeatureTable[Frequency],
+            'genome_lengths': FeatureData[Length]},
+    input_descriptions={
+        'regression_models': 'Linear regression models trained for each '
+                             'qualifying sample.',
+        'genome_counts': 'Feature table of genome counts.',
+        'genome_lengths': 'Lengths of genomes.'},
+    parameters={
+        'metadata': Metadata,
+        'read_length': Int % Range(1, None),
+        'min_percent_coverage': Float % Range(1, None),
+        'min_rsquared': Float % Range(0, 1),
+        'sample_block_size': Int % Range(1, None)},
+    parameter_descriptions={
+        'metadata': 'Metadata file with sample information.',
+        'read_length': 'Length of reads in basepairs (usually but not '
+                       'always 150).',
+        'min_percent_coverage': 'Minimum allowable percent coverage of a '
+                                'genome in a sample needed to include that '
+                                'genome/sample in the output.',
+        'min_rsquared': 'Minimum allowable R^2 value for the linear regression'
+                        ' model for a sample needed to include that sample in '
+                        'the output.',
+        'sample_block_size': 'If given, the genome counts are read, and the '
+                             'cell counts calculated and written, this many '
+                             'samples at a time, so the memory used depends '
+                             'on this rather than on the size of the genome '
+                             'count table.'},
+    outputs=[('cell_counts_per_g_of_gdna', FeatureTable[Frequency]),
+             ('cell_counts_per_g_of_sample', FeatureTable[Frequency]),
+             ('cell_count_log', PysyndnaLog)],
+    output_descriptions={
+        'cell_counts_per_g_of_gdna': 'Cell counts per genome per g of gDNA.',
+        'cell_counts_per_g_of_sample': 'Cell counts per genome per g of '
+                                       'sample.',
+        'cell_count_log': 'Log messages from the cell count calculation '
+                          'process.'}
+)
+
+
+plugin.methods.register_function(
+    function=q2_pysyndna.count_cells_sweep,
+    name='Calculate cell counts across a grid of filter thresholds.',
+    description=(
+        'Calculate number of cells of each genome per gram of sample (as '
+        f'count-cells does with the {SPARSE_CELL_COUNT_ENGINE} engine) for '
+        'each combination of a minimum r-squared and a minimum percent '
+        'coverage.  The coverages and cell counts are calculated once, and '
+        'each combination of thresholds is applied to them as a filter.'),
+    inputs={'regression_models': LinearRegressions,
+            'genome_counts': FeatureTable[Frequency],
+            'genome_lengths': FeatureData[Length]},
+    input_descriptions={
+        'regression_models': 'Linear regression models trained for each '
+                             'qualifying sample.',
+        'genome_counts': 'Feature table of genome counts.',
+        'genome_lengths': 'Lengths of genomes.'},
+    parameters={
+        'metadata': Metadata,
+        'min_percent_coverages': List[Float % Range(1, None)],
+        'min_rsquareds': List[Float % Range(0, 1)],
+        'read_length': Int % Range(1, None),
+        'output_metric': Str % Choices(OGU_CELLS_PER_G_OF_GDNA_KEY,
+                                       OGU_CELLS_PER_G_OF_SAMPLE_KEY)},
+    parameter_descriptions={
+        'metadata': 'Metadata file with sample information.',
+        'min_percent_coverages': 'The minimum allowable percent coverages of '
+                                 'a genome in a sample (as for count-cells) '
+                                 'to sweep.',
+        'min_rsquareds': 'The minimum allowable R^2 values for the linear '
+                         'regression model for a sample (as for '
+                         'count-cells) to sweep.',
+        'read_length': 'Length of reads in basepairs (usually but not '
+                       'always 150).',
+        'output_metric': 'The metric to calculate and output.  '
+                         f'Choices are {OGU_CELLS_PER_G_OF_GDNA_KEY} and '
+                         f'{OGU_CELLS_PER_G_OF_SAMPLE_KEY}.'},
+    outputs=[('cell_counts', Collection[FeatureTable[Frequency]]),
+             ('sweep_summary', PysyndnaLog)],
+    output_descriptions={
+        'cell_counts': 'Cell counts per genome for each combination of '
+                       'thresholds, keyed by the combination (e.g. '
+                       'min_rsquared_0.8_min_percent_coverage_1.0).',
+        'sweep_summary': 'The numbers of samples and genomes retained by '
+                         'each combination of thresholds.'}
+)
+
 plugin.methods.register_function(
     function=q2_pysyndna.count_copies,
     name='Calculate copies of RNA of each genome+ORF.',
@@ -209,9 +439,26 @@ plugin.methods.register_function(
     input_descriptions={
         'genome_orf_counts': 'Feature table of genome+ORF counts.',
         'genome_orf_coords': 'Start and end coordinates of genome+ORFs.'},
-    parameters={'metadata': Metadata},
+    parameters={'metadata': Metadata,
+                'engine': Str % Choices(*COPY_COUNT_ENGINES),
+                'sample_block_size': Int % Range(1, None)},
     parameter_descriptions={
-        'metadata': 'Metadata file with sample information.'},
+        'metadata': 'Metadata file with sample information.',
+        'engine': f'How to calculate the copies: '
+                  f'{PYSYNDNA_COPY_COUNT_ENGINE} calculates them with '
+                  f'pysyndna, while {SPARSE_COPY_COUNT_ENGINE} calculates '
+                  f'them on just the nonzero genome+ORF counts, without '
+                  f'making a dense copy of the genome+ORF count table, which '
+                  f'is needed for large tables.',
+        'sample_block_size': 'If given, the copies are calculated this many '
+                             'samples at a time, and the results combined.  '
+                             f'If the {CHECKPOINT_DIR_ENV_VAR} environment '
+                             'variable names a local directory, each '
+                             'finished block is stored there, and a rerun '
+                             'with the same inputs loads the blocks already '
+                             'stored rather than recalculating them, so an '
+                             'interrupted run resumes after its last '
+                             'finished block.'},
     outputs=[('copy_counts', FeatureTable[Frequency]),
              ('copy_count_log', PysyndnaLog)],
     output_descriptions={
@@ -0,0 +1,95 @@
+from unittest import mock
+
+import biom
+import numpy as np
+import numpy.testing as npt
+from qiime2.plugin.testing import TestPluginBase
+from scipy import sparse
+
+from q2_pysyndna import __package_name__
+from q2_pysyndna._biom_hdf5 import SpilledBiomWriter, \
+    biom_dir_fmt_to_table, iter_biom_sample_blocks, read_biom_ids, \
+    table_to_biom_dir_fmt
+from q2_pysyndna._type_format_pysyndna_log import \
+    extract_fp_from_directory_format
+
+
+class TestBiomHdf5(TestPluginBase):
+    package = f'{__package_name__}.tests'
+
+    OBS_IDS = ['G3', 'G1', 'G4', 'G2']
+    SAMPLE_IDS = ['S2', 'S4', 'S1', 'S3', 'S5']
+    # observations x samples; G4 and S3 have no values
+    VALUES = np.array([[1.5, 0, 0, 0, 2.5],
+                       [0, 3.0, 4.0, 0, 0],
+                       [0, 0, 0, 0, 0],
+                       [5.0, 0, 6.0, 0, 7.0]])
+
+    def _get_biom_fp(self, table):
+        biom_format = table_to_biom_dir_fmt(table)
+        return extract_fp_from_directory_format(
+            biom_format, biom_format.file)
+
+    def _write_spilled(self, sample_block_size):
+        with SpilledBiomWriter(self.OBS_IDS, self.SAMPLE_IDS) as writer:
+            for start in range(0, len(self.SAMPLE_IDS), sample_block_size):
+                block = sparse.coo_matrix(
+                    self.VALUES[:, start:start + sample_block_size])
+                writer.append(block.data, block.row, block.col + start)
+            return biom_dir_fmt_to_table(writer.write())
+
+    def _assert_sorted_nonempty_table(self, obs_table):
+        # only the observations and samples with values, sorted by id
+        self.assertListEqual(['G1', 'G2', 'G3'],
+                             obs_table.ids(axis='observation').tolist())
+        self.assertListEqual(['S1', 'S2', 'S4', 'S5'],
+                             obs_table.ids().tolist())
+        npt.assert_array_equal(
+            [[4.0, 0, 3.0, 0],
+             [6.0, 5.0, 0, 7.0],
+             [0, 1.5, 0, 2.5]],
+            obs_table.matrix_data.toarray())
+
+    def test_read_biom_ids(self):
+        biom_fp = self._get_biom_fp(
+            biom.Table(self.VALUES, self.OBS_IDS, self.SAMPLE_IDS))
+
+        obs_obs_ids, obs_sample_ids = read_biom_ids(biom_fp)
+
+        self.assertListEqual(self.OBS_IDS, obs_obs_ids)
+        self.assertListEqual(self.SAMPLE_IDS, obs_sample_ids)
+
+    def test_iter_biom_sample_blocks(self):
+        biom_fp = self._get_biom_fp(
+            biom.Table(self.VALUES, self.OBS_IDS, self.SAMPLE_IDS))
+
+        obs_blocks = list(iter_biom_sample_blocks(biom_fp, 2))
+
+        self.assertListEqual([0, 2, 4], [x[0] for x in obs_blocks])
+        npt.assert_array_equal(
+            self.VALUES,
+            np.hstack([x[1].toarray() for x in obs_blocks]))
+
+    def test_spilled_biom_writer(self):
+        for sample_block_size in [1, 2, 5]:
+            self._assert_sorted_nonempty_table(
+                self._write_spilled(sample_block_size))
+
+    def test_spilled_biom_writer_in_chunks(self):
+        # a chunk smaller than some samples' values, and than others'
+        with mock.patch('q2_pysyndna._biom_hdf5._WRITE_CHUNK_NNZ', 2):
+            obs_table = self._write_spilled(2)
+
+        self._assert_sorted_nonempty_table(obs_table)
+
+    def test_spilled_biom_writer_empty(self):
+        with SpilledBiomWriter(self.OBS_IDS, self.SAMPLE_IDS) as writer:
+            obs_table = biom_dir_fmt_to_table(writer.write())
+
+        self.assertEqual((0, 0), obs_table.shape)
+
+    def test_spilled_biom_writer_out_of_order(self):
+        with SpilledBiomWriter(self.OBS_IDS, self.SAMPLE_IDS) as writer:
+            writer.append(np.array([1.0]), np.array([0]), np.array([2]))
+            with self.assertRaisesRegex(ValueError, "in sample order"):
+                writer.append(np.array([1.0]), np.array([0]), np.array([1]))
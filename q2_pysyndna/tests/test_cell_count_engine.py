@@ -0,0 +1,296 @@
+import biom
+import numpy as np
+import numpy.testing as npt
+import pandas
+from qiime2.plugin.testing import TestPluginBase
+
+from pysyndna import OGU_CELLS_PER_G_OF_GDNA_KEY, \
+    OGU_CELLS_PER_G_OF_SAMPLE_KEY
+from pysyndna.src.fit_syndna_models import SAMPLE_ID_KEY, \
+    SAMPLE_TOTAL_READS_KEY
+from pysyndna.src.calc_cell_counts import GDNA_CONCENTRATION_NG_UL_KEY, \
+    ELUTE_VOL_UL_KEY, SAMPLE_IN_ALIQUOT_MASS_G_KEY, \
+    SEQUENCED_SAMPLE_GDNA_MASS_NG_KEY
+from q2_pysyndna import __package_name__
+from q2_pysyndna._biom_hdf5 import biom_dir_fmt_to_table, \
+    table_to_biom_dir_fmt
+from q2_pysyndna._cell_count_engine import calc_ogu_cell_counts_blocked, \
+    calc_ogu_cell_counts_sparse, calc_ogu_cell_counts_blocked_metrics, \
+    calc_ogu_cell_counts_sparse_metrics, calc_ogu_cell_counts_sweep, \
+    calc_percent_coverages_sparse, make_sweep_key
+from q2_pysyndna._type_format_pysyndna_log import \
+    extract_fp_from_directory_format
+
+
+class TestCellCountEngine(TestPluginBase):
+    package = f'{__package_name__}.tests'
+
+    GENOME_IDS = ['G3', 'G1', 'G2']
+    SAMPLE_IDS = ['S2', 'S1', 'S3']
+    # genomes x samples; mostly zeros
+    COUNTS = np.array([[500, 0, 0],
+                       [0, 2000, 0],
+                       [10, 0, 0]])
+    GENOME_LENGTHS = pandas.Series(
+        [100000, 200000, 50000], index=['G1', 'G2', 'G3'])
+    SAMPLE_INFO_DF = pandas.DataFrame({
+        SAMPLE_ID_KEY: SAMPLE_IDS,
+        SAMPLE_TOTAL_READS_KEY: [1000000, 2000000, 500000],
+        SEQUENCED_SAMPLE_GDNA_MASS_NG_KEY: [5, 2, 5],
+        GDNA_CONCENTRATION_NG_UL_KEY: [2, 4, 2],
+        ELUTE_VOL_UL_KEY: [70, 70, 70],
+        SAMPLE_IN_ALIQUOT_MASS_G_KEY: [0.002, 0.001, 0.002]})
+    LINREGS_DICT = {
+        'S1': {'slope': 1.2, 'intercept': -6.5, 'rvalue': 0.95},
+        'S2': {'slope': 1.1, 'intercept': -6.8, 'rvalue': 0.99},
+        'S3': {'slope': 1.0, 'intercept': -7.0, 'rvalue': 0.5}}
+
+    def _calc_cells_per_g_of_gdna(self, count, genome_id, sample_num):
+        # the one-value-at-a-time version of the sparse calculation
+        linreg = self.LINREGS_DICT[self.SAMPLE_IDS[sample_num]]
+        info = self.SAMPLE_INFO_DF.iloc[sample_num]
+        cpm = count / info[SAMPLE_TOTAL_READS_KEY] * 1e6
+        mass_ng = 10 ** (linreg['slope'] * np.log10(cpm) +
+                         linreg['intercept'])
+        genomes = mass_ng / 1e9 * 6.02214076e23 / (
+            self.GENOME_LENGTHS[genome_id] * 650)
+        return genomes / (info[SEQUENCED_SAMPLE_GDNA_MASS_NG_KEY] / 1e9)
+
+    def _calc_counts(self, output_metric, min_percent_coverage=1):
+        genome_counts = biom.Table(
+            self.COUNTS, self.GENOME_IDS, self.SAMPLE_IDS)
+        return calc_ogu_cell_counts_sparse(
+            self.SAMPLE_INFO_DF, self.LINREGS_DICT, genome_counts,
+            self.GENOME_LENGTHS, 150, min_percent_coverage, 0.8,
+            output_metric)
+
+    def test_calc_ogu_cell_counts_sparse(self):
+        obs_biom, obs_msgs = self._calc_counts(OGU_CELLS_PER_G_OF_GDNA_KEY)
+
+        # S2's reads cover only 10 * 150 / 200000 = 0.75% of G2, so it is
+        # filtered out, and S3's r-squared is too low
+        self.assertListEqual(
+            ['G1', 'G3'], obs_biom.ids(axis='observation').tolist())
+        self.assertListEqual(
+            ['S1', 'S2'], obs_biom.ids(axis='sample').tolist())
+        npt.assert_allclose(
+            [[self._calc_cells_per_g_of_gdna(2000, 'G1', 1), 0],
+             [0, self._calc_cells_per_g_of_gdna(500, 'G3', 0)]],
+            obs_biom.matrix_data.toarray(), rtol=1e-12)
+        self.assertListEqual(
+            ["The following items have % coverage lower than the minimum of "
+             "1.0: ['S2;G2']",
+             "R^2 of linear regression for sample S3 is 0.25, which is below "
+             "the minimum allowed value of 0.8."],
+            obs_msgs)
+
+    def test_calc_ogu_cell_counts_sparse_per_g_of_sample(self):
+        gdna_biom, _ = self._calc_counts(OGU_CELLS_PER_G_OF_GDNA_KEY)
+        obs_biom, _ = self._calc_counts(OGU_CELLS_PER_G_OF_SAMPLE_KEY)
+
+        # S1 has 4 ng/ul * 70 ul of gDNA per 0.001 g of sample, and S2 has
+        # 2 ng/ul * 70 ul per 0.002 g
+        npt.assert_allclose(
+            gdna_biom.matrix_data.toarray() *
+            np.array([[4 * 70 / 1e9 / 0.001, 2 * 70 / 1e9 / 0.002]]),
+            obs_biom.matrix_data.toarray(), rtol=1e-12)
+
+    def test_calc_ogu_cell_counts_sparse_metrics(self):
+        metrics = [OGU_CELLS_PER_G_OF_GDNA_KEY, OGU_CELLS_PER_G_OF_SAMPLE_KEY]
+        genome_counts = biom.Table(
+            self.COUNTS, self.GENOME_IDS, self.SAMPLE_IDS)
+
+        obs_dict, obs_msgs = calc_ogu_cell_counts_sparse_metrics(
+            self.SAMPLE_INFO_DF, self.LINREGS_DICT, genome_counts,
+            self.GENOME_LENGTHS, 150, 1, 0.8, metrics)
+
+        self.assertListEqual(metrics, list(obs_dict))
+        for curr_metric in metrics:
+            exp_biom, exp_msgs = self._calc_counts(curr_metric)
+            self.assertEqual(exp_biom, obs_dict[curr_metric])
+            self.assertListEqual(exp_msgs, obs_msgs)
+
+    def test_calc_ogu_cell_counts_blocked_metrics(self):
+        metrics = [OGU_CELLS_PER_G_OF_GDNA_KEY, OGU_CELLS_PER_G_OF_SAMPLE_KEY]
+        counts_format = table_to_biom_dir_fmt(biom.Table(
+            self.COUNTS, self.GENOME_IDS, self.SAMPLE_IDS))
+        counts_fp = extract_fp_from_directory_format(
+            counts_format, counts_format.file)
+
+        obs_dict, obs_msgs = calc_ogu_cell_counts_blocked_metrics(
+            self.SAMPLE_INFO_DF, self.LINREGS_DICT, counts_fp,
+            self.GENOME_LENGTHS, 150, 1, 0.8, metrics, 2)
+
+        for curr_metric in metrics:
+            exp_biom, exp_msgs = self._calc_counts(curr_metric)
+            obs_biom = biom_dir_fmt_to_table(obs_dict[curr_metric])
+            npt.assert_allclose(exp_biom.matrix_data.toarray(),
+                                obs_biom.matrix_data.toarray(), rtol=1e-12)
+            self.assertListEqual(exp_msgs, obs_msgs)
+
+    def test_calc_ogu_cell_counts_sweep(self):
+        genome_counts = biom.Table(
+            self.COUNTS, self.GENOME_IDS, self.SAMPLE_IDS)
+
+        obs_dict, obs_msgs = calc_ogu_cell_counts_sweep(
+            self.SAMPLE_INFO_DF, self.LINREGS_DICT, genome_counts,
+            self.GENOME_LENGTHS, 150, [1, 0.5], [0.95, 0.2],
+            OGU_CELLS_PER_G_OF_GDNA_KEY)
+
+        exp_keys = []
+        for min_rsquared in [0.95, 0.2]:
+            for min_percent_coverage in [1, 0.5]:
+                exp_biom, _ = calc_ogu_cell_counts_sparse(
+                    self.SAMPLE_INFO_DF, self.LINREGS_DICT, genome_counts,
+                    self.GENOME_LENGTHS, 150, min_percent_coverage,
+                    min_rsquared, OGU_CELLS_PER_G_OF_GDNA_KEY)
+                exp_key = make_sweep_key(min_rsquared, min_percent_coverage)
+                exp_keys.append(exp_key)
+                self.assertEqual(exp_biom, obs_dict[exp_key])
+        self.assertListEqual(exp_keys, list(obs_dict))
+        # S1's r-squared is 0.9025, S3 has no counts, and S2's G2 is 0.75%
+        # covered
+        self.assertListEqual(
+            ["Of 3 samples and 3 genomes with genome counts, the following "
+             "are retained by each combination of thresholds:",
+             "min_rsquared_0.95_min_percent_coverage_1.0: "
+             "1 samples and 1 genomes",
+             "min_rsquared_0.95_min_percent_coverage_0.5: "
+             "1 samples and 2 genomes",
+             "min_rsquared_0.2_min_percent_coverage_1.0: "
+             "2 samples and 2 genomes",
+             "min_rsquared_0.2_min_percent_coverage_0.5: "
+             "2 samples and 3 genomes"],
+            obs_msgs)
+
+    def test_calc_ogu_cell_counts_blocked(self):
+        exp_biom, exp_msgs = self._calc_counts(OGU_CELLS_PER_G_OF_SAMPLE_KEY)
+        counts_format = table_to_biom_dir_fmt(biom.Table(
+            self.COUNTS, self.GENOME_IDS, self.SAMPLE_IDS))
+        counts_fp = extract_fp_from_directory_format(
+            counts_format, counts_format.file)
+
+        for sample_block_size in [1, 2, 3]:
+            obs_format, obs_msgs = calc_ogu_cell_counts_blocked(
+                self.SAMPLE_INFO_DF, self.LINREGS_DICT, counts_fp,
+                self.GENOME_LENGTHS, 150, 1, 0.8,
+                OGU_CELLS_PER_G_OF_SAMPLE_KEY, sample_block_size)
+
+            obs_biom = biom_dir_fmt_to_table(obs_format)
+            self.assertListEqual(
+                exp_biom.ids(axis='observation').tolist(),
+                obs_biom.ids(axis='observation').tolist())
+            self.assertListEqual(exp_biom.ids().tolist(),
+                                 obs_biom.ids().tolist())
+            npt.assert_allclose(exp_biom.matrix_data.toarray(),
+                                obs_biom.matrix_data.toarray(), rtol=1e-12)
+            self.assertListEqual(exp_msgs, obs_msgs)
+
+    def test_calc_percent_coverages_sparse(self):
+        genome_lengths = self.GENOME_LENGTHS.drop('G1')
+
+        obs_biom = calc_percent_coverages_sparse(
+            biom.Table(self.COUNTS, self.GENOME_IDS, self.SAMPLE_IDS),
+            genome_lengths, 150)
+
+        # G1 has no length, so no coverages
+        exp_biom = biom.Table(
+            np.array([[500 * 150 / 50000 * 100, 0, 0],
+                      [0, 0, 0],
+                      [10 * 150 / 200000 * 100, 0, 0]]),
+            self.GENOME_IDS, self.SAMPLE_IDS)
+        self.assertEqual(exp_biom, obs_biom)
+        self.assertEqual(2, obs_biom.nnz)
+
+    def test_calc_ogu_cell_counts_sparse_w_coverages(self):
+        genome_counts = biom.Table(
+            self.COUNTS, self.GENOME_IDS, self.SAMPLE_IDS)
+        # in a different order, and with more genomes and samples
+        genome_coverages = calc_percent_coverages_sparse(
+            genome_counts, self.GENOME_LENGTHS, 150).sort(axis='observation')
+        genome_coverages = genome_coverages.merge(biom.Table(
+            np.array([[5]]), ['G0'], ['S0']))
+
+        for output_metric in [OGU_CELLS_PER_G_OF_GDNA_KEY,
+                              OGU_CELLS_PER_G_OF_SAMPLE_KEY]:
+            exp_biom, exp_msgs = self._calc_counts(output_metric)
+            # the read length is not used, as the coverages are looked up
+            obs_biom, obs_msgs = calc_ogu_cell_counts_sparse(
+                self.SAMPLE_INFO_DF, self.LINREGS_DICT, genome_counts,
+                self.GENOME_LENGTHS, 1, 1, 0.8, output_metric,
+                genome_coverages)
+
+            self.assertEqual(exp_biom, obs_biom)
+            self.assertListEqual(exp_msgs, obs_msgs)
+
+    def test_calc_ogu_cell_counts_sparse_w_empty_coverages(self):
+        genome_counts = biom.Table(
+            self.COUNTS, self.GENOME_IDS, self.SAMPLE_IDS)
+        genome_coverages = biom.Table(
+            np.zeros((3, 3)), self.GENOME_IDS, self.SAMPLE_IDS)
+
+        obs_biom, obs_msgs = calc_ogu_cell_counts_sparse(
+            self.SAMPLE_INFO_DF, self.LINREGS_DICT, genome_counts,
+            self.GENOME_LENGTHS, 150, 1, 0.8, OGU_CELLS_PER_G_OF_GDNA_KEY,
+            genome_coverages)
+
+        self.assertTrue(obs_biom.is_empty())
+        self.assertEqual(
+            "The following items have % coverage lower than the minimum of "
+            "1.0: ['S2;G3', 'S2;G2', 'S1;G1']",
+            obs_msgs[0])
+
+    def test_calc_ogu_cell_counts_sparse_w_coverages_missing_ids(self):
+        genome_counts = biom.Table(
+            self.COUNTS, self.GENOME_IDS, self.SAMPLE_IDS)
+        genome_coverages = calc_percent_coverages_sparse(
+            genome_counts, self.GENOME_LENGTHS, 150).filter(
+            ['S1', 'S2'], axis='sample', inplace=False)
+
+        with self.assertRaisesRegex(
+                ValueError, r"sample ids .* not in the genome coverages: "
+                            r"\['S3'\]"):
+            calc_ogu_cell_counts_sparse(
+                self.SAMPLE_INFO_DF, self.LINREGS_DICT, genome_counts,
+                self.GENOME_LENGTHS, 150, 1, 0.8,
+                OGU_CELLS_PER_G_OF_GDNA_KEY, genome_coverages)
+
+    def test_calc_ogu_cell_counts_sparse_no_regression(self):
+        linregs_dict = dict(self.LINREGS_DICT)
+        linregs_dict['S1'] = None
+        del linregs_dict['S2']
+        genome_counts = biom.Table(
+            self.COUNTS, self.GENOME_IDS, self.SAMPLE_IDS)
+
+        obs_biom, obs_msgs = calc_ogu_cell_counts_sparse(
+            self.SAMPLE_INFO_DF, linregs_dict, genome_counts,
+            self.GENOME_LENGTHS, 150, 1, 0.2, OGU_CELLS_PER_G_OF_GDNA_KEY)
+
+        self.assertTrue(obs_biom.is_empty())
+        # one message per sample, in sample order, as pysyndna logs them
+        self.assertListEqual(
+            ["No linear regression fitted for sample S2",
+             "No linear regression fitted for sample S1"],
+            obs_msgs[1:])
+
+    def test_calc_ogu_cell_counts_sparse_missing_length(self):
+        genome_lengths = self.GENOME_LENGTHS.drop('G3')
+
+        genome_counts = biom.Table(
+            self.COUNTS, self.GENOME_IDS, self.SAMPLE_IDS)
+        obs_biom, _ = calc_ogu_cell_counts_sparse(
+            self.SAMPLE_INFO_DF, self.LINREGS_DICT, genome_counts,
+            genome_lengths, 150, 1, 0.8, OGU_CELLS_PER_G_OF_GDNA_KEY)
+
+        self.assertListEqual(['G1'], obs_biom.ids(axis='observation').tolist())
+
+    def test_calc_ogu_cell_counts_sparse_missing_sample(self):
+        sample_info_df = self.SAMPLE_INFO_DF.iloc[1:]
+
+        with self.assertRaisesRegex(
+                ValueError, r"sample ids .* not in the metadata: \['S2'\]"):
+            calc_ogu_cell_counts_sparse(
+                sample_info_df, self.LINREGS_DICT,
+                biom.Table(self.COUNTS, self.GENOME_IDS, self.SAMPLE_IDS),
+                self.GENOME_LENGTHS, 150, 1, 0.8,
+                OGU_CELLS_PER_G_OF_GDNA_KEY)
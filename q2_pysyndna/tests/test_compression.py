@@ -0,0 +1,45 @@
+from unittest import mock
+
+from qiime2.plugin import ValidationError
+from qiime2.plugin.testing import TestPluginBase
+
+import q2_pysyndna._compression as compression
+from q2_pysyndna import __package_name__
+from q2_pysyndna._compression import get_compression, open_maybe_compressed
+
+
+class TestCompression(TestPluginBase):
+    package = f'{__package_name__}.tests'
+
+    def test_get_compression(self):
+        expected = {
+            'coords.txt': None,
+            'coords.txt.gz': compression.GZIP_COMPRESSION,
+            'coords.txt.xz': compression.XZ_COMPRESSION,
+            'coords.txt.zst': compression.ZSTD_COMPRESSION}
+
+        for filename, expected_compression in expected.items():
+            self.assertEqual(expected_compression,
+                             get_compression(self.get_data_path(filename)))
+
+    def test_open_maybe_compressed(self):
+        with open(self.get_data_path('coords.txt'), 'rb') as fh:
+            expected_bytes = fh.read()
+        expected_text = expected_bytes.decode()
+
+        filenames = ['coords.txt', 'coords.txt.gz', 'coords.txt.xz',
+                     'coords.txt.zst']
+        for filename in filenames:
+            filepath = self.get_data_path(filename)
+            with open_maybe_compressed(filepath) as fh:
+                self.assertEqual(expected_bytes, fh.read())
+            with open_maybe_compressed(filepath, 'r') as fh:
+                self.assertEqual(expected_text, fh.read())
+
+    def test_open_maybe_compressed_wo_zstandard(self):
+        filepath = self.get_data_path('coords.txt.zst')
+
+        with mock.patch.object(compression, 'zstandard', None):
+            with self.assertRaisesRegex(
+                    ValidationError, "requires the zstandard package"):
+                open_maybe_compressed(filepath)
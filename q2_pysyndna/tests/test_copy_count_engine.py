@@ -0,0 +1,221 @@
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+import biom
+import numpy as np
+import numpy.testing as npt
+import pandas
+from qiime2.plugin.testing import TestPluginBase
+
+from pysyndna.src.quant_orfs import SAMPLE_ID_KEY, \
+    SAMPLE_IN_ALIQUOT_MASS_G_KEY, SSRNA_CONCENTRATION_NG_UL_KEY, \
+    ELUTE_VOL_UL_KEY, TOTAL_BIOLOGICAL_READS_KEY
+from q2_pysyndna import __package_name__
+from q2_pysyndna._copy_count_engine import SPARSE_COPY_COUNT_ENGINE, \
+    CHECKPOINT_DIR_ENV_VAR, \
+    calc_copies_of_ogu_orf_ssrna_per_g_sample_chunked, \
+    calc_copies_of_ogu_orf_ssrna_per_g_sample_sparse, \
+    get_checkpoint_dir_from_env
+
+
+class TestCopyCountEngine(TestPluginBase):
+    package = f'{__package_name__}.tests'
+
+    OGU_ORF_IDS = ['G2_1', 'G1_2', 'G1_1']
+    OGU_ORF_LENS = np.array([300.0, 1500.0, 600.0])
+    SAMPLE_IDS = ['S2', 'S1']
+    # genome+ORFs x samples; mostly zeros
+    COUNTS = np.array([[0, 40],
+                       [0, 0],
+                       [25, 10]])
+    # in a different sample order than the counts, with an extra sample
+    SAMPLE_INFO_DF = pandas.DataFrame({
+        SAMPLE_ID_KEY: ['S1', 'S3', 'S2'],
+        SAMPLE_IN_ALIQUOT_MASS_G_KEY: [0.002, 0.001, 0.001],
+        SSRNA_CONCENTRATION_NG_UL_KEY: [0.5, 1, 0.25],
+        ELUTE_VOL_UL_KEY: [70, 70, 70],
+        TOTAL_BIOLOGICAL_READS_KEY: [1000, 2000, 500]})
+
+    def setUp(self):
+        super().setUp()
+        self.working_dir = tempfile.mkdtemp()
+        self.checkpoint_dir = os.path.join(self.working_dir, 'checkpoints')
+        self.num_calcs = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.working_dir)
+        super().tearDown()
+
+    def _calc_copies(self, count, ogu_orf_num, sample_id):
+        # the one-value-at-a-time version of the sparse calculation
+        info = self.SAMPLE_INFO_DF.set_index(SAMPLE_ID_KEY).loc[sample_id]
+        ssrna_mass_g = info[SSRNA_CONCENTRATION_NG_UL_KEY] * \
+            info[ELUTE_VOL_UL_KEY] / 1e9
+        ogu_orf_mass_g = \
+            count / info[TOTAL_BIOLOGICAL_READS_KEY] * ssrna_mass_g
+        copies = ogu_orf_mass_g * 6.02214076e23 / (
+            self.OGU_ORF_LENS[ogu_orf_num] * 340)
+        return copies / info[SAMPLE_IN_ALIQUOT_MASS_G_KEY]
+
+    def _make_counts(self):
+        return biom.Table(self.COUNTS, self.OGU_ORF_IDS, self.SAMPLE_IDS)
+
+    def test_calc_copies_of_ogu_orf_ssrna_per_g_sample_sparse(self):
+        obs_biom, obs_msgs = calc_copies_of_ogu_orf_ssrna_per_g_sample_sparse(
+            self.SAMPLE_INFO_DF, self._make_counts(), self.OGU_ORF_LENS)
+
+        # the ids of the counts, in their order, even where all zero
+        self.assertListEqual(
+            self.OGU_ORF_IDS, obs_biom.ids(axis='observation').tolist())
+        self.assertListEqual(
+            self.SAMPLE_IDS, obs_biom.ids(axis='sample').tolist())
+        npt.assert_allclose(
+            [[0, self._calc_copies(40, 0, 'S1')],
+             [0, 0],
+             [self._calc_copies(25, 2, 'S2'),
+              self._calc_copies(10, 2, 'S1')]],
+            obs_biom.matrix_data.toarray(), rtol=1e-12)
+        self.assertEqual(3, obs_biom.matrix_data.nnz)
+        self.assertListEqual([], obs_msgs)
+
+    def test_calc_copies_of_ogu_orf_ssrna_per_g_sample_sparse_no_len(self):
+        ogu_orf_lens = self.OGU_ORF_LENS.copy()
+        ogu_orf_lens[[0, 1]] = np.nan
+
+        with self.assertRaisesRegex(
+                ValueError, r"not in the coords: \['G2_1', 'G1_2'\]"):
+            calc_copies_of_ogu_orf_ssrna_per_g_sample_sparse(
+                self.SAMPLE_INFO_DF, self._make_counts(), ogu_orf_lens)
+
+    def test_calc_copies_of_ogu_orf_ssrna_per_g_sample_sparse_no_info(self):
+        sample_info_df = self.SAMPLE_INFO_DF.iloc[1:]
+
+        with self.assertRaisesRegex(
+                ValueError, r"not in the metadata: \['S1'\]"):
+            calc_copies_of_ogu_orf_ssrna_per_g_sample_sparse(
+                sample_info_df, self._make_counts(), self.OGU_ORF_LENS)
+
+    def _calc_block(self, sample_info_df, counts):
+        # the sparse engine, plus a log message naming the block's samples
+        self.num_calcs += 1
+        copies, _ = calc_copies_of_ogu_orf_ssrna_per_g_sample_sparse(
+            sample_info_df, counts, self.OGU_ORF_LENS)
+        return copies, [f"Calculated {counts.ids().tolist()}"]
+
+    def _calc_chunked(self, genome_orf_counts, sample_block_size=1,
+                      checkpoint_dir=None, calc_func=None):
+        return calc_copies_of_ogu_orf_ssrna_per_g_sample_chunked(
+            self.SAMPLE_INFO_DF, genome_orf_counts, self.OGU_ORF_LENS,
+            self._calc_block if calc_func is None else calc_func,
+            SPARSE_COPY_COUNT_ENGINE, sample_block_size, checkpoint_dir)
+
+    def _make_wide_counts(self):
+        # the counts of S2 and S1, plus S1's again as S3
+        counts = np.hstack([self.COUNTS, self.COUNTS[:, [1]]])
+        return biom.Table(counts, self.OGU_ORF_IDS, ['S2', 'S1', 'S3'])
+
+    def test_calc_copies_of_ogu_orf_ssrna_per_g_sample_chunked(self):
+        genome_orf_counts = self._make_wide_counts()
+        exp_biom, _ = calc_copies_of_ogu_orf_ssrna_per_g_sample_sparse(
+            self.SAMPLE_INFO_DF, genome_orf_counts, self.OGU_ORF_LENS)
+
+        for sample_block_size in [1, 2, 3]:
+            for checkpoint_dir in [None, self.checkpoint_dir]:
+                obs_biom, obs_msgs = self._calc_chunked(
+                    genome_orf_counts, sample_block_size, checkpoint_dir)
+
+                self.assertEqual(exp_biom, obs_biom)
+            shutil.rmtree(self.checkpoint_dir)
+
+        # the blocks' log messages, in block order
+        self.assertListEqual(
+            ["Calculated ['S2', 'S1']", "Calculated ['S3']"],
+            self._calc_chunked(genome_orf_counts, 2)[1])
+
+    def test_calc_copies_of_ogu_orf_ssrna_per_g_sample_chunked_dropped(self):
+        # a calculation that drops the genome+ORFs without copies, as
+        # pysyndna's might: only those with copies in some block are output
+        def calc_dropping_zeros(sample_info_df, counts):
+            copies, log_msgs = self._calc_block(sample_info_df, counts)
+            return copies.remove_empty(axis='observation'), log_msgs
+
+        obs_biom, _ = self._calc_chunked(
+            self._make_counts(), calc_func=calc_dropping_zeros)
+
+        self.assertListEqual(['G2_1', 'G1_1'],
+                             obs_biom.ids(axis='observation').tolist())
+        npt.assert_allclose(
+            [[0, self._calc_copies(40, 0, 'S1')],
+             [self._calc_copies(25, 2, 'S2'),
+              self._calc_copies(10, 2, 'S1')]],
+            obs_biom.matrix_data.toarray(), rtol=1e-12)
+
+    def test_calc_copies_of_ogu_orf_ssrna_per_g_sample_chunked_resume(self):
+        genome_orf_counts = self._make_wide_counts()
+        exp_biom, exp_msgs = self._calc_chunked(genome_orf_counts)
+
+        # a run interrupted while calculating its last block ...
+        def calc_until_s3(sample_info_df, counts):
+            if 'S3' in counts.ids():
+                raise KeyboardInterrupt()
+            return self._calc_block(sample_info_df, counts)
+
+        self.num_calcs = 0
+        with self.assertRaises(KeyboardInterrupt):
+            self._calc_chunked(genome_orf_counts,
+                               checkpoint_dir=self.checkpoint_dir,
+                               calc_func=calc_until_s3)
+        self.assertEqual(2, self.num_calcs)
+
+        # ... resumes with it, and assembles all the blocks
+        self.num_calcs = 0
+        obs_biom, obs_msgs = self._calc_chunked(
+            genome_orf_counts, checkpoint_dir=self.checkpoint_dir)
+        self.assertEqual(1, self.num_calcs)
+        self.assertEqual(exp_biom, obs_biom)
+        self.assertListEqual(exp_msgs, obs_msgs)
+
+        # and once finished, a rerun calculates nothing
+        self.num_calcs = 0
+        obs_biom, obs_msgs = self._calc_chunked(
+            genome_orf_counts, checkpoint_dir=self.checkpoint_dir)
+        self.assertEqual(0, self.num_calcs)
+        self.assertEqual(exp_biom, obs_biom)
+        self.assertListEqual(exp_msgs, obs_msgs)
+
+    def test_calc_copies_of_ogu_orf_ssrna_per_g_sample_chunked_changed(self):
+        genome_orf_counts = self._make_wide_counts()
+        self._calc_chunked(genome_orf_counts,
+                           checkpoint_dir=self.checkpoint_dir)
+
+        # only the block whose counts changed is recalculated
+        changed_values = genome_orf_counts.matrix_data.toarray()
+        changed_values[0, 2] += 1
+        changed_counts = biom.Table(
+            changed_values, self.OGU_ORF_IDS, ['S2', 'S1', 'S3'])
+        self.num_calcs = 0
+        obs_biom, _ = self._calc_chunked(
+            changed_counts, checkpoint_dir=self.checkpoint_dir)
+        self.assertEqual(1, self.num_calcs)
+        self.assertAlmostEqual(self._calc_copies(41, 0, 'S3'),
+                               obs_biom.get_value_by_ids('G2_1', 'S3'))
+
+        # and every block is recalculated if the ORF lengths change
+        self.num_calcs = 0
+        calc_copies_of_ogu_orf_ssrna_per_g_sample_chunked(
+            self.SAMPLE_INFO_DF, changed_counts, self.OGU_ORF_LENS + 1,
+            self._calc_block, SPARSE_COPY_COUNT_ENGINE, 1,
+            self.checkpoint_dir)
+        self.assertEqual(3, self.num_calcs)
+
+    def test_get_checkpoint_dir_from_env(self):
+        for env in [{}, {CHECKPOINT_DIR_ENV_VAR: ''}]:
+            with mock.patch.dict(os.environ, env, clear=True):
+                self.assertIsNone(get_checkpoint_dir_from_env())
+
+        env = {CHECKPOINT_DIR_ENV_VAR: self.checkpoint_dir}
+        with mock.patch.dict(os.environ, env, clear=True):
+            self.assertEqual(self.checkpoint_dir,
+                             get_checkpoint_dir_from_env())
@@ -0,0 +1,211 @@
+import os
+import shutil
+import tempfile
+import time
+from unittest import mock
+
+import numpy as np
+import pandas
+from pandas.testing import assert_frame_equal
+from qiime2.plugin.testing import TestPluginBase
+
+from q2_pysyndna import __package_name__
+from q2_pysyndna._disk_cache import DATAFRAME_CODEC, DiskCache, \
+    DISK_CACHE_DIR_ENV_VAR, DISK_CACHE_MAX_BYTES_ENV_VAR, \
+    get_artifact_uuid_and_relpath, get_disk_cache_from_env, \
+    get_disk_cache_key
+from q2_pysyndna._parse_cache import ParseCache, cached_parse
+from q2_pysyndna._type_format_coords import coords_fp_to_arrays
+from q2_pysyndna._type_format_length import length_fp_to_df
+import q2_pysyndna._parse_cache as parse_cache
+
+
+class TestDiskCache(TestPluginBase):
+    package = f'{__package_name__}.tests'
+    UUID = '2f1a9f3e-6c1d-4a8e-9b7e-0c3d5e7f9a1b'
+
+    def setUp(self):
+        super().setUp()
+        self.working_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.working_dir, 'cache')
+        self.num_parses = 0
+        parse_cache.PARSE_CACHE.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.working_dir)
+        parse_cache.PARSE_CACHE.clear()
+        super().tearDown()
+
+    def _copy_into_artifact(self, filename, uuid=UUID):
+        data_dir = os.path.join(self.working_dir, uuid, 'data')
+        os.makedirs(data_dir, exist_ok=True)
+        fp = os.path.join(data_dir, os.path.basename(filename))
+        shutil.copy(self.get_data_path(filename), fp)
+        return fp
+
+    def _parse_csv(self, fp):
+        self.num_parses += 1
+        return pandas.read_csv(fp, header=0, comment='#')
+
+    def _cached_parse_csv(self, fp, disk_cache):
+        # a fresh in-memory cache each time, like a fresh process
+        return cached_parse(fp, self._parse_csv,
+                            copy_func=pandas.DataFrame.copy,
+                            cache=ParseCache(1024 ** 2, 4),
+                            disk_codec=DATAFRAME_CODEC,
+                            disk_cache=disk_cache)
+
+    def test_cached_parse_disk_hit(self):
+        disk_cache = DiskCache(self.cache_dir, 1024 ** 2)
+        fp = self._copy_into_artifact('syndna_pool.csv')
+
+        first_df = self._cached_parse_csv(fp, disk_cache)
+        second_df = self._cached_parse_csv(fp, disk_cache)
+
+        self.assertEqual(1, self.num_parses)
+        assert_frame_equal(first_df, second_df)
+        self.assertEqual(1, len(os.listdir(self.cache_dir)))
+
+    def test_cached_parse_disk_hit_reads_no_file(self):
+        disk_cache = DiskCache(self.cache_dir, 1024 ** 2)
+        fp = self._copy_into_artifact('syndna_pool.csv')
+        expected_df = self._cached_parse_csv(fp, disk_cache)
+
+        with mock.patch.object(parse_cache, 'get_file_fingerprint',
+                               wraps=parse_cache.get_file_fingerprint) \
+                as mock_fingerprint, \
+                mock.patch('builtins.open', wraps=open) as mock_open:
+            obs_df = self._cached_parse_csv(fp, disk_cache)
+
+        mock_fingerprint.assert_not_called()
+        opened_fps = [os.path.realpath(x.args[0])
+                      for x in mock_open.call_args_list]
+        self.assertNotIn(os.path.realpath(fp), opened_fps)
+        self.assertEqual(1, self.num_parses)
+        assert_frame_equal(expected_df, obs_df)
+
+    def test_cached_parse_disk_not_artifact(self):
+        disk_cache = DiskCache(self.cache_dir, 1024 ** 2)
+        fp = self.get_data_path('syndna_pool.csv')
+
+        for _ in range(2):
+            _ = self._cached_parse_csv(fp, disk_cache)
+
+        self.assertEqual(2, self.num_parses)
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+    def test_cached_parse_disk_damaged_entry(self):
+        disk_cache = DiskCache(self.cache_dir, 1024 ** 2)
+        fp = self._copy_into_artifact('syndna_pool.csv')
+        expected_df = self._cached_parse_csv(fp, disk_cache)
+
+        entry_dir = os.path.join(self.cache_dir, os.listdir(self.cache_dir)[0])
+        os.remove(os.path.join(entry_dir, '0.npy'))
+        obs_df = self._cached_parse_csv(fp, disk_cache)
+
+        self.assertEqual(2, self.num_parses)
+        assert_frame_equal(expected_df, obs_df)
+
+    def test_disk_cache_evicts_least_recently_used(self):
+        disk_cache = DiskCache(self.cache_dir, 1024 ** 2)
+        df = pandas.DataFrame({'a': np.arange(1000)})
+        disk_cache.put('old', df, DATAFRAME_CODEC)
+        time.sleep(0.01)
+        disk_cache.put('new', df, DATAFRAME_CODEC)
+        time.sleep(0.01)
+        # using 'old' makes 'new' the least recently used
+        _ = disk_cache.get('old', DATAFRAME_CODEC)
+
+        entry_bytes = sum(
+            x.stat().st_size
+            for x in os.scandir(os.path.join(self.cache_dir, 'old')))
+        disk_cache.max_bytes = entry_bytes * 2
+        time.sleep(0.01)
+        disk_cache.put('newest', df, DATAFRAME_CODEC)
+
+        self.assertEqual(['newest', 'old'],
+                         sorted(os.listdir(self.cache_dir)))
+
+    def test_dataframe_codec_round_trip(self):
+        df = pandas.DataFrame(
+            {'name': ['x', 'y', 'z'], 'count': [1, 2, 3],
+             'value': [0.5, np.nan, 2.0]},
+            index=pandas.Index(['a', 'b', 'c'], name='id'))
+        disk_cache = DiskCache(self.cache_dir, 1024 ** 2)
+        disk_cache.put('df', df, DATAFRAME_CODEC)
+
+        assert_frame_equal(df, disk_cache.get('df', DATAFRAME_CODEC))
+
+    def test_dataframe_codec_skips_unstorable(self):
+        df = pandas.DataFrame({'name': ['x', None]})
+        disk_cache = DiskCache(self.cache_dir, 1024 ** 2)
+        disk_cache.put('df', df, DATAFRAME_CODEC)
+
+        self.assertIsNone(disk_cache.get('df', DATAFRAME_CODEC))
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+    def test_length_fp_to_df_disk_cached(self):
+        fp = self._copy_into_artifact('feature_length/lengths.tsv')
+        disk_cache = DiskCache(self.cache_dir, 1024 ** 2)
+        with mock.patch.object(parse_cache, 'DISK_CACHE', disk_cache):
+            expected_df = length_fp_to_df(fp)
+            parse_cache.PARSE_CACHE.clear()
+            with mock.patch('q2_pysyndna._type_format_length.pandas.read_csv',
+                            side_effect=AssertionError("reparsed")):
+                obs_df = length_fp_to_df(fp)
+
+        assert_frame_equal(expected_df, obs_df)
+
+    def test_coords_fp_to_arrays_disk_cached(self):
+        fp = self._copy_into_artifact('coords.txt')
+        disk_cache = DiskCache(self.cache_dir, 1024 ** 2)
+        with mock.patch.object(parse_cache, 'DISK_CACHE', disk_cache):
+            expected = coords_fp_to_arrays(fp)
+            parse_cache.PARSE_CACHE.clear()
+            with mock.patch(
+                    'q2_pysyndna._type_format_coords.parse_coords_fp',
+                    side_effect=AssertionError("reparsed")):
+                obs = coords_fp_to_arrays(fp)
+
+        self.assertListEqual(expected.genome_ids, obs.genome_ids)
+        for field in ['block_sizes', 'orf_ids', 'starts', 'ends']:
+            np.testing.assert_array_equal(
+                getattr(expected, field), getattr(obs, field))
+        self.assertFalse(obs.starts.flags.writeable)
+
+    def test_get_artifact_uuid_and_relpath(self):
+        fp = os.path.join(self.working_dir, self.UUID, 'data', 'sub', 'x.tsv')
+        self.assertEqual((self.UUID, 'sub/x.tsv'),
+                         get_artifact_uuid_and_relpath(fp))
+
+        fp = os.path.join(self.working_dir, 'not-a-uuid', 'data', 'x.tsv')
+        self.assertIsNone(get_artifact_uuid_and_relpath(fp))
+
+    def test_get_disk_cache_key(self):
+        fp = os.path.join(self.working_dir, self.UUID, 'data', 'x.tsv')
+        other_fp = os.path.join(
+            self.working_dir, self.UUID, 'data', 'y.tsv')
+
+        key = get_disk_cache_key(fp, self._parse_csv)
+        self.assertEqual(key, get_disk_cache_key(fp, self._parse_csv))
+        self.assertNotEqual(key, get_disk_cache_key(other_fp, self._parse_csv))
+        self.assertNotEqual(key, get_disk_cache_key(fp, length_fp_to_df))
+        with mock.patch('q2_pysyndna._disk_cache.get_versions',
+                        return_value={'version': 'other'}):
+            self.assertNotEqual(key, get_disk_cache_key(fp, self._parse_csv))
+
+    def test_get_disk_cache_from_env(self):
+        with mock.patch.dict(os.environ, {}, clear=True):
+            self.assertIsNone(get_disk_cache_from_env())
+
+        env = {DISK_CACHE_DIR_ENV_VAR: self.cache_dir,
+               DISK_CACHE_MAX_BYTES_ENV_VAR: '1000'}
+        with mock.patch.dict(os.environ, env, clear=True):
+            obs = get_disk_cache_from_env()
+        self.assertEqual(self.cache_dir, obs.cache_dir)
+        self.assertEqual(1000, obs.max_bytes)
+
+        env[DISK_CACHE_MAX_BYTES_ENV_VAR] = 'lots'
+        with mock.patch.dict(os.environ, env, clear=True):
+            with self.assertRaisesRegex(ValueError, "integer number of bytes"):
+                get_disk_cache_from_env()
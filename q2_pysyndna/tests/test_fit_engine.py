@@ -0,0 +1,220 @@
+import biom
+import numpy as np
+import numpy.testing as npt
+import pandas
+from qiime2.plugin.testing import TestPluginBase
+from scipy import stats
+
+from pysyndna import fit_linear_regression_models
+from pysyndna.src.fit_syndna_models import REGRESSION_KEYS, SAMPLE_ID_KEY, \
+    SYNDNA_ID_KEY, SYNDNA_INDIV_NG_UL_KEY, SYNDNA_POOL_MASS_NG_KEY, \
+    SAMPLE_TOTAL_READS_KEY
+from q2_pysyndna import __package_name__
+from q2_pysyndna._fit_engine import batched_linregress, \
+    fit_linear_regression_models_batched, calc_sample_input_fingerprints, \
+    get_dropped_syndna_ids
+
+
+class TestFitEngine(TestPluginBase):
+    package = f'{__package_name__}.tests'
+
+    SYNDNA_IDS = ['p126', 'p136', 'p146', 'p156', 'p166']
+    SAMPLE_IDS = ['A', 'B', 'C']
+    SYNDNA_CONCS_DF = pandas.DataFrame({
+        SYNDNA_ID_KEY: SYNDNA_IDS,
+        SYNDNA_INDIV_NG_UL_KEY: [1, 0.1, 0.01, 0.001, 0.0001]})
+    SAMPLE_INFO_DF = pandas.DataFrame({
+        SAMPLE_ID_KEY: SAMPLE_IDS,
+        SYNDNA_POOL_MASS_NG_KEY: [0.25, 0.5, 0.25],
+        SAMPLE_TOTAL_READS_KEY: [2000000, 3000000, 1000000]})
+    # syndnas x samples
+    COUNTS = np.array([[93135, 90897, 50],
+                       [15190, 15856, 0],
+                       [2241, 2468, 0],
+                       [267, 304, 0],
+                       [0, 48, 0]])
+
+    def _make_counts_table(self, counts=COUNTS):
+        return biom.Table(counts, self.SYNDNA_IDS, self.SAMPLE_IDS)
+
+    def _fit_with_linregress(self, counts, syndna_ids):
+        # the slow, one-sample-at-a-time version of the batched fit
+        concs = self.SYNDNA_CONCS_DF.set_index(SYNDNA_ID_KEY)[
+            SYNDNA_INDIV_NG_UL_KEY]
+        fractions = concs.loc[syndna_ids] / concs.sum()
+        expected = {}
+        for i, sample_id in enumerate(self.SAMPLE_IDS):
+            info = self.SAMPLE_INFO_DF.iloc[i]
+            used = counts[:, i] > 0
+            x = np.log10(counts[used, i] /
+                         info[SAMPLE_TOTAL_READS_KEY] * 1e6)
+            y = np.log10(fractions[used] * info[SYNDNA_POOL_MASS_NG_KEY])
+            if used.sum() < 2:
+                expected[sample_id] = None
+                continue
+            result = stats.linregress(x, y)
+            expected[sample_id] = \
+                {k: getattr(result, k) for k in REGRESSION_KEYS}
+        return expected
+
+    def _assert_linregs_dicts_almost_equal(self, expected, observed):
+        self.assertEqual(list(expected.keys()), list(observed.keys()))
+        for sample_id, expected_linreg in expected.items():
+            if expected_linreg is None:
+                self.assertIsNone(observed[sample_id])
+                continue
+            self.assertEqual(list(REGRESSION_KEYS),
+                             list(observed[sample_id].keys()))
+            for k in REGRESSION_KEYS:
+                self.assertIsInstance(observed[sample_id][k], float)
+                npt.assert_allclose(
+                    expected_linreg[k], observed[sample_id][k],
+                    rtol=1e-10, atol=1e-300, err_msg=f"{sample_id} {k}")
+
+    def test_batched_linregress(self):
+        rng = np.random.default_rng(42)
+        x = rng.normal(size=(50, 12))
+        y = 2 * x + rng.normal(size=(50, 12))
+        mask = rng.random((50, 12)) > 0.2
+        # rows of exactly 3 and exactly 2 points
+        mask[0, :] = [True] * 3 + [False] * 9
+        mask[1, :] = [True] * 2 + [False] * 10
+
+        obs, obs_is_fit = batched_linregress(x, y, mask)
+
+        self.assertTrue(obs_is_fit.all())
+        for i in range(x.shape[0]):
+            expected = stats.linregress(x[i, mask[i]], y[i, mask[i]])
+            for k in REGRESSION_KEYS:
+                npt.assert_allclose(getattr(expected, k), obs[k][i],
+                                    rtol=1e-9, atol=1e-12,
+                                    err_msg=f"row {i} {k}")
+
+    def test_batched_linregress_unfittable(self):
+        x = np.array([[1.0, 2.0, 3.0],
+                      [1.0, 1.0, 1.0],
+                      [1.0, np.inf, np.nan]])
+        y = np.array([[1.0, 2.0, 3.0],
+                      [1.0, 2.0, 3.0],
+                      [1.0, 2.0, 3.0]])
+        mask = np.array([[True, True, True],
+                         [True, True, True],
+                         [True, False, False]])
+
+        obs, obs_is_fit = batched_linregress(x, y, mask)
+
+        npt.assert_array_equal([True, False, False], obs_is_fit)
+        npt.assert_allclose([1.0, 0.0, 1.0], [obs['slope'][0],
+                            obs['intercept'][0], obs['rvalue'][0]],
+                            atol=1e-12)
+        for k in REGRESSION_KEYS:
+            self.assertTrue(np.isnan(obs[k][1:]).all())
+
+    def test_fit_linear_regression_models_batched(self):
+        obs_dict, obs_msgs = fit_linear_regression_models_batched(
+            self.SYNDNA_CONCS_DF, self.SAMPLE_INFO_DF,
+            self._make_counts_table(), 1)
+
+        expected_dict = self._fit_with_linregress(
+            self.COUNTS, self.SYNDNA_IDS)
+        self._assert_linregs_dicts_almost_equal(expected_dict, obs_dict)
+        # C, which can't be fit, is left to pysyndna, with its messages
+        _, expected_msgs = fit_linear_regression_models(
+            self.SYNDNA_CONCS_DF, self.SAMPLE_INFO_DF.iloc[[2]],
+            self._make_counts_table().filter(
+                ['C'], inplace=False).to_dataframe(dense=True), 0)
+        self.assertListEqual(expected_msgs, obs_msgs)
+
+    def test_fit_linear_regression_models_batched_drops_syndnas(self):
+        obs_dict, obs_msgs = fit_linear_regression_models_batched(
+            self.SYNDNA_CONCS_DF, self.SAMPLE_INFO_DF,
+            self._make_counts_table(), 200)
+
+        expected_dict = self._fit_with_linregress(
+            self.COUNTS[:4, :], self.SYNDNA_IDS[:4])
+        self._assert_linregs_dicts_almost_equal(expected_dict, obs_dict)
+        self.assertEqual(
+            "The following syndnas were dropped because they had fewer "
+            "than 200 total reads aligned:['p166']", obs_msgs[0])
+
+    def test_fit_linear_regression_models_batched_missing_sample(self):
+        sample_info_df = self.SAMPLE_INFO_DF.iloc[:2]
+
+        with self.assertRaisesRegex(
+                ValueError, r"sample ids .* not in the metadata: \['C'\]"):
+            fit_linear_regression_models_batched(
+                self.SYNDNA_CONCS_DF, sample_info_df,
+                self._make_counts_table(), 1)
+
+    def test_fit_linear_regression_models_batched_other_features(self):
+        # features not in the pool are ignored; pool synDNAs missing from the
+        # table have no reads (so are dropped)
+        counts = np.vstack([self.COUNTS[:4, :], [[7, 8, 9]]])
+        feature_ids = self.SYNDNA_IDS[:4] + ['G000005825']
+        counts_table = biom.Table(counts, feature_ids, self.SAMPLE_IDS)
+
+        obs_dict, obs_msgs = fit_linear_regression_models_batched(
+            self.SYNDNA_CONCS_DF, self.SAMPLE_INFO_DF, counts_table, 1)
+
+        expected_dict = self._fit_with_linregress(
+            self.COUNTS[:4, :], self.SYNDNA_IDS[:4])
+        self._assert_linregs_dicts_almost_equal(expected_dict, obs_dict)
+        self.assertEqual(
+            "The following syndnas were dropped because they had fewer "
+            "than 1 total reads aligned:['p166']", obs_msgs[0])
+
+    def test_fit_linear_regression_models_batched_sparse_input(self):
+        # a table wide in samples, most of them without any synDNA reads
+        num_samples = 2000
+        sample_ids = [f's{i}' for i in range(num_samples)]
+        counts = np.zeros((len(self.SYNDNA_IDS), num_samples))
+        counts[:, :3] = self.COUNTS
+        counts_table = biom.Table(counts, self.SYNDNA_IDS, sample_ids)
+        sample_info_df = pandas.DataFrame({
+            SAMPLE_ID_KEY: sample_ids,
+            SYNDNA_POOL_MASS_NG_KEY: 0.25,
+            SAMPLE_TOTAL_READS_KEY: 1000000})
+
+        obs_dict, _ = fit_linear_regression_models_batched(
+            self.SYNDNA_CONCS_DF, sample_info_df, counts_table, 1)
+
+        self.assertEqual(sample_ids, list(obs_dict.keys()))
+        self.assertIsNotNone(obs_dict['s0'])
+        self.assertIsNone(obs_dict['s3'])
+
+    def test_get_dropped_syndna_ids(self):
+        self.assertListEqual([], get_dropped_syndna_ids(
+            self.SYNDNA_CONCS_DF, self._make_counts_table(), 48))
+        self.assertListEqual(['p156', 'p166'], get_dropped_syndna_ids(
+            self.SYNDNA_CONCS_DF, self._make_counts_table(), 572))
+
+    def test_calc_sample_input_fingerprints(self):
+        obs = calc_sample_input_fingerprints(
+            self.SYNDNA_CONCS_DF, self.SAMPLE_INFO_DF,
+            self._make_counts_table(), 1, 'batched')
+
+        self.assertListEqual(self.SAMPLE_IDS, list(obs.keys()))
+        self.assertEqual(3, len(set(obs.values())))
+
+    def test_calc_sample_input_fingerprints_dropped_syndnas(self):
+        # a change in C's counts changes whether p166 is dropped, which
+        # changes the fingerprints of A and B too
+        counts = self.COUNTS.copy()
+        counts[4, 2] = 10
+        obs = calc_sample_input_fingerprints(
+            self.SYNDNA_CONCS_DF, self.SAMPLE_INFO_DF,
+            self._make_counts_table(), 50, 'batched')
+        changed_obs = calc_sample_input_fingerprints(
+            self.SYNDNA_CONCS_DF, self.SAMPLE_INFO_DF,
+            self._make_counts_table(counts), 50, 'batched')
+
+        for sample_id in self.SAMPLE_IDS:
+            self.assertNotEqual(obs[sample_id], changed_obs[sample_id])
+
+    def test_calc_sample_input_fingerprints_missing_sample(self):
+        # samples that aren't in the metadata have no fingerprint
+        obs = calc_sample_input_fingerprints(
+            self.SYNDNA_CONCS_DF, self.SAMPLE_INFO_DF.iloc[:2],
+            self._make_counts_table(), 1, 'batched')
+
+        self.assertListEqual(['A', 'B'], list(obs.keys()))
@@ -1,9 +1,16 @@
+import os
+import shutil
+import tempfile
+from unittest import mock
+
 import biom
 import numpy as np
+import numpy.testing as npt
 import pandas as pd
 from qiime2 import Metadata
 from qiime2.plugin.testing import TestPluginBase
 
+from pysyndna import OGU_CELLS_PER_G_OF_SAMPLE_KEY
 from pysyndna.tests.test_fit_syndna_models import FitSyndnaModelsTestData, \
     SYNDNA_ID_KEY
 from pysyndna.tests.test_calc_cell_counts import TestCalcCellCountsData, \
@@ -12,10 +19,26 @@ from pysyndna.tests.test_calc_cell_counts import TestCalcCellCountsData, \
     OGU_ID_KEY, OGU_CELLS_PER_G_OF_GDNA_KEY, SAMPLE_IN_ALIQUOT_MASS_G_KEY
 from pysyndna.tests.test_quant_orfs import TestQuantOrfsData, OGU_ORF_ID_KEY
 from pysyndna.tests.test_util import Testers
-from q2_pysyndna import __package_name__, fit, count_cells, count_copies
+from q2_pysyndna import __package_name__, fit, merge_regressions, \
+    count_cells, calc_genome_coverages, count_cells_gdna_and_sample, \
+    count_cells_sweep, count_copies, CoordsDirectoryFormat, \
+    LinearRegressionsDirectoryFormat
 from q2_pysyndna._type_format_linear_regressions import \
-    LinearRegressionsObjects
-from q2_pysyndna._type_format_length import LENGTH_KEY, FEATURE_NAME_KEY
+    LinearRegressionsObjects, \
+    linear_regressions_directory_format_to_linear_regressions_objects
+from q2_pysyndna.tests.test_type_format_linear_regressions import \
+    TestLinearRegressionsTransformers
+from q2_pysyndna._type_format_length import LENGTH_KEY, FEATURE_NAME_KEY, \
+    df_to_tsv_length_format, tsv_length_format_to_tsv_length_directory_format
+from q2_pysyndna._biom_hdf5 import biom_dir_fmt_to_table, \
+    table_to_biom_dir_fmt
+from q2_pysyndna._cell_count_engine import PYSYNDNA_CELL_COUNT_ENGINE, \
+    SPARSE_CELL_COUNT_ENGINE, make_sweep_key
+from q2_pysyndna._copy_count_engine import PYSYNDNA_COPY_COUNT_ENGINE, \
+    SPARSE_COPY_COUNT_ENGINE, CHECKPOINT_DIR_ENV_VAR
+from q2_pysyndna._fit_engine import BATCHED_FIT_ENGINE, \
+    fit_linear_regression_models_batched
+from q2_pysyndna.tests.test_fit_engine import TestFitEngine
 
 
 class TestFit(TestPluginBase):
@@ -50,11 +73,300 @@ class TestFit(TestPluginBase):
             FitSyndnaModelsTestData.lingress_results, out_linregress_dict)
         self.assertEqual([], out_msgs)
 
+    def _fit_batched_and_pysyndna(self, counts_array, min_count):
+        data = FitSyndnaModelsTestData
+        syndna_concs_df = pd.DataFrame(data.syndna_concs_dict)
+        sample_syndna_weights_and_total_reads_df = pd.DataFrame(
+            data.a_b_sample_syndna_weights_and_total_reads_dict)
+        sample_syndna_weights_and_total_reads_df.set_index(
+            SAMPLE_ID_KEY, inplace=True)
+        metadata = Metadata(sample_syndna_weights_and_total_reads_df)
+        input_biom = biom.table.Table(
+            counts_array, data.reads_per_syndna_per_sample_dict[SYNDNA_ID_KEY],
+            data.sample_ids)
+
+        pysyndna_objs = fit(syndna_concs_df, input_biom, metadata, min_count)
+        batched_objs = fit(syndna_concs_df, input_biom, metadata, min_count,
+                           engine=BATCHED_FIT_ENGINE)
+        return pysyndna_objs, batched_objs
+
+    def test_fit_batched(self):
+        counts_array = np.asarray(
+            FitSyndnaModelsTestData.reads_per_syndna_per_sample_array)
+        # with and without synDNAs dropped for having too few reads
+        drop_min_count = int(np.sort(counts_array.sum(axis=1))[1]) + 1
+        for min_count in [50, drop_min_count]:
+            pysyndna_objs, batched_objs = self._fit_batched_and_pysyndna(
+                counts_array, min_count)
+
+            self.assertEqual(list(pysyndna_objs.linregs_dict.keys()),
+                             list(batched_objs.linregs_dict.keys()))
+            a_tester = Testers()
+            a_tester.assert_dicts_almost_equal(
+                pysyndna_objs.linregs_dict, batched_objs.linregs_dict)
+            self.assertEqual(pysyndna_objs.log_msgs_list,
+                             batched_objs.log_msgs_list)
+
+    def test_fit_batched_unfittable_sample(self):
+        # a sample with reads of only one synDNA can't be fit; its result
+        # and log message are pysyndna's
+        counts_array = np.array(
+            FitSyndnaModelsTestData.reads_per_syndna_per_sample_array,
+            dtype=float)
+        counts_array[1:, 0] = 0
+        pysyndna_objs, batched_objs = self._fit_batched_and_pysyndna(
+            counts_array, 0)
+
+        self.assertIsNone(batched_objs.linregs_dict[
+            FitSyndnaModelsTestData.sample_ids[0]])
+        a_tester = Testers()
+        a_tester.assert_dicts_almost_equal(
+            pysyndna_objs.linregs_dict, batched_objs.linregs_dict)
+        self.assertNotEqual([], batched_objs.log_msgs_list)
+        self.assertEqual(pysyndna_objs.log_msgs_list,
+                         batched_objs.log_msgs_list)
+
+    def _fit_serial_and_sharded(self, min_count):
+        data = FitSyndnaModelsTestData
+        syndna_concs_df = pd.DataFrame(data.syndna_concs_dict)
+        sample_syndna_weights_and_total_reads_df = pd.DataFrame(
+            data.a_b_sample_syndna_weights_and_total_reads_dict)
+        sample_syndna_weights_and_total_reads_df.set_index(
+            SAMPLE_ID_KEY, inplace=True)
+        metadata = Metadata(sample_syndna_weights_and_total_reads_df)
+        input_biom = biom.table.Table(
+            data.reads_per_syndna_per_sample_array,
+            data.reads_per_syndna_per_sample_dict[SYNDNA_ID_KEY],
+            data.sample_ids)
+
+        serial_objs = fit(syndna_concs_df, input_biom, metadata, min_count)
+        sharded_objs = fit(syndna_concs_df, input_biom, metadata, min_count,
+                           n_jobs=2)
+        return serial_objs, sharded_objs
+
+    def test_fit_n_jobs(self):
+        serial_objs, sharded_objs = self._fit_serial_and_sharded(50)
+
+        self.assertEqual(list(serial_objs.linregs_dict.keys()),
+                         list(sharded_objs.linregs_dict.keys()))
+        self.assertEqual(serial_objs.linregs_dict, sharded_objs.linregs_dict)
+        self.assertEqual(serial_objs.log_msgs_list,
+                         sharded_objs.log_msgs_list)
+        self.assertEqual(serial_objs.input_fingerprints,
+                         sharded_objs.input_fingerprints)
+
+    def test_fit_n_jobs_drops_syndnas(self):
+        # synDNAs are dropped based on their reads across all samples, not
+        # just those of each process's shard
+        min_count = int(np.sort(np.asarray(
+            FitSyndnaModelsTestData.reads_per_syndna_per_sample_array).sum(
+                axis=1))[1]) + 1
+        serial_objs, sharded_objs = self._fit_serial_and_sharded(min_count)
+
+        self.assertEqual(serial_objs.linregs_dict, sharded_objs.linregs_dict)
+        self.assertEqual(serial_objs.log_msgs_list,
+                         sharded_objs.log_msgs_list)
+
+
+class TestFitIncremental(TestPluginBase):
+    package = f'{__package_name__}.tests'
+
+    def setUp(self):
+        super().setUp()
+        self.syndna_concs_df = TestFitEngine.SYNDNA_CONCS_DF
+        self.metadata = Metadata(
+            TestFitEngine.SAMPLE_INFO_DF.set_index(SAMPLE_ID_KEY))
+
+    def _make_counts_biom(self, counts, sample_ids):
+        return biom.table.Table(counts, TestFitEngine.SYNDNA_IDS, sample_ids)
+
+    def test_fit_records_input_fingerprints(self):
+        counts_biom = self._make_counts_biom(
+            TestFitEngine.COUNTS, TestFitEngine.SAMPLE_IDS)
+
+        out_objs = fit(self.syndna_concs_df, counts_biom, self.metadata,
+                       engine=BATCHED_FIT_ENGINE)
+
+        self.assertListEqual(TestFitEngine.SAMPLE_IDS,
+                             list(out_objs.input_fingerprints.keys()))
+
+    def test_fit_incremental(self):
+        first_objs = fit(
+            self.syndna_concs_df,
+            self._make_counts_biom(TestFitEngine.COUNTS[:, :2], ['A', 'B']),
+            self.metadata, engine=BATCHED_FIT_ENGINE)
+
+        # A is unchanged, B has changed counts and C is new
+        counts = TestFitEngine.COUNTS.copy()
+        counts[0, 1] += 1000
+        all_objs = fit(
+            self.syndna_concs_df,
+            self._make_counts_biom(counts, TestFitEngine.SAMPLE_IDS),
+            self.metadata, engine=BATCHED_FIT_ENGINE)
+
+        with mock.patch(
+                'q2_pysyndna._method.fit_linear_regression_models_batched',
+                wraps=fit_linear_regression_models_batched) as mock_fit:
+            out_objs = fit(
+                self.syndna_concs_df,
+                self._make_counts_biom(counts, TestFitEngine.SAMPLE_IDS),
+                self.metadata, engine=BATCHED_FIT_ENGINE,
+                existing_regression_models=first_objs)
+
+        fit_sample_ids = mock_fit.call_args[0][2].ids(axis='sample')
+        self.assertListEqual(['B', 'C'], list(fit_sample_ids))
+        self.assertDictEqual(all_objs.linregs_dict, out_objs.linregs_dict)
+        self.assertListEqual(['A', 'B', 'C'],
+                             list(out_objs.linregs_dict.keys()))
+        self.assertDictEqual(all_objs.input_fingerprints,
+                             out_objs.input_fingerprints)
+        self.assertListEqual(
+            first_objs.log_msgs_list +
+            ["Incremental fit kept 1 existing regressions and fit 2 new or "
+             "changed samples."] +
+            all_objs.log_msgs_list,
+            out_objs.log_msgs_list)
+
+    def test_fit_incremental_nothing_changed(self):
+        counts_biom = self._make_counts_biom(
+            TestFitEngine.COUNTS, TestFitEngine.SAMPLE_IDS)
+        first_objs = fit(self.syndna_concs_df, counts_biom, self.metadata,
+                         engine=BATCHED_FIT_ENGINE)
+
+        out_objs = fit(self.syndna_concs_df, counts_biom, self.metadata,
+                       engine=BATCHED_FIT_ENGINE,
+                       existing_regression_models=first_objs)
+
+        self.assertDictEqual(first_objs.linregs_dict, out_objs.linregs_dict)
+        self.assertEqual(
+            "Incremental fit kept 3 existing regressions and fit 0 new or "
+            "changed samples.", out_objs.log_msgs_list[-1])
+
+    def test_fit_incremental_wo_fingerprints(self):
+        # regressions fit before fingerprints were recorded are all refit
+        counts_biom = self._make_counts_biom(
+            TestFitEngine.COUNTS, TestFitEngine.SAMPLE_IDS)
+        first_objs = fit(self.syndna_concs_df, counts_biom, self.metadata,
+                         engine=BATCHED_FIT_ENGINE)
+        old_objs = LinearRegressionsObjects(
+            {'D': None, **first_objs.linregs_dict}, ["old msg"])
+
+        out_objs = fit(self.syndna_concs_df, counts_biom, self.metadata,
+                       engine=BATCHED_FIT_ENGINE,
+                       existing_regression_models=old_objs)
+
+        self.assertListEqual(['D', 'A', 'B', 'C'],
+                             list(out_objs.linregs_dict.keys()))
+        self.assertEqual(
+            "Incremental fit kept 1 existing regressions and fit 3 new or "
+            "changed samples.", out_objs.log_msgs_list[1])
+        self.assertDictEqual(first_objs.input_fingerprints,
+                             out_objs.input_fingerprints)
+
+    def test_fit_incremental_drops_as_full_fit(self):
+        # synDNAs are dropped based on their reads across all the samples,
+        # not just the new one being fit: p166 has 58 reads in all, but
+        # just 5 in C
+        counts = np.hstack([TestFitEngine.COUNTS[:, :2],
+                            [[50], [20], [0], [0], [5]]])
+        counts[4, 0] = 10
+        first_objs = fit(
+            self.syndna_concs_df,
+            self._make_counts_biom(counts[:, :2], ['A', 'B']),
+            self.metadata, 50, engine=BATCHED_FIT_ENGINE)
+        all_objs = fit(
+            self.syndna_concs_df,
+            self._make_counts_biom(counts, TestFitEngine.SAMPLE_IDS),
+            self.metadata, 50, engine=BATCHED_FIT_ENGINE)
+
+        with mock.patch(
+                'q2_pysyndna._method.fit_linear_regression_models_batched',
+                wraps=fit_linear_regression_models_batched) as mock_fit:
+            out_objs = fit(
+                self.syndna_concs_df,
+                self._make_counts_biom(counts, TestFitEngine.SAMPLE_IDS),
+                self.metadata, 50, engine=BATCHED_FIT_ENGINE,
+                existing_regression_models=first_objs)
+
+        fit_sample_ids = mock_fit.call_args[0][2].ids(axis='sample')
+        self.assertListEqual(['C'], list(fit_sample_ids))
+        self.assertIsNotNone(out_objs.linregs_dict['C'])
+        self.assertDictEqual(all_objs.linregs_dict, out_objs.linregs_dict)
+        self.assertDictEqual(all_objs.input_fingerprints,
+                             out_objs.input_fingerprints)
+
+    def test_fit_incremental_dropped_syndnas_changed(self):
+        # p166 has too few reads in the first fit, but not once A has some:
+        # every sample is refit, since which synDNAs are dropped changed
+        first_objs = fit(
+            self.syndna_concs_df,
+            self._make_counts_biom(TestFitEngine.COUNTS[:, :2], ['A', 'B']),
+            self.metadata, 50, engine=BATCHED_FIT_ENGINE)
+        counts = TestFitEngine.COUNTS[:, :2].copy()
+        counts[4, 0] = 10
+        counts_biom = self._make_counts_biom(counts, ['A', 'B'])
+        all_objs = fit(self.syndna_concs_df, counts_biom, self.metadata, 50,
+                       engine=BATCHED_FIT_ENGINE)
+
+        out_objs = fit(self.syndna_concs_df, counts_biom, self.metadata, 50,
+                       engine=BATCHED_FIT_ENGINE,
+                       existing_regression_models=first_objs)
+
+        self.assertEqual(
+            "Incremental fit kept 0 existing regressions and fit 2 new or "
+            "changed samples.",
+            out_objs.log_msgs_list[len(first_objs.log_msgs_list)])
+        self.assertDictEqual(all_objs.linregs_dict, out_objs.linregs_dict)
+
+    def test_fit_incremental_sample_not_in_metadata(self):
+        # a sample that isn't in the metadata has no fingerprint, so it is
+        # always passed to the engine (which here rejects it)
+        first_objs = fit(
+            self.syndna_concs_df,
+            self._make_counts_biom(TestFitEngine.COUNTS, ['A', 'B', 'C']),
+            self.metadata, engine=BATCHED_FIT_ENGINE)
+
+        with self.assertRaisesRegex(
+                ValueError, r"not in the metadata: \['D'\]"):
+            fit(self.syndna_concs_df,
+                self._make_counts_biom(TestFitEngine.COUNTS, ['A', 'B', 'D']),
+                self.metadata, engine=BATCHED_FIT_ENGINE,
+                existing_regression_models=first_objs)
+
+
+class TestMergeRegressions(TestPluginBase):
+    package = f'{__package_name__}.tests'
+
+    def test_merge_regressions(self):
+        regression_models = [
+            LinearRegressionsDirectoryFormat(
+                self.get_data_path(x), mode='r')
+            for x in ['linear_regressions', 'linear_regressions_w_inputs']]
+
+        merged_format = merge_regressions(regression_models, 'last')
+
+        merged_objs = \
+            linear_regressions_directory_format_to_linear_regressions_objects(
+                merged_format)
+        self.assertDictEqual(
+            TestLinearRegressionsTransformers.TEST_DICT_1_2_3,
+            merged_objs.linregs_dict)
+        self.assertDictEqual(
+            TestLinearRegressionsTransformers.INPUT_FINGERPRINTS_1_2_3,
+            merged_objs.input_fingerprints)
+        self.assertListEqual(
+            TestLinearRegressionsTransformers.LINREGOBJ_1_2_3.log_msgs_list *
+            2 +
+            ["Kept the last regression of each of the following sample ids, "
+             "which had regressions in more than one input: ['example1', "
+             "'example2', 'example3']"],
+            merged_objs.log_msgs_list)
+
 
 class TestCountCells(TestPluginBase):
     package = f'{__package_name__}.tests'
 
-    def test_count_cells(self):
+    def _make_count_cells_inputs(self):
         params_dict = {k: TestCalcCellCountsData.sample_and_prep_input_dict[k]
                        for k in
                        [SAMPLE_ID_KEY, SAMPLE_IN_ALIQUOT_MASS_G_KEY,
@@ -78,6 +390,18 @@ class TestCountCells(TestPluginBase):
         lengths_df.set_index(OGU_ID_KEY, inplace=True)
         lengths_df.index.name = FEATURE_NAME_KEY
         lengths_df.columns = [LENGTH_KEY]
+        lengths_format = tsv_length_format_to_tsv_length_directory_format(
+            df_to_tsv_length_format(lengths_df))
+
+        linregs_objs = LinearRegressionsObjects(
+            TestCalcCellCountsData.linregresses_dict, ["test fit msg"])
+
+        return linregs_objs, table_to_biom_dir_fmt(counts_biom), \
+            lengths_format, metadata
+
+    def test_count_cells(self):
+        linregs_objs, counts_biom, lengths_format, metadata = \
+            self._make_count_cells_inputs()
 
         # Note that, in the output, the ogu_ids are apparently sorted
         # alphabetically--different than the input order
@@ -92,18 +416,16 @@ class TestCountCells(TestPluginBase):
         min_rsquared = 0.8
         output_metric = OGU_CELLS_PER_G_OF_GDNA_KEY
 
-        linregs_objs = LinearRegressionsObjects(
-            TestCalcCellCountsData.linregresses_dict, ["test fit msg"])
-
         # Note: 1) this is outputting the ogu_cell_counts_per_g_gdna, not the
         # ogu_cell_counts_per_g_sample (which is what is output by the qiita
         # version of this function) because I want to check that I really can
         # choose to get something else, and 2) this is using the full version
         # of Avogadro's #, not the truncated version that was used in the
         # notebook, so the results are slightly different (but more realistic)
-        output_biom, output_msgs = count_cells(
-            linregs_objs, counts_biom, lengths_df, metadata,
+        output_biom_format, output_msgs = count_cells(
+            linregs_objs, counts_biom, lengths_format, metadata,
             read_len, min_coverage, min_rsquared, output_metric)
+        output_biom = biom_dir_fmt_to_table(output_biom_format)
 
         # NB: only checking results to 2 decimals because Ubuntu and Mac
         # differ past that point. Not that it matters much since the decimal
@@ -117,6 +439,150 @@ class TestCountCells(TestPluginBase):
              "'example2;Haemophilus influenzae']"],
             output_msgs)
 
+    def test_count_cells_sparse(self):
+        linregs_objs, counts_biom, lengths_format, metadata = \
+            self._make_count_cells_inputs()
+
+        for output_metric in [OGU_CELLS_PER_G_OF_GDNA_KEY,
+                              OGU_CELLS_PER_G_OF_SAMPLE_KEY]:
+            expected_biom_format, expected_msgs = count_cells(
+                linregs_objs, counts_biom, lengths_format, metadata,
+                150, 1, 0.8, output_metric)
+            output_biom_format, output_msgs = count_cells(
+                linregs_objs, counts_biom, lengths_format, metadata,
+                150, 1, 0.8, output_metric, engine=SPARSE_CELL_COUNT_ENGINE)
+
+            self._assert_biom_formats_almost_equal(
+                expected_biom_format, output_biom_format)
+            self.assertListEqual(expected_msgs, output_msgs)
+
+    def test_count_cells_sparse_unusable_regressions(self):
+        # samples without a regression, or with too low an r-squared, are
+        # logged as pysyndna logs them
+        linregs_objs, counts_biom, lengths_format, metadata = \
+            self._make_count_cells_inputs()
+        sample_ids = list(linregs_objs.linregs_dict.keys())
+        linregs_dict = dict(linregs_objs.linregs_dict)
+        linregs_dict[sample_ids[0]] = None
+        linregs_objs = LinearRegressionsObjects(
+            linregs_dict, linregs_objs.log_msgs_list)
+        min_rsquared = \
+            linregs_dict[sample_ids[1]]['rvalue'] ** 2 + 1e-6
+
+        expected_biom_format, expected_msgs = count_cells(
+            linregs_objs, counts_biom, lengths_format, metadata,
+            150, 1, min_rsquared)
+        output_biom_format, output_msgs = count_cells(
+            linregs_objs, counts_biom, lengths_format, metadata,
+            150, 1, min_rsquared, engine=SPARSE_CELL_COUNT_ENGINE)
+
+        self._assert_biom_formats_almost_equal(
+            expected_biom_format, output_biom_format)
+        self.assertListEqual(expected_msgs, output_msgs)
+
+    def test_count_cells_blocked(self):
+        linregs_objs, counts_biom, lengths_format, metadata = \
+            self._make_count_cells_inputs()
+        expected_biom_format, expected_msgs = count_cells(
+            linregs_objs, counts_biom, lengths_format, metadata,
+            engine=SPARSE_CELL_COUNT_ENGINE)
+
+        for sample_block_size in [1, 2, 1000]:
+            output_biom_format, output_msgs = count_cells(
+                linregs_objs, counts_biom, lengths_format, metadata,
+                sample_block_size=sample_block_size)
+
+            self._assert_biom_formats_almost_equal(
+                expected_biom_format, output_biom_format)
+            self.assertListEqual(expected_msgs, output_msgs)
+
+    def test_count_cells_w_genome_coverages(self):
+        linregs_objs, counts_biom, lengths_format, metadata = \
+            self._make_count_cells_inputs()
+        coverages_format = calc_genome_coverages(
+            counts_biom, lengths_format, 150)
+
+        for engine in [PYSYNDNA_CELL_COUNT_ENGINE, SPARSE_CELL_COUNT_ENGINE]:
+            expected_biom_format, expected_msgs = count_cells(
+                linregs_objs, counts_biom, lengths_format, metadata,
+                engine=SPARSE_CELL_COUNT_ENGINE)
+            output_biom_format, output_msgs = count_cells(
+                linregs_objs, counts_biom, lengths_format, metadata,
+                engine=engine, genome_coverages=coverages_format)
+
+            self._assert_biom_formats_almost_equal(
+                expected_biom_format, output_biom_format)
+            self.assertListEqual(expected_msgs, output_msgs)
+
+    def test_count_cells_w_genome_coverages_blocked(self):
+        linregs_objs, counts_biom, lengths_format, metadata = \
+            self._make_count_cells_inputs()
+        coverages_format = calc_genome_coverages(
+            counts_biom, lengths_format)
+
+        with self.assertRaisesRegex(ValueError, "sample block size"):
+            count_cells(linregs_objs, counts_biom, lengths_format, metadata,
+                        sample_block_size=2,
+                        genome_coverages=coverages_format)
+
+    def test_count_cells_gdna_and_sample(self):
+        linregs_objs, counts_biom, lengths_format, metadata = \
+            self._make_count_cells_inputs()
+
+        for sample_block_size in [None, 2]:
+            obs_gdna_format, obs_sample_format, obs_msgs = \
+                count_cells_gdna_and_sample(
+                    linregs_objs, counts_biom, lengths_format, metadata,
+                    sample_block_size=sample_block_size)
+
+            for output_metric, output_biom_format in [
+                    (OGU_CELLS_PER_G_OF_GDNA_KEY, obs_gdna_format),
+                    (OGU_CELLS_PER_G_OF_SAMPLE_KEY, obs_sample_format)]:
+                expected_biom_format, expected_msgs = count_cells(
+                    linregs_objs, counts_biom, lengths_format, metadata,
+                    output_metric=output_metric,
+                    engine=SPARSE_CELL_COUNT_ENGINE)
+                self._assert_biom_formats_almost_equal(
+                    expected_biom_format, output_biom_format)
+                self.assertListEqual(expected_msgs, obs_msgs)
+
+    def test_count_cells_sweep(self):
+        linregs_objs, counts_biom, lengths_format, metadata = \
+            self._make_count_cells_inputs()
+        min_percent_coverages = [1, 5]
+        min_rsquareds = [0.8, 0.99]
+
+        obs_dict, obs_summary = count_cells_sweep(
+            linregs_objs, counts_biom, lengths_format, metadata,
+            min_percent_coverages, min_rsquareds)
+
+        self.assertEqual(4, len(obs_dict))
+        self.assertEqual(5, len(obs_summary))
+        for min_rsquared in min_rsquareds:
+            for min_percent_coverage in min_percent_coverages:
+                expected_biom_format, _ = count_cells(
+                    linregs_objs, counts_biom, lengths_format, metadata,
+                    min_percent_coverage=min_percent_coverage,
+                    min_rsquared=min_rsquared,
+                    engine=SPARSE_CELL_COUNT_ENGINE)
+                self._assert_biom_formats_almost_equal(
+                    expected_biom_format,
+                    obs_dict[make_sweep_key(
+                        min_rsquared, min_percent_coverage)])
+
+    def _assert_biom_formats_almost_equal(self, expected_format,
+                                          output_format):
+        expected_biom = biom_dir_fmt_to_table(expected_format)
+        output_biom = biom_dir_fmt_to_table(output_format)
+        self.assertListEqual(
+            list(expected_biom.ids(axis='observation')),
+            list(output_biom.ids(axis='observation')))
+        self.assertListEqual(list(expected_biom.ids()),
+                             list(output_biom.ids()))
+        npt.assert_allclose(expected_biom.matrix_data.toarray(),
+                            output_biom.matrix_data.toarray(),
+                            rtol=1e-9)
+
 
 class TestCountCopies(TestPluginBase):
     package = f'{__package_name__}.tests'
@@ -127,7 +593,8 @@ class TestCountCopies(TestPluginBase):
         input_quant_params_per_sample_df.set_index(SAMPLE_ID_KEY, inplace=True)
         metadata = Metadata(input_quant_params_per_sample_df)
 
-        ogu_orf_coords_df = pd.DataFrame(TestQuantOrfsData.COORDS_DICT)
+        ogu_orf_coords = CoordsDirectoryFormat(
+            self.get_data_path('coords_w_index'), mode='r')
 
         input_reads_per_ogu_orf_per_sample_biom = biom.table.Table(
             TestQuantOrfsData.COUNT_VALS,
@@ -141,7 +608,7 @@ class TestCountCopies(TestPluginBase):
 
         output_biom, output_msgs = count_copies(
             input_reads_per_ogu_orf_per_sample_biom,
-            ogu_orf_coords_df, metadata)
+            ogu_orf_coords, metadata)
 
         # NB: Comparing the bioms as dataframes because the biom equality
         # compare does not allow "almost equal" checking for float values,
@@ -151,3 +618,93 @@ class TestCountCopies(TestPluginBase):
         pd.testing.assert_frame_equal(output_df, expected_df)
 
         self.assertListEqual([], output_msgs)
+
+    def test_count_copies_sparse(self):
+        input_quant_params_per_sample_df = pd.DataFrame(
+            TestQuantOrfsData.PARAMS_DICT)
+        input_quant_params_per_sample_df.set_index(SAMPLE_ID_KEY, inplace=True)
+        metadata = Metadata(input_quant_params_per_sample_df)
+
+        ogu_orf_coords = CoordsDirectoryFormat(
+            self.get_data_path('coords_w_index'), mode='r')
+
+        input_reads_per_ogu_orf_per_sample_biom = biom.table.Table(
+            TestQuantOrfsData.COUNT_VALS,
+            TestQuantOrfsData.LEN_AND_COPIES_DICT[OGU_ORF_ID_KEY],
+            TestQuantOrfsData.SAMPLE_IDS)
+
+        expected_biom, expected_msgs = count_copies(
+            input_reads_per_ogu_orf_per_sample_biom,
+            ogu_orf_coords, metadata)
+
+        output_biom, output_msgs = count_copies(
+            input_reads_per_ogu_orf_per_sample_biom,
+            ogu_orf_coords, metadata, engine=SPARSE_COPY_COUNT_ENGINE)
+
+        # the sparse engine gives the same copies as pysyndna
+        pd.testing.assert_frame_equal(
+            output_biom.to_dataframe(dense=True),
+            expected_biom.to_dataframe(dense=True))
+        self.assertListEqual(expected_msgs, output_msgs)
+
+    def _make_count_copies_inputs(self):
+        input_quant_params_per_sample_df = pd.DataFrame(
+            TestQuantOrfsData.PARAMS_DICT)
+        input_quant_params_per_sample_df.set_index(SAMPLE_ID_KEY, inplace=True)
+        metadata = Metadata(input_quant_params_per_sample_df)
+
+        ogu_orf_coords = CoordsDirectoryFormat(
+            self.get_data_path('coords_w_index'), mode='r')
+
+        input_reads_per_ogu_orf_per_sample_biom = biom.table.Table(
+            TestQuantOrfsData.COUNT_VALS,
+            TestQuantOrfsData.LEN_AND_COPIES_DICT[OGU_ORF_ID_KEY],
+            TestQuantOrfsData.SAMPLE_IDS)
+        return input_reads_per_ogu_orf_per_sample_biom, ogu_orf_coords, \
+            metadata
+
+    def test_count_copies_chunked(self):
+        inputs = self._make_count_copies_inputs()
+        working_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, working_dir)
+
+        for engine in [PYSYNDNA_COPY_COUNT_ENGINE, SPARSE_COPY_COUNT_ENGINE]:
+            expected_biom, expected_msgs = count_copies(
+                *inputs, engine=engine)
+            checkpoint_dir = os.path.join(working_dir, engine)
+
+            # the second run loads the blocks the first one checkpointed
+            for _ in range(2):
+                with mock.patch.dict(
+                        os.environ, {CHECKPOINT_DIR_ENV_VAR: checkpoint_dir}):
+                    output_biom, output_msgs = count_copies(
+                        *inputs, engine=engine, sample_block_size=1)
+
+                pd.testing.assert_frame_equal(
+                    output_biom.to_dataframe(dense=True),
+                    expected_biom.to_dataframe(dense=True))
+                self.assertListEqual(expected_msgs, output_msgs)
+            self.assertEqual(len(TestQuantOrfsData.SAMPLE_IDS),
+                             len(os.listdir(checkpoint_dir)))
+
+    def test_count_copies_checkpoint_without_blocks(self):
+        # only blocks of samples are checkpointed
+        working_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, working_dir)
+        checkpoint_dir = os.path.join(working_dir, 'checkpoints')
+
+        with mock.patch.dict(
+                os.environ, {CHECKPOINT_DIR_ENV_VAR: checkpoint_dir}):
+            count_copies(*self._make_count_copies_inputs())
+
+        self.assertFalse(os.path.exists(checkpoint_dir))
+
+    def test_count_copies_chunked_wo_checkpoints_wo_lens(self):
+        # the pysyndna engine looks up the ORFs' lengths only to checkpoint
+        with mock.patch.dict(os.environ, {}, clear=True), mock.patch(
+                'q2_pysyndna._method.coords_directory_format_to_ogu_orf_lens'
+        ) as mock_lens:
+            count_copies(*self._make_count_copies_inputs(),
+                         sample_block_size=1)
+
+        mock_lens.assert_not_called()
@@ -0,0 +1,177 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas
+from pandas.testing import assert_frame_equal
+from qiime2.plugin import ValidationError
+from qiime2.plugin.testing import TestPluginBase
+
+from q2_pysyndna import __package_name__
+from q2_pysyndna._parse_cache import ParseCache, PARSE_CACHE, cached_parse, \
+    get_file_fingerprint
+from q2_pysyndna._type_format_coords import coords_fp_to_arrays
+from q2_pysyndna._type_format_length import length_fp_to_df
+
+
+class TestParseCache(TestPluginBase):
+    package = f'{__package_name__}.tests'
+
+    def setUp(self):
+        super().setUp()
+        self.working_dir = tempfile.mkdtemp()
+        self.num_parses = 0
+        PARSE_CACHE.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.working_dir)
+        PARSE_CACHE.clear()
+        super().tearDown()
+
+    def _write(self, filename, text):
+        fp = os.path.join(self.working_dir, filename)
+        with open(fp, 'w') as fh:
+            fh.write(text)
+        return fp
+
+    def _parse(self, fp):
+        self.num_parses += 1
+        with open(fp) as fh:
+            return {'lines': fh.read().splitlines()}
+
+    def test_cached_parse_hit(self):
+        cache = ParseCache(max_bytes=1024 ** 2, max_entries=4)
+        fp = self._write('a.txt', 'x\ny\n')
+
+        first = cached_parse(fp, self._parse, cache=cache)
+        second = cached_parse(fp, self._parse, cache=cache)
+
+        self.assertEqual({'lines': ['x', 'y']}, second)
+        self.assertEqual(1, self.num_parses)
+        # callers get copies, so modifying one doesn't change the cache
+        first['lines'].append('z')
+        self.assertEqual({'lines': ['x', 'y']},
+                         cached_parse(fp, self._parse, cache=cache))
+
+    def test_cached_parse_invalidated_by_change(self):
+        cache = ParseCache(max_bytes=1024 ** 2, max_entries=4)
+        fp = self._write('a.txt', 'x\ny\n')
+        _ = cached_parse(fp, self._parse, cache=cache)
+
+        # same size, so only the contents (and mtime) tell them apart
+        fp = self._write('a.txt', 'x\nz\n')
+        obs = cached_parse(fp, self._parse, cache=cache)
+
+        self.assertEqual({'lines': ['x', 'z']}, obs)
+        self.assertEqual(2, self.num_parses)
+
+    def test_cached_parse_error_not_cached(self):
+        cache = ParseCache(max_bytes=1024 ** 2, max_entries=4)
+        fp = self._write('a.txt', 'x\n')
+
+        def failing_parse(x):
+            self.num_parses += 1
+            raise ValidationError("bad file")
+
+        for _ in range(2):
+            with self.assertRaisesRegex(ValidationError, "bad file"):
+                cached_parse(fp, failing_parse, cache=cache)
+        self.assertEqual(2, self.num_parses)
+        self.assertEqual(0, len(cache))
+
+    def test_cached_parse_disabled(self):
+        cache = ParseCache(max_bytes=0, max_entries=4)
+        fp = self._write('a.txt', 'x\n')
+
+        for _ in range(2):
+            _ = cached_parse(fp, self._parse, cache=cache)
+        self.assertEqual(2, self.num_parses)
+        self.assertEqual(0, len(cache))
+
+    def test_parse_cache_evicts_least_recently_used(self):
+        cache = ParseCache(max_bytes=1024 ** 2, max_entries=2)
+        cache.put('a', 1, 10)
+        cache.put('b', 2, 10)
+        _ = cache.get('a')
+        cache.put('c', 3, 10)
+
+        self.assertEqual(1, cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(3, cache.get('c'))
+
+    def test_parse_cache_memory_ceiling(self):
+        cache = ParseCache(max_bytes=100, max_entries=10)
+        cache.put('a', 1, 60)
+        cache.put('b', 2, 30)
+        cache.put('c', 3, 30)
+
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(60, cache.total_bytes)
+
+        # too big to cache at all: doesn't evict anything
+        cache.put('d', 4, 101)
+        self.assertIsNone(cache.get('d'))
+        self.assertEqual(2, len(cache))
+
+    def test_get_file_fingerprint(self):
+        fp = self._write('a.txt', 'x\n')
+        link_fp = os.path.join(self.working_dir, 'link.txt')
+        os.symlink(fp, link_fp)
+
+        self.assertEqual(get_file_fingerprint(fp),
+                         get_file_fingerprint(link_fp))
+
+    def test_get_file_fingerprint_full_contents(self):
+        # an edit anywhere in a large file, keeping its size and mtime,
+        # changes the fingerprint
+        fp = os.path.join(self.working_dir, 'large.txt')
+        contents = bytearray(b'x' * (3 * 1024 ** 2 + 1))
+        with open(fp, 'wb') as fh:
+            fh.write(contents)
+        stat = os.stat(fp)
+        fingerprint = get_file_fingerprint(fp)
+
+        contents[1024 ** 2 + 12345] = ord('y')
+        with open(fp, 'wb') as fh:
+            fh.write(contents)
+        os.utime(fp, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        changed_fingerprint = get_file_fingerprint(fp)
+
+        self.assertEqual(fingerprint[:3], changed_fingerprint[:3])
+        self.assertNotEqual(fingerprint[3], changed_fingerprint[3])
+
+    def test_length_fp_to_df_cached(self):
+        fp = self.get_data_path('feature_length/lengths.tsv')
+        first_df = length_fp_to_df(fp)
+        first_df.iloc[0, 0] = -1
+
+        second_df = length_fp_to_df(fp)
+
+        self.assertEqual(1, len(PARSE_CACHE))
+        self.assertGreaterEqual(second_df.iloc[0, 0], 0)
+
+    def test_coords_fp_to_arrays_cached(self):
+        fp = self.get_data_path('coords.txt')
+        first_arrays = coords_fp_to_arrays(fp)
+        second_arrays = coords_fp_to_arrays(fp)
+
+        self.assertEqual(1, len(PARSE_CACHE))
+        self.assertIs(first_arrays.starts, second_arrays.starts)
+        self.assertFalse(second_arrays.starts.flags.writeable)
+        self.assertIsNot(first_arrays.genome_ids, second_arrays.genome_ids)
+        with self.assertRaises(ValueError):
+            second_arrays.starts[0] = 0
+        np.testing.assert_array_equal(first_arrays.ends, second_arrays.ends)
+
+    def test_coords_df_from_cached_arrays_is_writeable(self):
+        from q2_pysyndna._type_format_coords import coords_fp_to_df
+
+        fp = self.get_data_path('coords.txt')
+        _ = coords_fp_to_arrays(fp)
+        obs_df = coords_fp_to_df(fp)
+        expected_df = obs_df.copy()
+        obs_df.iloc[0, 2] = 0
+
+        assert_frame_equal(expected_df, coords_fp_to_df(fp))
+        self.assertIsInstance(obs_df, pandas.DataFrame)
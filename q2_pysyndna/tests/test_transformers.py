@@ -5,7 +5,8 @@ from q2_pysyndna import (
     __package_name__, SyndnaPoolCsvFormat, LinearRegressionsYamlFormat,
     LinearRegressionsDirectoryFormat,
     PysyndnaLogFormat, PysyndnaLogDirectoryFormat,
-    TSVLengthFormat, CoordsFormat)
+    TSVLengthFormat, TSVLengthDirectoryFormat, CoordsFormat,
+    CoordsDirectoryFormat)
 from q2_pysyndna._type_format_linear_regressions import \
     LinearRegressionsObjects
 from q2_pysyndna.tests.test_type_format_linear_regressions import \
@@ -96,6 +97,22 @@ class TestTransformers(TestPluginBase):
 
         assert_frame_equal(obs_df, TestTSVLengthTransformers.TEST_DF)
 
+    def test_tsv_length_format_to_tsv_length_directory_format(self):
+        _, obs_format = self.transform_format(
+            TSVLengthFormat,
+            TSVLengthDirectoryFormat,
+            filename="feature_length/lengths.tsv")
+
+        obs_format.validate()
+
+    def test_tsv_length_directory_format_to_df(self):
+        _, obs_df = self.transform_format(
+            TSVLengthDirectoryFormat,
+            pandas.DataFrame,
+            filename="feature_length_w_index")
+
+        assert_frame_equal(obs_df, TestTSVLengthTransformers.TEST_DF)
+
     def test_coords_format_to_df(self):
         _, obs_df = self.transform_format(
             CoordsFormat,
@@ -103,3 +120,25 @@ class TestTransformers(TestPluginBase):
             filename="coords.txt")
 
         assert_frame_equal(obs_df, TestCoordsTransformers.TEST_DF)
+        self.assertListEqual(
+            TestCoordsTransformers.OGU_ORF_COORDS_COLUMNS,
+            obs_df.columns.tolist())
+
+    def test_coords_format_to_coords_directory_format(self):
+        _, obs_format = self.transform_format(
+            CoordsFormat,
+            CoordsDirectoryFormat,
+            filename="coords.txt")
+
+        obs_format.validate()
+
+    def test_coords_directory_format_to_df(self):
+        _, obs_df = self.transform_format(
+            CoordsDirectoryFormat,
+            pandas.DataFrame,
+            filename="coords_w_arrays")
+
+        assert_frame_equal(obs_df, TestCoordsTransformers.TEST_DF)
+        self.assertListEqual(
+            TestCoordsTransformers.OGU_ORF_COORDS_COLUMNS,
+            obs_df.columns.tolist())
@@ -1,16 +1,44 @@
+import os
+from unittest import mock
+
+import numpy as np
+import numpy.testing as npt
 import pandas
 from pandas.testing import assert_frame_equal
-from qiime2.plugin import ValidationError
+from qiime2.plugin import ValidationError, model
 from qiime2.plugin.testing import TestPluginBase
 from q2_types.feature_data import FeatureData
 
+from pysyndna import OGU_ID_KEY
 from pysyndna.tests.test_quant_orfs import TestQuantOrfsData
+from pysyndna.src.quant_orfs import \
+    OGU_ORF_ID_KEY, OGU_ORF_START_KEY, OGU_ORF_END_KEY
 from q2_pysyndna import (
     __package_name__,
     CoordsFormat, CoordsDirectoryFormat,
     Coords)
 from q2_pysyndna._type_format_coords import (
-    coords_fp_to_df, df_to_coords_format)
+    coords_fp_to_df, coords_fp_to_arrays, coords_arrays_to_df,
+    df_to_coords_format,
+    coords_format_to_coords_directory_format, coords_directory_format_to_df,
+    read_coords_arrays, calc_orf_lens,
+    coords_directory_format_to_ogu_orf_lens, ORF_NUM_KEY, ORF_LEN_KEY,
+    _coords_arrays_to_compact_df)
+
+
+def _make_compact_coords_df(genome_ids, orf_nums, starts, ends,
+                            orf_num_dtype=np.int16, coord_dtype=np.int32,
+                            orf_len_dtype=np.int16):
+    orf_lens = np.abs(np.array(ends) - np.array(starts)) + 1
+    return pandas.DataFrame({
+        OGU_ID_KEY: pandas.Categorical(
+            genome_ids, categories=pandas.Index(
+                pandas.unique(pandas.Series(genome_ids, dtype=object)),
+                dtype=object)),
+        ORF_NUM_KEY: np.array(orf_nums, dtype=orf_num_dtype),
+        OGU_ORF_START_KEY: np.array(starts, dtype=coord_dtype),
+        OGU_ORF_END_KEY: np.array(ends, dtype=coord_dtype),
+        ORF_LEN_KEY: orf_lens.astype(orf_len_dtype)})
 
 
 class TestCoordsTypes(TestPluginBase):
@@ -26,7 +54,8 @@ class TestTSVLengthFormat(TestPluginBase):
     package = f'{__package_name__}.tests'
 
     def test_coords_format_valid(self):
-        filenames = ['coords.txt']
+        filenames = ['coords.txt', 'coords_with_blank_line.txt',
+                     'coords.txt.gz', 'coords.txt.xz', 'coords.txt.zst']
         filepaths = [self.get_data_path(filename)
                      for filename in filenames]
 
@@ -34,44 +63,340 @@ class TestTSVLengthFormat(TestPluginBase):
             test_format = CoordsFormat(filepath, mode='r')
             test_format.validate()
 
+    def test_coords_format_valid_min(self):
+        filenames = ['coords.txt', 'coords.txt.gz']
+        filepaths = [self.get_data_path(filename)
+                     for filename in filenames]
+
+        for filepath in filepaths:
+            test_format = CoordsFormat(filepath, mode='r')
+            test_format.validate(level='min')
+
+    def test_coords_format_compressed_invalid(self):
+        expected_msg = "line 3: ORF, start and end must be integers"
+        filepath = self.get_data_path('coords_malformed_2.txt.gz')
+
+        for level in ['min', 'max']:
+            with self.assertRaisesRegex(ValidationError, expected_msg):
+                test_format = CoordsFormat(filepath, mode='r')
+                test_format.validate(level=level)
+
+    def test_coords_format_invalid_min(self):
+        expected_msg = "line 3: expected 3 tab-separated fields but found 2"
+        filepath = self.get_data_path('coords_malformed_1.txt')
+
+        with self.assertRaisesRegex(ValidationError, expected_msg):
+            test_format = CoordsFormat(filepath, mode='r')
+            test_format.validate(level='min')
+
     def test_coords_format_invalid(self):
-        expected_msg = "lengths.tsv is malformed or missing: list index " \
-                       "out of range"
+        expected_msg = "lengths.tsv is malformed or missing: line 1: ORF " \
+                       "line found before any '>' genome header"
         filepath = self.get_data_path('feature_length/lengths.tsv')
 
         with self.assertRaisesRegex(ValidationError, expected_msg):
             test_format = CoordsFormat(filepath, mode='r')
             test_format.validate()
 
+    def test_coords_format_malformed_invalid(self):
+        expected_msgs = [
+            "line 3: expected 3 tab-separated fields but found 2",
+            "line 3: ORF, start and end must be integers",
+            "line 3: empty genome header"]
+        filenames = ['coords_malformed_1.txt',
+                     'coords_malformed_2.txt',
+                     'coords_malformed_3.txt']
+
+        for filename, expected_msg in zip(filenames, expected_msgs):
+            filepath = self.get_data_path(filename)
+            with self.assertRaisesRegex(ValidationError, expected_msg):
+                test_format = CoordsFormat(filepath, mode='r')
+                test_format.validate()
+
+
+class TestCoordsDirectoryFormat(TestPluginBase):
+    package = f'{__package_name__}.tests'
+
+    def test_coords_directory_format_valid(self):
+        rel_fps = ['coords', 'coords_w_arrays', 'coords_w_index']
+        abs_fps = [self.get_data_path(rel_fp) for rel_fp in rel_fps]
+
+        for abs_fp in abs_fps:
+            test_format = CoordsDirectoryFormat(abs_fp, mode='r')
+            test_format.validate()
+
+    def test_coords_directory_format_single_file(self):
+        # so that a plain coords file imports without an input format
+        self.assertTrue(issubclass(
+            CoordsDirectoryFormat, model.SingleFileDirectoryFormatBase))
+        self.assertIs(CoordsFormat, CoordsDirectoryFormat.file.format)
+
+    def test_coords_directory_format_invalid(self):
+        abs_fp = self.get_data_path('coords_w_partial_arrays')
+
+        with self.assertRaisesRegex(
+                ValidationError,
+                "Coords arrays must be either all present or all absent."):
+            test_format = CoordsDirectoryFormat(abs_fp, mode='r')
+            test_format.validate()
+
+    def test_coords_directory_format_invalid_orf_lens(self):
+        abs_fp = self.get_data_path('coords_w_orf_lens_wo_arrays')
+
+        with self.assertRaisesRegex(
+                ValidationError,
+                "Coords ORF lengths must not be present without the coords "
+                "arrays."):
+            test_format = CoordsDirectoryFormat(abs_fp, mode='r')
+            test_format.validate()
+
+    def test_coords_directory_format_invalid_index(self):
+        abs_fp = self.get_data_path('coords_w_index_wo_arrays')
+
+        with self.assertRaisesRegex(
+                ValidationError,
+                "Coords block index must not be present without the coords "
+                "arrays."):
+            test_format = CoordsDirectoryFormat(abs_fp, mode='r')
+            test_format.validate()
+
 
 class TestCoordsTransformers(TestPluginBase):
     package = f'{__package_name__}.tests'
 
     TEST_DF = pandas.DataFrame(TestQuantOrfsData.COORDS_DICT)
+    OGU_ORF_COORDS_COLUMNS = [
+        OGU_ORF_ID_KEY, OGU_ORF_START_KEY, OGU_ORF_END_KEY]
+    # the same coords, as held compactly internally
+    TEST_COMPACT_DF = _make_compact_coords_df(
+        ["G000005825"] * 5 + ["G900163845"] * 5,
+        [1, 2, 3, 4, 5, 3247, 3248, 3249, 3250, 3251],
+        TEST_DF[OGU_ORF_START_KEY], TEST_DF[OGU_ORF_END_KEY])
 
     def test_coords_fp_to_df(self):
         test_fp = self.get_data_path('coords.txt')
         out_df = coords_fp_to_df(test_fp)
         assert_frame_equal(self.TEST_DF, out_df)
 
+    def test_coords_fp_to_df_compressed(self):
+        # compressed files are parsed serially, even if n_jobs asks otherwise
+        filenames = ['coords.txt.gz', 'coords.txt.xz', 'coords.txt.zst']
+        for filename in filenames:
+            for n_jobs in [None, 2]:
+                out_df = coords_fp_to_df(
+                    self.get_data_path(filename), n_jobs=n_jobs)
+                assert_frame_equal(self.TEST_DF, out_df)
+
+    def test_coords_fp_to_df_parallel(self):
+        test_fp = self.get_data_path('coords.txt')
+        out_df = coords_fp_to_df(test_fp, n_jobs=2)
+        assert_frame_equal(self.TEST_DF, out_df)
+
+    def test_coords_fp_to_df_parallel_err(self):
+        # the line number is relative to the whole file, not to the part of
+        # it parsed by whichever process found the problem
+        test_fp = self.get_data_path('coords_malformed_3.txt')
+        with self.assertRaisesRegex(
+                ValidationError, "line 3: empty genome header"):
+            coords_fp_to_df(test_fp, n_jobs=2)
+
+    def test_coords_fp_to_df_w_blank_line(self):
+        test_fp = self.get_data_path('coords_with_blank_line.txt')
+        expected_df = pandas.DataFrame({
+            OGU_ORF_ID_KEY: ["G000005825_1", "G000005825_2",
+                             "G900163845_3247"],
+            OGU_ORF_START_KEY: [816, 2348, 3392209],
+            OGU_ORF_END_KEY: [2168, 3490, 3390413]})
+
+        out_df = coords_fp_to_df(test_fp)
+        assert_frame_equal(expected_df, out_df)
+
+    def test_coords_format_to_coords_directory_format(self):
+        test_fp = self.get_data_path('coords.txt')
+        test_format = CoordsFormat(test_fp, mode='r')
+
+        out_format = coords_format_to_coords_directory_format(test_format)
+
+        out_arrays = read_coords_arrays(out_format)
+        self.assertListEqual(['G000005825', 'G900163845'],
+                             out_arrays.genome_ids)
+        self.assertListEqual([5, 5], out_arrays.block_sizes.tolist())
+        self.assertTrue(os.path.exists(str(out_format.path.joinpath(
+            'coords_block_index.npy'))))
+        self.assertListEqual(
+            [1353, 1143, 216, 1116, 276, 1797, 846, 891, 768, 645],
+            out_arrays.orf_lens.tolist())
+        self.assertListEqual(
+            self.TEST_DF[OGU_ORF_START_KEY].tolist(),
+            out_arrays.starts.tolist())
+        self.assertListEqual(
+            self.TEST_DF[OGU_ORF_END_KEY].tolist(),
+            out_arrays.ends.tolist())
+
+        with open(test_fp) as fh:
+            expected_contents = fh.read()
+        with out_format.file.view(CoordsFormat).open() as fh:
+            out_contents = fh.read()
+        self.assertEqual(expected_contents, out_contents)
+
+    def test_coords_directory_format_to_df(self):
+        # same result whether or not the parsed arrays are present
+        rel_fps = ['coords', 'coords_w_arrays', 'coords_w_index']
+        abs_fps = [self.get_data_path(rel_fp) for rel_fp in rel_fps]
+
+        for abs_fp in abs_fps:
+            test_format = CoordsDirectoryFormat(abs_fp, mode='r')
+            out_df = coords_directory_format_to_df(test_format)
+            assert_frame_equal(self.TEST_DF, out_df)
+
+    def test_coords_directory_format_to_df_columns(self):
+        # the public view is the frame pysyndna expects, not the compact one
+        test_format = CoordsDirectoryFormat(
+            self.get_data_path('coords_w_index'), mode='r')
+        for out_df in [coords_directory_format_to_df(test_format),
+                       coords_directory_format_to_df(
+                           test_format, ['G000005825']),
+                       coords_fp_to_df(self.get_data_path('coords.txt'))]:
+            self.assertListEqual(
+                self.OGU_ORF_COORDS_COLUMNS, out_df.columns.tolist())
+
+    def test_coords_directory_format_to_df_w_genome_ids(self):
+        # only the requested genomes' ORFs are loaded, unknown ids ignored,
+        # whether the blocks are found by parsing, by the genome codes or by
+        # the block index
+        expected_df = self.TEST_DF.iloc[5:].reset_index(drop=True)
+        rel_fps = ['coords', 'coords_w_arrays', 'coords_w_index']
+        abs_fps = [self.get_data_path(rel_fp) for rel_fp in rel_fps]
+
+        for abs_fp in abs_fps:
+            test_format = CoordsDirectoryFormat(abs_fp, mode='r')
+            out_df = coords_directory_format_to_df(
+                test_format, ['G900163845', 'G999999999'])
+            assert_frame_equal(expected_df, out_df)
+
+    def test_coords_directory_format_to_ogu_orf_lens(self):
+        # looked up whether the lengths are stored, calculated from the
+        # arrays or parsed; unknown genomes and ORFs, and malformed ids,
+        # have no length
+        ogu_orf_ids = ['G900163845_3251', 'G000005825_1', 'G000005825_6',
+                       'G999999999_1', 'G900163845_3247', 'G000005825',
+                       'G000005825_x']
+        rel_fps = ['coords', 'coords_w_arrays', 'coords_w_index']
+        abs_fps = [self.get_data_path(rel_fp) for rel_fp in rel_fps]
+
+        for abs_fp in abs_fps:
+            test_format = CoordsDirectoryFormat(abs_fp, mode='r')
+            out_lens = coords_directory_format_to_ogu_orf_lens(
+                test_format, ogu_orf_ids)
+            npt.assert_array_equal(
+                [645, 1353, np.nan, np.nan, 1797, np.nan, np.nan], out_lens)
+
+    def test_calc_orf_lens(self):
+        # lengths are inclusive of both ends, on either strand
+        out_lens = calc_orf_lens(np.array([816, 3392209, 7]),
+                                 np.array([2168, 3390413, 7]))
+        self.assertListEqual([1353, 1797, 1], out_lens.tolist())
+
+    def test_read_coords_arrays_orf_lens(self):
+        # stored lengths are read back, for all or some genomes; arrays
+        # stored without them have none
+        test_format = CoordsDirectoryFormat(
+            self.get_data_path('coords_w_index'), mode='r')
+        self.assertListEqual(
+            [1353, 1143, 216, 1116, 276, 1797, 846, 891, 768, 645],
+            read_coords_arrays(test_format).orf_lens.tolist())
+        self.assertListEqual(
+            [1797, 846, 891, 768, 645],
+            read_coords_arrays(test_format, ['G900163845']).orf_lens.tolist())
+
+        test_format = CoordsDirectoryFormat(
+            self.get_data_path('coords_w_arrays'), mode='r')
+        self.assertIsNone(read_coords_arrays(test_format).orf_lens)
+
+    def test_coords_arrays_to_compact_df(self):
+        out_df = _coords_arrays_to_compact_df(
+            coords_fp_to_arrays(self.get_data_path('coords.txt')))
+        assert_frame_equal(self.TEST_COMPACT_DF, out_df)
+
+    def test_coords_arrays_to_df_wo_compact_df(self):
+        # the pysyndna frame is built straight from the arrays
+        coords_arrays = coords_fp_to_arrays(self.get_data_path('coords.txt'))
+        with mock.patch(
+                'q2_pysyndna._type_format_coords._coords_arrays_to_compact_df'
+        ) as mock_to_compact_df:
+            out_df = coords_arrays_to_df(coords_arrays)
+
+        mock_to_compact_df.assert_not_called()
+        assert_frame_equal(self.TEST_DF, out_df)
+
+    def test_coords_arrays_to_compact_df_narrow_dtypes(self):
+        # each column gets the narrowest int dtype that holds its values
+        test_fp = self.get_data_path('coords_with_blank_line.txt')
+        out_df = _coords_arrays_to_compact_df(coords_fp_to_arrays(test_fp))
+        self.assertEqual(np.int16, out_df[ORF_NUM_KEY].dtype)
+        self.assertEqual(np.int32, out_df[OGU_ORF_START_KEY].dtype)
+        self.assertEqual(['G000005825', 'G900163845'],
+                         out_df[OGU_ID_KEY].cat.categories.tolist())
+
+    def test_read_coords_arrays_w_genome_ids(self):
+        test_format = CoordsDirectoryFormat(
+            self.get_data_path('coords_w_index'), mode='r')
+
+        out_arrays = read_coords_arrays(test_format, ['G000005825'])
+
+        self.assertListEqual(['G000005825'], out_arrays.genome_ids)
+        self.assertListEqual([5], out_arrays.block_sizes.tolist())
+        self.assertListEqual([1, 2, 3, 4, 5], out_arrays.orf_ids.tolist())
+        self.assertListEqual(
+            self.TEST_DF[OGU_ORF_START_KEY].tolist()[:5],
+            out_arrays.starts.tolist())
+
+    def test_read_coords_arrays_wo_arrays(self):
+        test_format = CoordsDirectoryFormat(
+            self.get_data_path('coords'), mode='r')
+        self.assertIsNone(read_coords_arrays(test_format))
+
     def test_df_to_coords_format(self):
         input_df = pandas.DataFrame(TestQuantOrfsData.COORDS_DICT)
-        expected_contents = ('G000005825_1\t816\t2168\n'
-                             'G000005825_2\t2348\t3490\n'
-                             'G000005825_3\t3744\t3959\n'
-                             'G000005825_4\t3971\t5086\n'
-                             'G000005825_5\t5098\t5373\n'
-                             'G900163845_3247\t3392209\t3390413\n'
-                             'G900163845_3248\t3393051\t3392206\n'
-                             'G900163845_3249\t3393938\t3393048\n'
-                             'G900163845_3250\t3394702\t3393935\n'
-                             'G900163845_3251\t3395077\t3395721')
-
-        # ensure the new format is filled with the expected contents
+        expected_contents_fp = self.get_data_path('coords.txt')
+        with open(expected_contents_fp, 'r') as fc:
+            expected_contents = fc.read()
+
+        # ensure the new format is filled with the expected contents,
+        # whether it is made from the pysyndna or the compact coords DataFrame
+        for test_df in [input_df, self.TEST_COMPACT_DF]:
+            test_format = df_to_coords_format(test_df)
+            test_format.validate()
+
+            with test_format.open() as fh:
+                out_contents = fh.read()
+            self.assertEqual(expected_contents.strip(), out_contents.strip())
+
+    def test_df_to_coords_format_interleaved(self):
+        # each genome's ORFs are written as one block, keeping their order
+        input_df = pandas.DataFrame(TestQuantOrfsData.COORDS_DICT).iloc[
+            [0, 5, 1, 6, 2]]
+        expected_contents = ('>G000005825\n'
+                             '1\t816\t2168\n'
+                             '2\t2348\t3490\n'
+                             '3\t3744\t3959\n'
+                             '>G900163845\n'
+                             '3247\t3392209\t3390413\n'
+                             '3248\t3393051\t3392206\n')
+
         test_format = df_to_coords_format(input_df)
 
         with test_format.open() as fh:
             out_contents = fh.read()
-        self.assertEqual(expected_contents.strip(), out_contents.strip())
+        self.assertEqual(expected_contents, out_contents)
+
+    def test_df_to_coords_format_err(self):
+        input_df = pandas.DataFrame({
+            OGU_ORF_ID_KEY: ["G000005825_1", "G000005825"],
+            OGU_ORF_START_KEY: [816, 2348],
+            OGU_ORF_END_KEY: [2168, 3490]})
 
-# NB: No tests for CoordsDirectoryFormat because it's a single-file one
+        with self.assertRaisesRegex(
+                ValidationError, "values must all be '<genome id>_<integer "
+                                 "ORF number>'"):
+            df_to_coords_format(input_df)
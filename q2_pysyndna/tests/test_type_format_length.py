@@ -1,6 +1,6 @@
 import pandas
 from pandas.testing import assert_frame_equal
-from qiime2.plugin import ValidationError
+from qiime2.plugin import ValidationError, model
 from qiime2.plugin.testing import TestPluginBase
 from q2_types.feature_data import FeatureData
 
@@ -11,6 +11,9 @@ from q2_pysyndna import (
 from q2_pysyndna._type_format_length import (
     length_fp_to_df,
     df_to_tsv_length_format,
+    tsv_length_format_to_tsv_length_directory_format,
+    tsv_length_directory_format_to_df,
+    df_to_length_index, lookup_lengths, read_length_index,
     FEATURE_NAME_KEY, LENGTH_KEY)
 
 
@@ -27,7 +30,8 @@ class TestTSVLengthFormat(TestPluginBase):
     package = f'{__package_name__}.tests'
 
     def test_tsv_length_format_valid(self):
-        filenames = ['feature_length/lengths.tsv']
+        filenames = ['feature_length/lengths.tsv', 'feature_lengths.tsv.gz',
+                     'feature_lengths.tsv.xz', 'feature_lengths.tsv.zst']
         filepaths = [self.get_data_path(filename)
                      for filename in filenames]
 
@@ -53,6 +57,28 @@ class TestTSVLengthFormat(TestPluginBase):
             test_format = TSVLengthFormat(filepath, mode='r')
             test_format.validate()
 
+    def test_tsv_length_format_line_num_invalid(self):
+        # line numbers count blank lines too
+        expected_msgs = {
+            'feature_lengths_malformed_2.tsv':
+                "Lengths must be integers, but found non-integer values: "
+                "line 1 has 'len'.",
+            'feature_lengths_malformed_3.tsv':
+                "Lengths must be non-negative integers, but line 1 has "
+                "-4249288.",
+            'feature_lengths_malformed_4.tsv':
+                "Length format requires two tab-separated columns, but line "
+                "4 has 1.",
+            'feature_lengths_malformed_5.tsv':
+                "Lengths must be integers, but found non-integer values: "
+                "line 2 has '1936387.5'."}
+
+        for filename, expected_msg in expected_msgs.items():
+            filepath = self.get_data_path(filename)
+            with self.assertRaisesRegex(ValidationError, expected_msg):
+                test_format = TSVLengthFormat(filepath, mode='r')
+                test_format.validate()
+
     def test_tsv_length_format_negint_invalid(self):
         expected_msg = "Lengths must be non-negative integers."
         filepath = self.get_data_path('feature_lengths_malformed_3.tsv')
@@ -79,6 +105,34 @@ class TestTSVLengthTransformers(TestPluginBase):
         out_df = length_fp_to_df(test_fp)
         assert_frame_equal(self.TEST_DF, out_df)
 
+    def test_length_fp_to_df_compressed(self):
+        filenames = ['feature_lengths.tsv.gz', 'feature_lengths.tsv.xz',
+                     'feature_lengths.tsv.zst']
+        for filename in filenames:
+            out_df = length_fp_to_df(self.get_data_path(filename))
+            assert_frame_equal(self.TEST_DF, out_df)
+
+    def test_length_fp_to_df_w_blank_line(self):
+        expected_df = pandas.DataFrame(
+            index=pandas.Index(["G000005825", "G000006175"],
+                               name=FEATURE_NAME_KEY),
+            data={LENGTH_KEY: [4249288, 1936387]})
+
+        test_fp = self.get_data_path('feature_lengths_with_blank_line.tsv')
+        out_df = length_fp_to_df(test_fp)
+        assert_frame_equal(expected_df, out_df)
+
+    def test_length_fp_to_df_numeric_ids(self):
+        # IDs that look like numbers are kept exactly as written
+        expected_df = pandas.DataFrame(
+            index=pandas.Index(["001", "0002", "12345678901234567890"],
+                               name=FEATURE_NAME_KEY),
+            data={LENGTH_KEY: [4249288, 1936387, 2476842]})
+
+        test_fp = self.get_data_path('feature_lengths_numeric_ids.tsv')
+        out_df = length_fp_to_df(test_fp)
+        assert_frame_equal(expected_df, out_df)
+
     def test_df_to_tsv_length_format(self):
         # ensure the new format is filled with the expected contents
         test_format = df_to_tsv_length_format(self.TEST_DF)
@@ -107,4 +161,97 @@ class TestTSVLengthTransformers(TestPluginBase):
                 ValidationError, "Lengths must be non-negative integers."):
             df_to_tsv_length_format(input_df)
 
-# NB: No tests for TSVLengthDirectoryFormat because it's a single-file one
+    def test_tsv_length_format_to_tsv_length_directory_format(self):
+        test_fp = self.get_data_path('feature_length/lengths.tsv')
+        test_format = TSVLengthFormat(test_fp, mode='r')
+
+        out_format = tsv_length_format_to_tsv_length_directory_format(
+            test_format)
+        out_format.validate()
+
+        length_index = read_length_index(out_format)
+        sorted_df = self.TEST_DF.sort_index()
+        self.assertListEqual(sorted_df.index.tolist(),
+                             length_index.ids.tolist())
+        self.assertListEqual(sorted_df[LENGTH_KEY].tolist(),
+                             length_index.lengths.tolist())
+
+        with open(test_fp) as fh:
+            expected_contents = fh.read()
+        with out_format.file.view(TSVLengthFormat).open() as fh:
+            out_contents = fh.read()
+        self.assertEqual(expected_contents, out_contents)
+
+    def test_tsv_length_directory_format_to_df(self):
+        # same result whether or not the length index is present
+        rel_fps = ['feature_length', 'feature_length_w_index']
+        for rel_fp in rel_fps:
+            test_format = TSVLengthDirectoryFormat(
+                self.get_data_path(rel_fp), mode='r')
+            out_df = tsv_length_directory_format_to_df(test_format)
+            assert_frame_equal(self.TEST_DF, out_df)
+
+    def test_tsv_length_directory_format_to_df_w_feature_ids(self):
+        # only the requested, known features, in the requested order
+        expected_df = pandas.DataFrame(
+            index=pandas.Index(["G000007005", "G000005825"],
+                               name=FEATURE_NAME_KEY),
+            data={LENGTH_KEY: [2992245, 4249288]})
+
+        rel_fps = ['feature_length', 'feature_length_w_index']
+        for rel_fp in rel_fps:
+            test_format = TSVLengthDirectoryFormat(
+                self.get_data_path(rel_fp), mode='r')
+            out_df = tsv_length_directory_format_to_df(
+                test_format, ["G000007005", "G999999999", "G000005825"])
+            assert_frame_equal(expected_df, out_df)
+
+    def test_lookup_lengths(self):
+        length_index = df_to_length_index(self.TEST_DF.iloc[::-1])
+        expected_df = pandas.DataFrame(
+            index=pandas.Index(["G000006175", "G000005825"],
+                               name=FEATURE_NAME_KEY),
+            data={LENGTH_KEY: [1936387, 4249288]})
+
+        # IDs before, between and after the indexed ones are not found
+        out_df = lookup_lengths(
+            length_index,
+            ["A", "G000006175", "G000006176", "G000005825", "Z"])
+        assert_frame_equal(expected_df, out_df)
+
+    def test_lookup_lengths_empty(self):
+        length_index = df_to_length_index(self.TEST_DF.iloc[:0])
+        out_df = lookup_lengths(length_index, ["G000005825"])
+        self.assertEqual(0, len(out_df))
+
+    def test_read_length_index_wo_index(self):
+        test_format = TSVLengthDirectoryFormat(
+            self.get_data_path('feature_length'), mode='r')
+        self.assertIsNone(read_length_index(test_format))
+
+
+class TestTSVLengthDirectoryFormat(TestPluginBase):
+    package = f'{__package_name__}.tests'
+
+    def test_tsv_length_directory_format_valid(self):
+        rel_fps = ['feature_length', 'feature_length_w_index']
+        for rel_fp in rel_fps:
+            test_format = TSVLengthDirectoryFormat(
+                self.get_data_path(rel_fp), mode='r')
+            test_format.validate()
+
+    def test_tsv_length_directory_format_single_file(self):
+        # so that a plain lengths file imports without an input format
+        self.assertTrue(issubclass(
+            TSVLengthDirectoryFormat, model.SingleFileDirectoryFormatBase))
+        self.assertIs(TSVLengthFormat, TSVLengthDirectoryFormat.file.format)
+
+    def test_tsv_length_directory_format_invalid(self):
+        abs_fp = self.get_data_path('feature_length_w_partial_index')
+
+        with self.assertRaisesRegex(
+                ValidationError,
+                "Length index arrays must be either both present or both "
+                "absent."):
+            test_format = TSVLengthDirectoryFormat(abs_fp, mode='r')
+            test_format.validate()
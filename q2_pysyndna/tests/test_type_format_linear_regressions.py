@@ -1,14 +1,19 @@
+import os
+
 from qiime2.plugin import ValidationError
 from qiime2.plugin.testing import TestPluginBase
 
 from q2_pysyndna import (
     __package_name__, LinearRegressionsYamlFormat,
+    LinearRegressionsInputsYamlFormat,
     LinearRegressionsDirectoryFormat, LinearRegressions)
 from q2_pysyndna._type_format_pysyndna_log import (
     extract_fp_from_directory_format)
 from q2_pysyndna._type_format_linear_regressions import (
     LinearRegressionsObjects,
     yaml_fp_to_linear_regressions_yaml_format,
+    yaml_fp_to_input_fingerprints,
+    merge_linear_regressions_directory_formats,
     dict_to_linear_regressions_yaml_format,
     linear_regressions_directory_format_to_linear_regressions_objects,
     linear_regressions_objects_to_linear_regressions_directory_format)
@@ -59,12 +64,32 @@ class TestLinearRegressionsYamlFormat(TestPluginBase):
                 test_format.validate()
 
 
+class TestLinearRegressionsInputsYamlFormat(TestPluginBase):
+    package = f'{__package_name__}.tests'
+
+    def test_linear_regressions_inputs_yaml_format_valid(self):
+        filepath = self.get_data_path(
+            'linear_regressions_w_inputs/linear_regressions_inputs.yaml')
+        test_format = LinearRegressionsInputsYamlFormat(filepath, mode='r')
+        test_format.validate()
+
+    def test_linear_regressions_inputs_yaml_format_invalid(self):
+        filepath = self.get_data_path(
+            'linear_regressions_inputs_malformed.yaml')
+        with self.assertRaisesRegex(
+                ValidationError, r'Expected a dictionary of sample ids'):
+            test_format = LinearRegressionsInputsYamlFormat(
+                filepath, mode='r')
+            test_format.validate()
+
+
 class TestLinearRegressionsDirectoryFormat(TestPluginBase):
     package = f'{__package_name__}.tests'
 
     def test_linear_regressions_directory_format_valid(self):
         rel_fps = ['linear_regressions',
-                   'linear_regressions_minimal']
+                   'linear_regressions_minimal',
+                   'linear_regressions_w_inputs']
         abs_fps = [self.get_data_path(rel_fp)
                    for rel_fp in rel_fps]
 
@@ -133,6 +158,11 @@ example3: null
         log_msgs_list=["The following syndnas were dropped because they had "
                        "fewer than 200 total reads aligned:['p166']"])
 
+    INPUT_FINGERPRINTS_1_2_3 = {
+        'example1': '5d8f0c2a9b7e4d1f3a6c8e0b2d4f6a8c',
+        'example2': '0e1f2a3b4c5d6e7f8091a2b3c4d5e6f7',
+        'example3': '9a8b7c6d5e4f30211203f4e5d6c7b8a9'}
+
     @staticmethod
     def compare_linear_regressions_directory_formats(
             expected_format, out_format):
@@ -270,3 +300,137 @@ example3: null
                     self.compare_linear_regressions_directory_formats(
                         expected_format, out_format):
                 self.assertEqual(exp_obs_pair[0], exp_obs_pair[1])
+
+    def test_yaml_fp_to_input_fingerprints(self):
+        test_fp = self.get_data_path(
+            'linear_regressions_w_inputs/linear_regressions_inputs.yaml')
+        self.assertDictEqual(self.INPUT_FINGERPRINTS_1_2_3,
+                             yaml_fp_to_input_fingerprints(test_fp))
+
+    def test_linear_regressions_directory_format_w_inputs_round_trip(self):
+        test_format = LinearRegressionsDirectoryFormat(
+            self.get_data_path('linear_regressions_w_inputs'), mode='r')
+
+        out_obj = linear_regressions_directory_format_to_linear_regressions_objects(test_format)
+        self.assertDictEqual(
+            self.INPUT_FINGERPRINTS_1_2_3, out_obj.input_fingerprints)
+
+        out_format = linear_regressions_objects_to_linear_regressions_directory_format(out_obj)
+        out_format.validate()
+        round_trip_obj = linear_regressions_directory_format_to_linear_regressions_objects(out_format)
+        self.assertTupleEqual(out_obj, round_trip_obj)
+        self.assertDictEqual(self.INPUT_FINGERPRINTS_1_2_3,
+                             round_trip_obj.input_fingerprints)
+
+    def test_linear_regressions_objects_unpacks_to_two_values(self):
+        obj = LinearRegressionsObjects(
+            self.TEST_DICT_1_2_3, self.LINREGOBJ_1_2_3.log_msgs_list,
+            self.INPUT_FINGERPRINTS_1_2_3)
+
+        linregs_dict, log_msgs_list = obj
+        self.assertDictEqual(self.TEST_DICT_1_2_3, linregs_dict)
+        self.assertListEqual(self.LINREGOBJ_1_2_3.log_msgs_list,
+                             log_msgs_list)
+        self.assertDictEqual(self.INPUT_FINGERPRINTS_1_2_3,
+                             obj.input_fingerprints)
+        self.assertIsNone(self.LINREGOBJ_1_2_3.input_fingerprints)
+
+    def test_linear_regressions_directory_format_wo_inputs(self):
+        test_format = LinearRegressionsDirectoryFormat(
+            self.get_data_path('linear_regressions'), mode='r')
+
+        out_obj = linear_regressions_directory_format_to_linear_regressions_objects(test_format)
+        self.assertIsNone(out_obj.input_fingerprints)
+
+        out_format = linear_regressions_objects_to_linear_regressions_directory_format(out_obj)
+        self.assertFalse(os.path.exists(extract_fp_from_directory_format(
+            out_format, out_format.inputs_yaml)))
+
+
+class TestMergeLinearRegressions(TestPluginBase):
+    package = f'{__package_name__}.tests'
+
+    T = TestLinearRegressionsTransformers
+
+    def _make_format(self, linregs_dict, log_msgs_list,
+                     input_fingerprints=None):
+        return linear_regressions_objects_to_linear_regressions_directory_format(
+            LinearRegressionsObjects(
+                linregs_dict, log_msgs_list, input_fingerprints))
+
+    def _read(self, merged_format):
+        merged_format.validate()
+        return linear_regressions_directory_format_to_linear_regressions_objects(
+            merged_format)
+
+    def test_merge_linear_regressions_directory_formats(self):
+        formats = [
+            LinearRegressionsDirectoryFormat(
+                self.get_data_path('linear_regressions_minimal'), mode='r'),
+            self._make_format(self.T.TEST_DICT_2_3, ["msg 2_3"])]
+
+        obs = self._read(merge_linear_regressions_directory_formats(formats))
+
+        self.assertDictEqual(self.T.TEST_DICT_1_2_3, obs.linregs_dict)
+        self.assertListEqual(["msg 2_3"], obs.log_msgs_list)
+        self.assertIsNone(obs.input_fingerprints)
+
+    def test_merge_linear_regressions_directory_formats_fingerprints(self):
+        fingerprints = self.T.INPUT_FINGERPRINTS_1_2_3
+        formats = [
+            self._make_format(self.T.TEST_DICT_1, ["msg 1"],
+                              {'example1': fingerprints['example1']}),
+            self._make_format(self.T.TEST_DICT_2_3, ["msg 2_3"])]
+
+        obs = self._read(merge_linear_regressions_directory_formats(formats))
+
+        self.assertDictEqual({'example1': fingerprints['example1']},
+                             obs.input_fingerprints)
+        self.assertListEqual(["msg 1", "msg 2_3"], obs.log_msgs_list)
+
+    def test_merge_linear_regressions_directory_formats_collision_error(
+            self):
+        formats = [self._make_format(self.T.TEST_DICT_1_2_3, []),
+                   self._make_format(self.T.TEST_DICT_2_3, [])]
+
+        with self.assertRaisesRegex(
+                ValueError, r"The following sample ids have regressions in "
+                            r"more than one input: \['example2', "
+                            r"'example3'\]"):
+            merge_linear_regressions_directory_formats(formats)
+
+    def test_merge_linear_regressions_directory_formats_collision_first(
+            self):
+        other_dict_1 = {'example1': None}
+        formats = [self._make_format(self.T.TEST_DICT_1, ["msg a"], {}),
+                   self._make_format(other_dict_1, ["msg b"],
+                                     {'example1': 'b'})]
+
+        obs = self._read(merge_linear_regressions_directory_formats(
+            formats, 'first'))
+
+        self.assertDictEqual(self.T.TEST_DICT_1, obs.linregs_dict)
+        self.assertDictEqual({}, obs.input_fingerprints)
+        self.assertListEqual(
+            ["msg a", "msg b",
+             "Kept the first regression of each of the following sample "
+             "ids, which had regressions in more than one input: "
+             "['example1']"],
+            obs.log_msgs_list)
+
+    def test_merge_linear_regressions_directory_formats_collision_last(
+            self):
+        other_dict_1 = {'example1': None}
+        formats = [self._make_format(self.T.TEST_DICT_1_2_3, [], {}),
+                   self._make_format(other_dict_1, [], {'example1': 'b'})]
+
+        obs = self._read(merge_linear_regressions_directory_formats(
+            formats, 'last'))
+
+        self.assertDictEqual({**self.T.TEST_DICT_2_3, **other_dict_1},
+                             obs.linregs_dict)
+        self.assertDictEqual({'example1': 'b'}, obs.input_fingerprints)
+
+    def test_merge_linear_regressions_directory_formats_bad_policy(self):
+        with self.assertRaisesRegex(ValueError, r"Collision policy must be"):
+            merge_linear_regressions_directory_formats([], 'middle')
@@ -25,7 +25,10 @@ class TestSyndnaPoolCsvFormat(TestPluginBase):
 
     def test_syndna_pool_csv_format_valid(self):
         filenames = ['syndna_pool.csv',
-                     'syndna_pool_with_comments.csv']
+                     'syndna_pool_with_comments.csv',
+                     'syndna_pool.csv.gz',
+                     'syndna_pool.csv.xz',
+                     'syndna_pool.csv.zst']
         filepaths = [self.get_data_path(filename)
                      for filename in filenames]
 
@@ -60,7 +63,10 @@ class TestSyndnaPoolCsvFormatTransformers(TestPluginBase):
         expected_df = pandas.DataFrame(expected_dict)
 
         filenames = ['syndna_pool.csv',
-                     'syndna_pool_with_comments.csv']
+                     'syndna_pool_with_comments.csv',
+                     'syndna_pool.csv.gz',
+                     'syndna_pool.csv.xz',
+                     'syndna_pool.csv.zst']
         filepaths = [self.get_data_path(filename)
                      for filename in filenames]
 